@@ -0,0 +1,218 @@
+import argparse
+import configparser
+import csv
+import psycopg2
+import mylib
+from mylib import logger
+import db
+import result_cache
+from sql_queries import analytics_queries
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = pq = None
+
+# ---------------------------------------------------------------------------------
+# Parameterized analytics queries, with streaming export of large results
+#
+#     python analytics.py top_songs --limit 20 --start 2018-11-01 --end 2018-12-01
+#     python analytics.py top_session_users --limit 1
+#     python analytics.py top_sessions_for_user --user-id 49
+#     python analytics.py top_songs_for_user --user-id 49 --limit 5
+#     python analytics.py user_songplays --user-id 49 --export plays.csv
+# ---------------------------------------------------------------------------------
+
+
+CHUNK_ROWS = 10000
+
+
+def bind_params(name, **params):
+    """
+    Return the query and its complete bind parameters (defaults filled in).
+
+    Raises:
+        KeyError : unknown query name
+        ValueError : unknown or missing parameter
+
+    """
+    query, defaults = analytics_queries[name]
+
+    unknown = set(params) - set(defaults)
+    if unknown:
+        raise ValueError("query [ {} ] has no parameter {}".format(name, sorted(unknown)))
+
+    bound = dict(defaults)
+    bound.update({key: value for key, value in params.items() if value is not None})
+
+    # start / end may stay NULL (no bound); the others are required
+    missing = [key for key, value in bound.items()
+               if value is None and key not in ('start', 'end')]
+    if missing:
+        raise ValueError("query [ {} ] needs parameter {}".format(name, missing))
+
+    return query, bound
+
+
+def run_query(conn, name, config=None, **params):
+    """
+    Run an analytics query (through the result cache) and return a DataFrame;
+    for small results such as the top-N queries.
+
+    Parameters:
+        conn (db session object) : connection to a database session
+        name (str) : key of *analytics_queries*
+        config (config file object) : access to the [CACHE] settings
+        params : bind parameters, e.g. user_id = 49, limit = 5
+
+    """
+    query, bound = bind_params(name, **params)
+    return result_cache.read_sql(query, conn, bound, config)
+
+
+def iter_chunks(conn, name, chunk_rows=CHUNK_ROWS, **params):
+    """
+    Stream the result of an analytics query in chunks through a server-side
+    (named) cursor, so memory use does not depend on the result size.
+
+    Yields:
+        (columns, rows) : column names, and up to chunk_rows rows; the first
+                          chunk comes even when the result is empty, so an
+                          export always has the column names
+
+    """
+    query, bound = bind_params(name, **params)
+
+    cur = conn.cursor(name = 'analytics_{}'.format(name))
+    cur.itersize = chunk_rows
+
+    try:
+        cur.execute(query, bound)
+
+        # a named cursor describes the result after the first fetch
+        rows = cur.fetchmany(chunk_rows)
+        columns = [column[0] for column in cur.description]
+        yield columns, rows
+
+        while rows:
+            rows = cur.fetchmany(chunk_rows)
+            if rows:
+                yield columns, rows
+    finally:
+        cur.close()
+        conn.commit()
+
+
+def export_csv(chunks, path):
+    """
+    Write the chunks to a CSV file, one chunk at a time; the header comes
+    from the first chunk, even when it has no rows.
+
+    Returns:
+        count (int) : rows written
+
+    """
+    count = 0
+    header = None
+    with open(path, 'w', newline = '') as f:
+        writer = csv.writer(f)
+        for columns, rows in chunks:
+            if header is None:
+                header = columns
+                writer.writerow(header)
+            writer.writerows(rows)
+            count += len(rows)
+    return count
+
+
+def export_parquet(chunks, path):
+    """
+    Write the chunks to a Parquet file, one row group per chunk
+    (needs pyarrow).
+
+    Returns:
+        count (int) : rows written
+
+    """
+    if pq is None:
+        raise ImportError("Parquet export needs pyarrow:  pip install pyarrow")
+
+    count = 0
+    writer = None
+    try:
+        for columns, rows in chunks:
+            # an empty result still gets its columns
+            if rows:
+                table = pa.Table.from_pylist([dict(zip(columns, row)) for row in rows])
+            else:
+                table = pa.Table.from_pydict({column: [] for column in columns})
+            if writer is None:
+                writer = pq.ParquetWriter(path, table.schema)
+            writer.write_table(table.cast(writer.schema))
+            count += len(rows)
+    finally:
+        if writer is not None:
+            writer.close()
+    return count
+
+
+def export_query(conn, name, path, chunk_rows=CHUNK_ROWS, **params):
+    """
+    Export the full result of an analytics query to CSV or Parquet (by file
+    extension), streaming it chunk by chunk.
+
+    Returns:
+        count (int) : rows written
+
+    """
+    chunks = iter_chunks(conn, name, chunk_rows, **params)
+
+    if path.endswith('.parquet'):
+        count = export_parquet(chunks, path)
+    else:
+        count = export_csv(chunks, path)
+
+    logger.info('export [ {} ] :  {} rows to {}'.format(name, count, path))
+    return count
+
+
+def main():
+    parser = argparse.ArgumentParser(description = 'Run a Sparkify analytics query')
+    parser.add_argument('query', choices = sorted(analytics_queries))
+    parser.add_argument('--user-id', type = int)
+    parser.add_argument('--start', help = 'first day, e.g. 2018-11-01')
+    parser.add_argument('--end', help = 'day after the last day, e.g. 2018-12-01')
+    parser.add_argument('--limit', type = int)
+    parser.add_argument('--export', help = 'stream the full result to a .csv or .parquet file')
+    parser.add_argument('--chunk-rows', type = int, default = CHUNK_ROWS)
+    args = parser.parse_args()
+    mylib.setup_logger()
+
+    config = configparser.ConfigParser()
+    config.read('dwh.cfg')
+
+    defaults = analytics_queries[args.query][1]
+    params = {key: value for key, value in [('user_id', args.user_id), ('start', args.start),
+                                            ('end', args.end), ('limit', args.limit)]
+              if key in defaults and value is not None}
+
+    try:
+        conn = db.connect(config)
+    except psycopg2.Error as e:
+        logger.info("Error :  Could not make connection to the sparkify DB")
+        print(e)
+        return
+
+    try:
+        if args.export:
+            count = export_query(conn, args.query, args.export, args.chunk_rows, **params)
+            print('{} rows written to {}'.format(count, args.export))
+        else:
+            print(run_query(conn, args.query, config, **params).to_string(index = False))
+    finally:
+        conn.close()
+
+
+if __name__ == "__main__":
+    main()
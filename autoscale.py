@@ -0,0 +1,269 @@
+import math
+import os
+import time
+from urllib.parse import urlparse
+from mylib import logger
+import metrics
+import manage_redshift_cluster as cluster
+from botocore.exceptions import ClientError
+
+# ---------------------------------------------------------------------------------
+# Input-size-aware cluster sizing around the heavy ETL stages: measure the
+# input volume, resize the cluster up before the staging load so that every
+# slice gets about *bytes_per_slice* of input, and back down after the load.
+# The cluster is never made smaller for the load; when it already has enough
+# nodes it is left alone.
+#
+# resize_method = elastic uses resize_cluster (minutes, sessions are held);
+# a refused elastic resize falls back to classic, which uses modify_cluster
+# and also works against moto.
+# ---------------------------------------------------------------------------------
+
+
+SLICES_PER_NODE = {'dc2.large'    : 2,
+                   'dc2.8xlarge'  : 16,
+                   'ds2.xlarge'   : 2,
+                   'ds2.8xlarge'  : 16,
+                   'ra3.xlplus'   : 2,
+                   'ra3.4xlarge'  : 4,
+                   'ra3.16xlarge' : 16
+                  }
+
+# node counts of a multi-node cluster - {node type: (min, max)}
+NODE_LIMITS = {'dc2.large'    : (2, 32),
+               'dc2.8xlarge'  : (2, 128),
+               'ds2.xlarge'   : (2, 32),
+               'ds2.8xlarge'  : (2, 128),
+               'ra3.xlplus'   : (2, 32),
+               'ra3.4xlarge'  : (2, 64),
+               'ra3.16xlarge' : (2, 128)
+              }
+
+# node types that an elastic resize can only halve or double; the others can
+# go to any count between half and double the current one
+ELASTIC_HALF_DOUBLE = ['dc2.8xlarge', 'ds2.8xlarge', 'ra3.4xlarge', 'ra3.16xlarge']
+
+BYTES_PER_SLICE = 256 * 1024 * 1024
+MIN_NODES       = 2
+MAX_NODES       = 8
+RESIZE_METHOD   = 'elastic'
+
+
+def get_settings(config):
+    """
+    Return the [AUTOSCALE] settings.
+
+    """
+    return dict(
+        bytes_per_slice = int(config.getfloat('AUTOSCALE', 'BYTES_PER_SLICE',
+                                              fallback = BYTES_PER_SLICE)),
+        min_nodes       = config.getint('AUTOSCALE', 'MIN_NODES', fallback = MIN_NODES),
+        max_nodes       = config.getint('AUTOSCALE', 'MAX_NODES', fallback = MAX_NODES),
+        resize_method   = config.get('AUTOSCALE', 'RESIZE_METHOD', fallback = RESIZE_METHOD))
+
+
+def s3_prefix_bytes(s3, url):
+    """
+    Return (bytes, objects) under an S3 prefix, e.g. 's3://udacity-dend/log_data'.
+
+    """
+    parsed = urlparse(url.strip('\'"'))
+    paginator = s3.get_paginator('list_objects_v2')
+
+    size, count = 0, 0
+    for page in paginator.paginate(Bucket = parsed.netloc, Prefix = parsed.path.lstrip('/')):
+        for obj in page.get('Contents', []):
+            size += obj['Size']
+            count += 1
+    return size, count
+
+
+def local_path_bytes(path):
+    """
+    Return (bytes, files) under a local directory.
+
+    """
+    size, count = 0, 0
+    for root, dirs, files in os.walk(path):
+        for name in files:
+            size += os.path.getsize(os.path.join(root, name))
+            count += 1
+    return size, count
+
+
+def measure_input(config, s3=None):
+    """
+    Measure the volume of the log and song data to be staged, from the
+    [S3] or [LOCAL] paths depending on STAGING_SOURCE.
+
+    Returns:
+        input_bytes (int) : total size of the input files
+
+    """
+    total = 0
+    if config.get('ETL', 'STAGING_SOURCE', fallback = 's3') == 'local':
+        for key in ['LOG_DATA', 'SONG_DATA']:
+            size, count = local_path_bytes(config['LOCAL'][key])
+            logger.info('input [ {} ] :  {} files, {:.1f} MB'.format(key.lower(), count,
+                                                                  size / 1024 / 1024))
+            total += size
+    else:
+        for key in ['LOG_DATA', 'SONG_DATA']:
+            size, count = s3_prefix_bytes(s3, config['S3'][key])
+            logger.info('input [ {} ] :  {} objects, {:.1f} MB'.format(key.lower(), count,
+                                                                    size / 1024 / 1024))
+            total += size
+    return total
+
+
+def plan_nodes(input_bytes, node_type, bytes_per_slice=BYTES_PER_SLICE,
+               min_nodes=MIN_NODES, max_nodes=MAX_NODES):
+    """
+    Return the number of nodes that gives every slice about *bytes_per_slice*
+    of input, within [min_nodes, max_nodes].
+
+    """
+    slices = SLICES_PER_NODE.get(node_type, 2)
+    nodes = math.ceil(input_bytes / float(bytes_per_slice * slices))
+    return max(min_nodes, min(max_nodes, nodes))
+
+
+def elastic_node_counts(node_type, current):
+    """
+    Return the node counts an elastic resize of a *current*-node cluster
+    accepts, within the limits of the node type.
+
+    """
+    low, high = NODE_LIMITS.get(node_type, (MIN_NODES, MAX_NODES))
+    if node_type in ELASTIC_HALF_DOUBLE:
+        counts = [current * 2] + ([current // 2] if current % 2 == 0 else [])
+    else:
+        counts = range(math.ceil(current / 2.0), current * 2 + 1)
+    return sorted(count for count in counts if low <= count <= high)
+
+
+def valid_nodes(nodes, node_type, current, method=RESIZE_METHOD):
+    """
+    Return the node count to resize to for a plan of *nodes*: within the
+    limits of the node type and, for an elastic resize, the smallest count
+    it accepts that is at least the plan (or the largest it accepts).
+
+    """
+    low, high = NODE_LIMITS.get(node_type, (MIN_NODES, MAX_NODES))
+    nodes = max(low, min(high, nodes))
+    if method != 'elastic' or nodes == current:
+        return nodes
+
+    counts = elastic_node_counts(node_type, current)
+    larger = [count for count in counts if count >= nodes]
+    if larger:
+        return larger[0]
+    return counts[-1] if counts else current
+
+
+def resize(redshift, props, nodes, method=RESIZE_METHOD, sleep=time.sleep):
+    """
+    Resize the cluster to *nodes* nodes and wait until it is available; an
+    elastic resize that is refused (or not supported, e.g. by moto) is done
+    as a classic resize instead.
+
+    Returns:
+        seconds (float) : time until the resized cluster was available
+
+    """
+    cluster_id = props['ClusterIdentifier']
+    start = time.time()
+
+    if method == 'elastic':
+        try:
+            redshift.resize_cluster(ClusterIdentifier = cluster_id,
+                                    NumberOfNodes     = nodes,
+                                    Classic           = False)
+        except (ClientError, NotImplementedError) as e:
+            logger.info('autoscale :  elastic resize refused ({}), classic resize'.format(e))
+            method = 'classic'
+
+    if method != 'elastic':
+        redshift.modify_cluster(ClusterIdentifier = cluster_id,
+                                ClusterType       = 'single-node' if nodes == 1 else 'multi-node',
+                                NodeType          = props['NodeType'],
+                                NumberOfNodes     = nodes)
+
+    cluster.wait_for_cluster(redshift, cluster_id, 'available', sleep = sleep, nodes = nodes)
+    return time.time() - start
+
+
+def scale_to(config, nodes, reason, clients=None, sleep=time.sleep):
+    """
+    Resize the cluster to *nodes* nodes unless it already has them; the
+    decision and the time taken are logged and recorded in the metrics.
+
+    Returns:
+        previous (int) : the number of nodes before the resize, or None when
+                         the cluster was not resized
+
+    """
+    clients = clients or cluster.get_clients(config)
+    settings = get_settings(config)
+    cluster_id = config['DWH']['DWH_CLUSTER_IDENTIFIER']
+
+    props = cluster.describe_cluster(clients['redshift'], cluster_id)
+    if props is None or props['ClusterStatus'] != 'available':
+        logger.info('autoscale :  cluster not available, not resized')
+        return None
+
+    previous = props['NumberOfNodes']
+    if nodes == previous:
+        logger.info('autoscale [ {} ] :  keep {} nodes'.format(reason, nodes))
+        return None
+
+    logger.info('autoscale [ {} ] :  resize {} -> {} nodes ({})'
+                .format(reason, previous, nodes, settings['resize_method']))
+    seconds = resize(clients['redshift'], props, nodes, settings['resize_method'], sleep)
+    logger.info('autoscale [ {} ] :  {} nodes available after {:.0f} sec'
+                .format(reason, nodes, seconds))
+    metrics.record('autoscale', '{}:{}->{}'.format(reason, previous, nodes), seconds)
+
+    return previous
+
+
+def scale_for_load(config, clients=None, sleep=time.sleep):
+    """
+    Measure the input and resize the cluster up for the staging load; a
+    cluster that already has the planned nodes, or more, is left alone.
+
+    Returns:
+        previous (int) : the number of nodes to scale back to, or None
+
+    """
+    clients = clients or cluster.get_clients(config)
+    settings = get_settings(config)
+    node_type = config['DWH']['DWH_NODE_TYPE']
+
+    props = cluster.describe_cluster(clients['redshift'], config['DWH']['DWH_CLUSTER_IDENTIFIER'])
+    if props is None or props['ClusterStatus'] != 'available':
+        logger.info('autoscale :  cluster not available, not resized')
+        return None
+    current = props['NumberOfNodes']
+
+    input_bytes = measure_input(config, clients['s3'])
+    planned = plan_nodes(input_bytes, node_type, settings['bytes_per_slice'],
+                         settings['min_nodes'], settings['max_nodes'])
+    nodes = valid_nodes(max(planned, current), node_type, current, settings['resize_method'])
+    logger.info('autoscale :  {:.1f} MB input, {} nodes planned, {} nodes on the cluster'
+                .format(input_bytes / 1024 / 1024, planned, current))
+
+    if nodes <= current:
+        logger.info('autoscale [ load ] :  keep {} nodes'.format(current))
+        return None
+
+    return scale_to(config, nodes, 'load', clients, sleep)
+
+
+def scale_back(config, nodes, clients=None, sleep=time.sleep):
+    """
+    Resize the cluster back to its size before the load.
+
+    """
+    if nodes is not None:
+        scale_to(config, nodes, 'post-load', clients, sleep)
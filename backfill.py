@@ -0,0 +1,437 @@
+import argparse
+import calendar
+import configparser
+import datetime
+import re
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from urllib.parse import urlparse
+import psycopg2
+import mylib
+from mylib import logger
+import db
+import metrics
+import local_ingest
+import manage_redshift_cluster as cluster
+from sql_queries import (get_query, get_target, target_query, copy_query, partition_copy_query,
+                         partition_events_create, partition_events_drop, partition_lock,
+                         partition_queries, partition_songplays_drop, partition_status_delete,
+                         partition_status_insert, partition_status_select,
+                         partition_transform_queries)
+
+# ---------------------------------------------------------------------------------
+# Time-partitioned backfill of LOG_DATA: the log prefix is split into day
+# partitions (log_data/<year>/<month>/<year>-<month>-<day>-events.json, or
+# compressed); each partition is loaded and transformed on its own pooled
+# connection, with at most *workers* at a time, and its status is kept in the
+# etl_backfill table. A partition replaces its day (UTC) in the analytics
+# tables, so any day can be re-run on its own.
+#
+#     python backfill.py --start 2018-11-01 --end 2018-12-01 --workers 4
+#     python backfill.py --failed
+#     python backfill.py --days 2018-11-05 --force
+#     python backfill.py --status
+# ---------------------------------------------------------------------------------
+
+
+WORKERS = 4
+
+# the day in a log file name, e.g. 2018-11-05-events.json, or compressed
+# (see [COPY] compression) 2018-11-05-events.json.gz
+DAY_PATTERN = re.compile(r'(\d{4})-(\d{2})-(\d{2})[^/]*\.json(?:\.gz|\.zst|\.bz2)?$')
+
+
+def parse_day(value):
+    """
+    Return the datetime.date of a 'YYYY-MM-DD' string.
+
+    """
+    return datetime.datetime.strptime(value, '%Y-%m-%d').date()
+
+
+def day_partition(path):
+    """
+    Return (day, prefix) for a log file path or key, e.g.
+    'log_data/2018/11/2018-11-05-events.json' gives
+    (date(2018, 11, 5), 'log_data/2018/11/2018-11-05'); None when the name
+    holds no day.
+
+    """
+    match = DAY_PATTERN.search(path)
+    if match is None:
+        return None
+    day = datetime.date(*[int(part) for part in match.groups()])
+    return day, path[:match.start()] + day.isoformat()
+
+
+def day_sources(files):
+    """
+    Return the sources of every day partition, given the files of each day:
+    a log file named by its day may run past UTC midnight, so the events of
+    a day are in the files of the day and of the day before. The day after
+    the last file is a partition of its own.
+
+    Parameters:
+        files (dict) : {day: source}, the prefix of the files of the day
+
+    Returns:
+        partitions (dict) : {day: [source, ...]}, oldest first
+
+    """
+    partitions = {}
+    for day in sorted(files):
+        partitions.setdefault(day, []).append(files[day])
+        partitions.setdefault(day + datetime.timedelta(days = 1), []).append(files[day])
+    return partitions
+
+
+def list_partitions(config, s3=None):
+    """
+    Split the log data into day partitions, from the [S3] or [LOCAL] path
+    depending on STAGING_SOURCE.
+
+    Returns:
+        partitions (dict) : {day: [source, ...]}, the S3 URL or local path
+                            prefixes of the files holding events of the day
+                            (see day_sources)
+
+    """
+    files = {}
+
+    if config.get('ETL', 'STAGING_SOURCE', fallback = 's3') == 'local':
+        for path in local_ingest.iter_json_files(config['LOCAL']['LOG_DATA']):
+            partition = day_partition(path)
+            if partition:
+                files[partition[0]] = partition[1]
+        return day_sources(files)
+
+    parsed = urlparse(config['S3']['LOG_DATA'].strip('\'"'))
+    paginator = s3.get_paginator('list_objects_v2')
+
+    for page in paginator.paginate(Bucket = parsed.netloc, Prefix = parsed.path.lstrip('/')):
+        for obj in page.get('Contents', []):
+            partition = day_partition(obj['Key'])
+            if partition:
+                files[partition[0]] = 's3://{}/{}'.format(parsed.netloc, partition[1])
+    return day_sources(files)
+
+
+def read_status(cur, conn):
+    """
+    Return the backfill status of every partition recorded so far.
+
+    Returns:
+        status (dict) : {day: (status, rows, seconds, error, updated)}
+
+    """
+    cur.execute(get_query('backfill_table_create').sql)
+    cur.execute(partition_status_select)
+    status = {row[0]: row[2:] for row in cur.fetchall()}
+    conn.commit()
+    return status
+
+
+def set_status(cur, day, sources, status, rows=None, seconds=None, error=None):
+    """
+    Record the status of a partition; the caller commits.
+
+    """
+    params = dict(day = day, source = ', '.join(sources)[:512], status = status, rows = rows,
+                  seconds = None if seconds is None else round(seconds, 3),
+                  error = None if error is None else error[:1024],
+                  updated = datetime.datetime.now(datetime.timezone.utc).replace(tzinfo = None))
+    cur.execute("LOCK etl_backfill")
+    cur.execute(partition_status_delete, params)
+    cur.execute(partition_status_insert, params)
+
+
+def load_partition(cur, conn, config, day, sources, copy_set=None):
+    """
+    Load one day partition and replace the day in the analytics tables.
+
+    The files of the day (and of the day before) are copied into a temp
+    table of the session, and the song plays of the day are joined from it
+    into another, so that partitions load and transform in parallel. Only
+    then, in one transaction under a lock on the shared tables, the day is
+    replaced in songplays, time, users and the aggregates, and the partition
+    is marked done. A failed partition leaves nothing behind.
+
+    Parameters:
+        cur (cursor object) : for executing PostgreSQL command in a db session
+        conn (db session object) : connection to a database session
+        config (config file object) : access to the configuration settings
+        day (datetime.date) : the partition
+        sources (list) : S3 URL or local path prefixes of the files holding
+                         events of the day
+        copy_set (str) : COPY option set for the S3 load, or None for [COPY]
+
+    Returns:
+        rows (int) : number of song plays of the day
+
+    """
+    start = time.time()
+    next_day = day + datetime.timedelta(days = 1)
+    start_ts = calendar.timegm(day.timetuple()) * 1000
+    end_ts = calendar.timegm(next_day.timetuple()) * 1000
+    target = get_target(config)
+    stage = 'backfill'
+
+    set_status(cur, day, sources, 'running')
+    conn.commit()
+
+    metrics.execute(cur, partition_events_drop, stage, day.isoformat())
+    metrics.execute(cur, partition_events_create, stage, day.isoformat())
+
+    for source in sources:
+        if config.get('ETL', 'STAGING_SOURCE', fallback = 's3') == 'local':
+            count = local_ingest.load_staging_events(
+                        cur, conn, source, config['LOCAL'].get('LOG_JSONPATH'),
+                        config.getint('LOCAL', 'BATCH_ROWS', fallback = local_ingest.BATCH_ROWS),
+                        table = 'staging_events_day', commit = False)
+            metrics.record(stage, day.isoformat(), time.time() - start, count)
+        else:
+            metrics.execute(cur, partition_copy_query(config, source, copy_set),
+                            stage, day.isoformat())
+
+    for query in partition_transform_queries(start_ts, end_ts):
+        metrics.execute(cur, target_query(query, target), stage, day.isoformat())
+
+    # the lock is held from here to the commit: the replace of the day only
+    cur.execute(partition_lock)
+
+    rows = None
+    queries = [target_query(query, target) for query in partition_queries(day, next_day)]
+    for query in queries:
+        count = metrics.execute(cur, query, stage, day.isoformat())
+        if query is queries[1]:
+            rows = count
+
+    set_status(cur, day, sources, 'done', rows, time.time() - start)
+    metrics.execute(cur, partition_songplays_drop, stage, day.isoformat())
+    metrics.execute(cur, partition_events_drop, stage, day.isoformat())
+    conn.commit()
+
+    return rows
+
+
+def run_partition(db_pool, config, day, sources, copy_set=None):
+    """
+    Run one partition on a connection borrowed from the pool; a failed
+    partition is logged and marked failed, and does not stop the others.
+
+    Returns:
+        (day, status, rows, seconds) : 'done' or 'failed', song plays, wall time
+
+    """
+    logger.info('backfill partition [ {} ]...'.format(day))
+    start = time.time()
+
+    try:
+        rows = db_pool.run(lambda conn: load_partition(conn.cursor(), conn, config,
+                                                       day, sources, copy_set))
+
+    except (psycopg2.Error, OSError, ValueError) as e:
+        seconds = time.time() - start
+        error = str(e)
+        logger.info('Error: Backfill partition [ {} ]'.format(day))
+        print(e)
+
+        def mark_failed(conn):
+            set_status(conn.cursor(), day, sources, 'failed', None, seconds, error)
+            conn.commit()
+
+        try:
+            db_pool.run(mark_failed)
+        except psycopg2.Error as e:
+            logger.info('Error: Recording status of partition [ {} ]'.format(day))
+            print(e)
+        return day, 'failed', None, seconds
+
+    seconds = time.time() - start
+    logger.info('backfill partition [ {} ] :  {} song plays in {:.2f} sec'
+                .format(day, rows, seconds))
+    return day, 'done', rows, seconds
+
+
+def run_backfill(db_pool, config, partitions, workers=WORKERS, copy_set=None):
+    """
+    Backfill the partitions concurrently, at most *workers* at a time.
+
+    Parameters:
+        db_pool (db.Pool) : pool of db sessions shared by the workers
+        config (config file object) : access to the configuration settings
+        partitions (dict) : {day: [source, ...]} of the partitions to run
+        workers (int) : maximum number of concurrent partitions
+        copy_set (str) : COPY option set for the S3 loads
+
+    Returns:
+        results (dict) : {day: (status, rows, seconds)}
+
+    """
+    workers = max(1, min(int(workers), len(partitions)))
+    logger.info('Backfill {} partitions ({} workers)...'.format(len(partitions), workers))
+
+    results = {}
+    start = time.time()
+
+    with ThreadPoolExecutor(max_workers = workers) as executor:
+        futures = [executor.submit(run_partition, db_pool, config, day, sources, copy_set)
+                   for day, sources in sorted(partitions.items())]
+
+        for future in as_completed(futures):
+            day, status, rows, seconds = future.result()
+            results[day] = (status, rows, seconds)
+
+    failed = sorted(day for day, result in results.items() if result[0] == 'failed')
+    logger.info('backfill :  {} partitions done, {} failed in {:.2f} sec'
+                .format(len(results) - len(failed), len(failed), time.time() - start))
+    if failed:
+        logger.info('backfill :  failed partitions {}'
+                    .format(', '.join(day.isoformat() for day in failed)))
+
+    return results
+
+
+def load_songs(cur, conn, config, copy_set=None):
+    """
+    Reload staging_songs, which every partition joins its events with.
+
+    """
+    logger.info('load staging table [ staging_songs ]...')
+    cur.execute("TRUNCATE staging_songs")
+    conn.commit()
+
+    if config.get('ETL', 'STAGING_SOURCE', fallback = 's3') == 'local':
+        local_ingest.load_staging_songs(cur, conn, config['LOCAL']['SONG_DATA'],
+                                        config.getint('LOCAL', 'BATCH_ROWS',
+                                                      fallback = local_ingest.BATCH_ROWS))
+    else:
+        metrics.execute(cur, copy_query(config, 'staging_songs', copy_set), 'backfill', 'staging_songs')
+        conn.commit()
+
+
+def select_partitions(partitions, status, start=None, end=None, days=None,
+                      failed=False, force=False):
+    """
+    Select the partitions to run: those in [start, end) or in *days*; only
+    the failed ones with *failed*; partitions already done are skipped
+    unless *force* is set.
+
+    """
+    selected = {}
+    for day, sources in partitions.items():
+        state = status.get(day, (None,))[0]
+        if start and day < start or end and day >= end:
+            continue
+        if days and day not in days:
+            continue
+        if failed and state != 'failed':
+            continue
+        if state == 'done' and not force:
+            continue
+        selected[day] = sources
+    return selected
+
+
+def print_status(status):
+    """
+    Print the status of every partition recorded so far.
+
+    """
+    print('{:<12} {:<8} {:>10} {:>10}  {}'.format('day', 'status', 'rows', 'seconds', 'updated'))
+    for day, (state, rows, seconds, error, updated) in sorted(status.items()):
+        print('{:<12} {:<8} {:>10} {:>10}  {}'.format(day.isoformat(), state,
+                                                      '' if rows is None else rows,
+                                                      '' if seconds is None else
+                                                      '{:.2f}'.format(seconds),
+                                                      updated))
+        if error:
+            print('    ' + error.splitlines()[0])
+
+
+def main():
+    """
+    Backfill the log data partitions selected on the command line.
+
+    """
+    parser = argparse.ArgumentParser(description = 'Backfill Sparkify log data by day')
+    parser.add_argument('--start', type = parse_day, help = 'first day, e.g. 2018-11-01')
+    parser.add_argument('--end', type = parse_day, help = 'day after the last day')
+    parser.add_argument('--days', type = lambda value: {parse_day(day) for day in value.split(',')},
+                        help = 'comma separated days, e.g. 2018-11-05,2018-11-09')
+    parser.add_argument('--failed', action = 'store_true', help = 're-run the failed partitions')
+    parser.add_argument('--force', action = 'store_true', help = 're-run partitions already done')
+    parser.add_argument('--workers', type = int)
+    parser.add_argument('--load-songs', action = 'store_true',
+                        help = 'reload staging_songs before the backfill')
+    parser.add_argument('--status', action = 'store_true', help = 'print the partition status')
+    args = parser.parse_args()
+    mylib.setup_logger()
+
+    logger.info('---[ Backfill ]---')
+    mylib.log_timestamp()
+    metrics.start_run('backfill')
+
+    config = configparser.ConfigParser()
+    config.read('dwh.cfg')
+
+    workers = args.workers or config.getint('BACKFILL', 'WORKERS', fallback = WORKERS)
+    copy_set = config.get('ETL', 'COPY_OPTIONS', fallback = '') or None
+
+    if config.get('ETL', 'STAGING_SOURCE', fallback = 's3') == 'local':
+        try:
+            local_ingest.check_target(config)
+        except ValueError as e:
+            logger.info('Error :  {}'.format(e))
+            print(e)
+            return
+
+    try:
+        conn = db.connect(config)
+        cur = conn.cursor()
+        logger.info('DB connection :  open')
+
+    except Exception as e:
+        logger.info("Error :  Could not make connection to the sparkify DB")
+        print(e)
+        return
+
+    try:
+        status = read_status(cur, conn)
+        if args.status:
+            print_status(status)
+            return
+
+        s3 = None
+        if config.get('ETL', 'STAGING_SOURCE', fallback = 's3') != 'local':
+            s3 = cluster.get_clients(config)['s3']
+        partitions = list_partitions(config, s3)
+        selected = select_partitions(partitions, status, args.start, args.end, args.days,
+                                     args.failed, args.force)
+        logger.info('backfill :  {} partitions found, {} selected'
+                    .format(len(partitions), len(selected)))
+        if not selected:
+            print('No partitions to backfill')
+            return
+
+        if args.load_songs:
+            load_songs(cur, conn, config, copy_set)
+
+        db_pool = db.Pool(config, maxconn = max(1, min(workers, len(selected))))
+        try:
+            results = run_backfill(db_pool, config, selected, workers, copy_set)
+        finally:
+            db_pool.closeall()
+
+        for day, (state, rows, seconds) in sorted(results.items()):
+            print('{}  {:<8} {:>10} {:10.2f} sec'.format(day.isoformat(), state,
+                                                        '' if rows is None else rows, seconds))
+
+    finally:
+        conn.close()
+        logger.info('DB connection :  closed')
+        metrics.write_summary()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,200 @@
+import argparse
+import configparser
+import json
+import os
+import time
+import mylib
+import db
+from mylib import logger
+import etl
+import local_ingest
+import generate_data
+import metrics
+import autoscale
+import manage_redshift_cluster as cluster
+from sql_queries import copy_options_section, copy_query
+
+# ---------------------------------------------------------------------------------
+# End-to-end ETL benchmark: generate synthetic data at several scales, load
+# it with local_ingest.py and time the ETL stages against a Postgres database
+# ([ETL] target = postgres, tables from create_tables.py).
+#
+# With --copy-sets, time the S3 staging COPY instead, once per COPY option
+# set ([COPY] as 'default', and each [COPY:<name>] section)
+# ---------------------------------------------------------------------------------
+
+
+TABLES = ['staging_events', 'staging_songs', 'songplays', 'users', 'songs',
+          'artists', 'time']
+
+
+def truncate_tables(cur, conn):
+    """
+    Empty the staging and analytics tables before a benchmark run.
+
+    """
+    for table in TABLES:
+        cur.execute("TRUNCATE TABLE {}".format(table))
+    conn.commit()
+
+
+def time_stage(results, scale, stage, function, *args):
+    """
+    Run one ETL stage and append its timing to the results.
+
+    """
+    start = time.time()
+    function(*args)
+    seconds = time.time() - start
+
+    results.append({'scale': scale, 'stage': stage, 'seconds': round(seconds, 3)})
+    logger.info('benchmark [ {:g}x ] stage [ {} ] :  {:.2f} sec'.format(scale, stage, seconds))
+    print('{:>6g}x  {:<20} {:8.2f} sec'.format(scale, stage, seconds))
+
+
+def run_scale(cur, conn, config, scale, data_dir, match_rate):
+    """
+    Generate the dataset for one scale and time each stage of the ETL.
+
+    Returns:
+        results (list) : one record per stage
+
+    """
+    scale_dir = os.path.join(data_dir, 'bench-{:g}x'.format(scale))
+    results = []
+
+    start = time.time()
+    counts = generate_data.generate(scale_dir, scale, match_rate)
+    results.append({'scale': scale, 'stage': 'generate_data',
+                    'seconds': round(time.time() - start, 3),
+                    'songs': counts['songs'], 'events': counts['events']})
+
+    config['LOCAL']['LOG_DATA']     = os.path.join(scale_dir, 'log_data')
+    config['LOCAL']['LOG_JSONPATH'] = os.path.join(scale_dir, 'log_json_path.json')
+    config['LOCAL']['SONG_DATA']    = os.path.join(scale_dir, 'song_data')
+
+    truncate_tables(cur, conn)
+
+    time_stage(results, scale, 'load_staging_tables',
+               local_ingest.load_local_staging_tables, cur, conn, config)
+    time_stage(results, scale, 'insert_tables', etl.insert_tables, cur, conn)
+    time_stage(results, scale, 'count_table_rows', etl.count_table_rows, cur, conn)
+
+    return results
+
+
+def copy_set_names(config):
+    """
+    Return the COPY option sets in the config: 'default' for [COPY], and the
+    <name> of each [COPY:<name>] section.
+
+    """
+    return ['default'] + [section.split(':', 1)[1] for section in config.sections()
+                          if section.startswith('COPY:')]
+
+
+def run_copy_set(cur, conn, config, name, s3):
+    """
+    Time the staging COPY of each table with one option set, together with
+    the size of its S3 input.
+
+    Returns:
+        results (list) : one record per staging table
+
+    """
+    copy_set = None if name == 'default' else name
+    settings = copy_options_section(config, copy_set)
+    sources = {'staging_events': settings.get('log_data') or config['S3']['LOG_DATA'],
+               'staging_songs' : settings.get('song_data') or config['S3']['SONG_DATA']}
+
+    truncate_tables(cur, conn)
+    results = []
+
+    for table in sources:
+        query = copy_query(config, table, copy_set)
+        input_bytes, objects = autoscale.s3_prefix_bytes(s3, sources[table])
+
+        start = time.time()
+        metrics.execute(cur, query, 'load_staging_tables', table)
+        conn.commit()
+        seconds = time.time() - start
+
+        results.append({'copy_set': name, 'stage': 'load_staging_tables', 'table': table,
+                        'seconds': round(seconds, 3), 'input_bytes': input_bytes,
+                        'objects': objects})
+        logger.info('benchmark [ {} ] table [ {} ] :  {:.2f} sec, {:.1f} MB'
+                    .format(name, table, seconds, input_bytes / 1024 / 1024))
+        print('{:<12} {:<16} {:8.2f} sec {:10.1f} MB'
+              .format(name, table, seconds, input_bytes / 1024 / 1024))
+
+    return results
+
+
+def main():
+    """
+    Benchmark the ETL at each scale and write the results as JSON.
+
+    """
+    parser = argparse.ArgumentParser(description = 'Benchmark the Sparkify ETL')
+    parser.add_argument('--scales', default = '1,10,100',
+                        help = 'comma separated multiples of the sample data')
+    parser.add_argument('--match-rate', type = float, default = generate_data.MATCH_RATE)
+    parser.add_argument('--data', default = './data', help = 'directory for the datasets')
+    parser.add_argument('--out', default = './bench', help = 'directory for the results')
+    parser.add_argument('--copy-sets', nargs = '?', const = 'all',
+                        help = 'time the S3 staging COPY per option set, '
+                               'e.g. default,repeat (all sets when no list is given)')
+    args = parser.parse_args()
+    mylib.setup_logger()
+
+    logger.info('---[ Benchmark ]---')
+    mylib.log_timestamp()
+    metrics.start_run('benchmark')
+
+    config = configparser.ConfigParser()
+    config.read('dwh.cfg')
+
+    # the scale runs stage local files, which only a Postgres target accepts
+    if not args.copy_sets:
+        try:
+            local_ingest.check_target(config)
+        except ValueError as e:
+            logger.info('Error :  {}'.format(e))
+            print(e)
+            return
+
+    try:
+        conn = db.connect(config)
+        cur = conn.cursor()
+        logger.info('DB connection :  open')
+
+    except Exception as e:
+        logger.info("Error :  Could not make connection to the sparkify DB")
+        print(e)
+        return
+
+    results = []
+    if args.copy_sets:
+        names = copy_set_names(config) if args.copy_sets == 'all' else args.copy_sets.split(',')
+        s3 = cluster.get_clients(config)['s3']
+        for name in names:
+            results += run_copy_set(cur, conn, config, name, s3)
+    else:
+        for scale in args.scales.split(','):
+            results += run_scale(cur, conn, config, float(scale), args.data, args.match_rate)
+
+    conn.close()
+    logger.info('DB connection :  closed')
+
+    metrics.write_summary()
+
+    os.makedirs(args.out, exist_ok = True)
+    outfile = os.path.join(args.out, 'benchmark-{}.json'.format(time.strftime('%Y%m%d-%H%M%S')))
+    with open(outfile, 'w') as f:
+        json.dump({'match_rate': args.match_rate, 'results': results}, f, indent = 2)
+
+    print('Results :  ' + outfile)
+
+
+if __name__ == "__main__":
+    main()
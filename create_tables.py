@@ -1,9 +1,11 @@
 import configparser
 import psycopg2
-from sql_queries import create_table_queries, drop_table_queries
+from sql_queries import stage_queries
 import time
-import re
 import mylib
+import db
+import metrics
+import schema_profiler
 from mylib import logger
 
 
@@ -11,8 +13,9 @@ def drop_tables(cur, conn):
     """
     Drop all tables from the sparkify database.
     
-    Execute each query from the *drop_table_queries* list; each query
-    deletes a specific table from the Sparkify database.
+    Execute each query of the 'drop_tables' stage; each query deletes a
+    specific table from the Sparkify database.
+    (registry defined in sql_queries.py)
 
     Parameters:
         cur (cursor object) : for executing PostgreSQL command in a db session
@@ -24,31 +27,33 @@ def drop_tables(cur, conn):
     """
     logger.info('Drop existing tables...')
 
-    for query in drop_table_queries:
-        # the table name is the 5th word in the query string
-        table = re.findall(r'\w+', query)[4]
+    for query in stage_queries('drop_tables'):
+        table = query.table
         logger.info('delete table [ {} ]'.format(table))
 
         try:
-            cur.execute(query)
+            metrics.execute(cur, query.sql, query.stage, table)
             conn.commit()
         except psycopg2.Error as e: 
             logger.info('Error :  Dropping table [ {} ]'.format(table))
             print(e)
-            print(query)
+            print(query.sql)
 
 
-def create_tables(cur, conn):
+def create_tables(cur, conn, queries=None):
     """
     Create the tables for a clean sparkify database.
     
-    Execute each query from the *create_table_queries* list; each query
-    creates a specific table in the Sparkify database.
-    (list defined in sql_queries.py)
+    Execute each query of the 'create_tables' stage; each query creates a
+    specific table in the Sparkify database.
+    (registry defined in sql_queries.py)
 
     Parameters:
         cur (cursor object) : for executing PostgreSQL command in a db session
         conn (db session object) : connection to a database session
+        queries (list) : CREATE TABLE queries (sql_queries.Query) to run
+                         instead, e.g. with the types and encodings of a
+                         schema profile
 
     Returns:
         none
@@ -56,18 +61,17 @@ def create_tables(cur, conn):
     """
     logger.info('Create tables...')
 
-    for query in create_table_queries:
-        # the table name is the 6th word in the query string
-        table = re.findall(r'\w+', query)[5]
+    for query in queries or stage_queries('create_tables'):
+        table = query.table
         logger.info('create table [ {} ]'.format(table))
 
         try:
-            cur.execute(query)
+            metrics.execute(cur, query.sql, query.stage, table)
             conn.commit()
         except psycopg2.Error as e: 
             logger.info('Error :  Creating table [ {} ]'.format(table))
             print(e)
-            print(query)
+            print(query.sql)
 
 
 def main():
@@ -78,9 +82,10 @@ def main():
     and acquire a cursor object to process SQL queries.
 
     """
-    
+    mylib.setup_logger()
     logger.info('---[ Create Tables ]---')
     mylib.log_timestamp()
+    metrics.start_run('create_tables')
     print("Logfile :  " + mylib.get_log_file_name())
 
     # read config parameters for database connection string
@@ -88,25 +93,34 @@ def main():
     config.read('dwh.cfg')
 
     try:
-        conn_string = "host={} dbname={} user={} password={} port={}"
-        conn_string = conn_string.format(*config['CLUSTER'].values())
-        conn = psycopg2.connect( conn_string )
+        conn = db.connect(config)
         cur = conn.cursor()
 
-        print(conn_string)
+        print(db.get_conn_string(config))
         logger.info('DB connection :  open')
 
     except Exception as e:
         logger.info("Error :  Could not make connection to the sparkify DB")
         print(e)
+        return
+
+    # tighter column types and encodings from the schema profiler, if any
+    queries = None
+    profile_file = config.get('SCHEMA', 'PROFILE_FILE', fallback = '')
+    if profile_file:
+        logger.info('schema profile :  {}'.format(profile_file))
+        queries = schema_profiler.apply_profile(stage_queries('create_tables'),
+                                                schema_profiler.load_profile(profile_file))
 
     # Drop (if exists) and create new tables for sparkify database
     drop_tables(cur, conn)
-    create_tables(cur, conn)
+    create_tables(cur, conn, queries)
 
     conn.close()
     logger.info('DB connection :  closed')
 
+    metrics.write_summary()
+
 
 if __name__ == "__main__":
     main()
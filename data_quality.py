@@ -0,0 +1,173 @@
+import json
+import os
+import time
+import psycopg2
+from mylib import logger
+import metrics
+import run_state
+from sql_queries import data_quality_query
+
+# ---------------------------------------------------------------------------------
+# Data quality stage: table counts, null counts, orphan keys, duplicate keys
+# and aggregate totals from a single batched query, compared with the stats
+# of the previous run
+# ---------------------------------------------------------------------------------
+
+
+STATS_FILE             = './logs/data_quality.json'
+MAX_ROW_CHANGE         = 0.5
+MAX_NULL_RATE_INCREASE = 0.05
+
+# tables reported in the order of the old count_table_rows() output
+TABLES = ['staging_events', 'staging_songs', 'songplays', 'users', 'songs',
+          'artists', 'time']
+
+
+def collect_stats(cur, conn):
+    """
+    Run the batched data quality query.
+
+    Parameters:
+        cur (cursor object) : for executing PostgreSQL command in a db session
+        conn (db session object) : connection to a database session
+
+    Returns:
+        stats (dict) : {table: {check: value}}, e.g. stats['songplays']['rows']
+
+    """
+    metrics.execute(cur, data_quality_query, 'data_quality', 'all')
+    row = cur.fetchone()
+    names = [column[0] for column in cur.description]
+    conn.commit()
+
+    stats = {}
+    for name, value in zip(names, row):
+        table, check = name.split('__', 1)
+        stats.setdefault(table, {})[check] = int(value or 0)
+
+    return stats
+
+
+def null_rates(table_stats):
+    """
+    Return {check: rate} for the null counts of one table.
+
+    """
+    rows = table_stats.get('rows', 0)
+    return {check: (value / rows if rows else 0.0)
+            for check, value in table_stats.items() if check.startswith('null_')}
+
+
+def find_anomalies(stats, previous, max_row_change=MAX_ROW_CHANGE,
+                   max_null_rate_increase=MAX_NULL_RATE_INCREASE):
+    """
+    Flag data quality problems, and changes from the previous run's stats.
+
+    Parameters:
+        stats (dict) : stats of this run, from collect_stats()
+        previous (dict) : stats of the previous run, or None
+        max_row_change (float) : largest accepted relative change in rows
+        max_null_rate_increase (float) : largest accepted rise of a null rate
+
+    Returns:
+        anomalies (list) : one message per anomaly
+
+    """
+    anomalies = []
+
+    # every song play is counted once in each aggregate table
+    for check, value in stats.get('aggregates', {}).items():
+        if value != stats['songplays']['rows']:
+            anomalies.append('aggregates :  {} counts {} plays, songplays has {}'
+                             .format(check, value, stats['songplays']['rows']))
+
+    for table, table_stats in stats.items():
+        for check, value in table_stats.items():
+            if value and (check.startswith('orphan_') or check == 'duplicate_keys'):
+                anomalies.append('{} :  {} {}'.format(table, value, check))
+
+        if table_stats.get('rows') == 0:
+            anomalies.append('{} :  table is empty'.format(table))
+
+        if not previous or table not in previous:
+            continue
+        before = previous[table]
+
+        rows, rows_before = table_stats.get('rows', 0), before.get('rows', 0)
+        if rows_before and abs(rows - rows_before) / rows_before > max_row_change:
+            anomalies.append('{} :  rows changed from {} to {}'
+                             .format(table, rows_before, rows))
+
+        rates_before = null_rates(before)
+        for check, rate in null_rates(table_stats).items():
+            if rate - rates_before.get(check, 0.0) > max_null_rate_increase:
+                anomalies.append('{} :  {} rate rose from {:.1%} to {:.1%}'
+                                 .format(table, check, rates_before.get(check, 0.0), rate))
+
+    return anomalies
+
+
+def load_previous(stats_file):
+    """
+    Return the stats stored by the previous run, or None.
+
+    """
+    if not os.path.exists(stats_file):
+        return None
+
+    with open(stats_file) as f:
+        return json.load(f).get('stats')
+
+
+def save_stats(stats_file, stats, anomalies):
+    with open(stats_file, 'w') as f:
+        json.dump({'time'      : time.strftime('%Y-%m-%dT%H:%M:%S'),
+                   'stats'     : stats,
+                   'anomalies' : anomalies
+                  }, f, indent = 2)
+
+
+def check_data_quality(cur, conn, config):
+    """
+    Run the data quality stage: log the table counts and checks, compare
+    them with the previous run, and store this run's stats.
+
+    Parameters:
+        cur (cursor object) : for executing PostgreSQL command in a db session
+        conn (db session object) : connection to a database session
+        config (config file object) : access to the [DQ] settings
+
+    Returns:
+        anomalies (list) : one message per anomaly, or None on error (the
+                           stage is then marked failed in the run state)
+
+    """
+    logger.info('Check data quality...')
+
+    stats_file = config.get('DQ', 'STATS_FILE', fallback = STATS_FILE)
+    max_row_change = config.getfloat('DQ', 'MAX_ROW_CHANGE', fallback = MAX_ROW_CHANGE)
+    max_null_rate_increase = config.getfloat('DQ', 'MAX_NULL_RATE_INCREASE',
+                                             fallback = MAX_NULL_RATE_INCREASE)
+
+    try:
+        stats = collect_stats(cur, conn)
+
+    except psycopg2.Error as e:
+        conn.rollback()
+        run_state.mark_failed('data_quality', 'stats', e)
+        logger.info('Error :  Issue checking data quality')
+        print(e)
+        return None
+
+    for table in TABLES:
+        logger.info("table count [ {} ] :  {}".format(table, stats[table]['rows']))
+
+    anomalies = find_anomalies(stats, load_previous(stats_file),
+                               max_row_change, max_null_rate_increase)
+    for anomaly in anomalies:
+        logger.info('data quality :  {}'.format(anomaly))
+        print('Data quality :  {}'.format(anomaly))
+
+    save_stats(stats_file, stats, anomalies)
+
+    return anomalies
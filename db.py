@@ -0,0 +1,251 @@
+import random
+import threading
+import time
+import psycopg2
+from psycopg2 import pool
+from mylib import logger
+
+# ---------------------------------------------------------------------------------
+# Shared database connections: connection string, connect with retries and
+# exponential backoff on transient errors (cluster resume, leader failover),
+# and a thread-safe pool with health checks for the parallel ETL stages
+# ---------------------------------------------------------------------------------
+
+
+CONNECT_RETRIES = 5
+BACKOFF_BASE    = 1.0
+BACKOFF_MAX     = 30.0
+
+# SQLSTATE classes / codes of a lost or refused connection, worth retrying on
+# a fresh connection: connection exceptions, server shutting down or starting
+# up, too many connections. Query cancels (57014, statement_timeout), disk
+# full and out of memory (53xxx) are left to the caller.
+TRANSIENT_PGCODE_PREFIXES = ('08', '57P', '53300')
+
+
+def get_conn_string(config):
+    """
+    Build the connection string from the [CLUSTER] section of the config file.
+
+    Parameters:
+        config (config file object) : access to the cluster configuration settings
+
+    Returns:
+        conn_string (str) : libpq connection string
+
+    """
+    cluster = config['CLUSTER']
+    return "host={} dbname={} user={} password={} port={}".format(
+                cluster['HOST'], cluster['DB_NAME'], cluster['DB_USER'],
+                cluster['DB_PASSWORD'], cluster['DB_PORT'])
+
+
+def get_retry_settings(config):
+    """
+    Read the retry settings from the [DB] section of the config file.
+
+    Returns:
+        (retries, backoff_base, backoff_max)
+
+    """
+    return (config.getint('DB', 'CONNECT_RETRIES', fallback = CONNECT_RETRIES),
+            config.getfloat('DB', 'BACKOFF_BASE', fallback = BACKOFF_BASE),
+            config.getfloat('DB', 'BACKOFF_MAX', fallback = BACKOFF_MAX))
+
+
+def is_transient(error, conn=None):
+    """
+    Return True if a database error is a lost or refused connection, which
+    is likely to go away on a fresh connection.
+
+    Parameters:
+        error (psycopg2.Error) : the error
+        conn (db session object) : the connection it was raised on, if any;
+                                   a closed connection is lost
+
+    """
+    if isinstance(error, psycopg2.InterfaceError):
+        return True
+    if conn is not None and conn.closed:
+        return True
+
+    pgcode = getattr(error, 'pgcode', None) or ''
+    if pgcode:
+        return pgcode.startswith(TRANSIENT_PGCODE_PREFIXES)
+
+    # libpq reports a refused or dropped connection as a plain
+    # OperationalError without a SQLSTATE; server errors have their own class
+    return type(error) is psycopg2.OperationalError
+
+
+def backoff(attempt, base=BACKOFF_BASE, maximum=BACKOFF_MAX):
+    """
+    Return the delay before a retry: exponential, capped, with jitter.
+
+    """
+    delay = min(maximum, base * 2 ** attempt)
+    return delay / 2 + random.uniform(0, delay / 2)
+
+
+def connect(config, retries=None):
+    """
+    Open a connection to the sparkify DB, retrying transient failures with
+    exponential backoff.
+
+    Parameters:
+        config (config file object) : access to the cluster configuration settings
+        retries (int) : number of retries; defaults to [DB] CONNECT_RETRIES
+
+    Returns:
+        conn (db session object) : connection to a database session
+
+    Raises:
+        psycopg2.Error : the last error, when every attempt failed
+
+    """
+    conn_string = get_conn_string(config)
+    default_retries, base, maximum = get_retry_settings(config)
+    if retries is None:
+        retries = default_retries
+
+    for attempt in range(retries + 1):
+        try:
+            return psycopg2.connect(conn_string)
+
+        except psycopg2.Error as e:
+            if attempt >= retries or not is_transient(e):
+                raise
+            delay = backoff(attempt, base, maximum)
+            logger.info('DB connection :  attempt {} failed, retry in {:.1f} sec'
+                        .format(attempt + 1, delay))
+            time.sleep(delay)
+
+
+def is_healthy(conn):
+    """
+    Check that a connection is open and answers a trivial query.
+
+    """
+    if conn.closed:
+        return False
+
+    try:
+        cur = conn.cursor()
+        cur.execute("SELECT 1")
+        cur.fetchone()
+        cur.close()
+        conn.rollback()
+        return True
+
+    except psycopg2.Error:
+        return False
+
+
+class Pool:
+    """
+    Thread-safe pool of connections to the sparkify DB, shared by the
+    parallel ETL stages.
+
+    Connections are checked before they are handed out; broken ones are
+    discarded and replaced, and new connections are opened with retries.
+
+    """
+
+    def __init__(self, config, maxconn=8, minconn=1):
+        retries, base, maximum = get_retry_settings(config)
+        self.retries = retries
+        self.base    = base
+        self.maximum = maximum
+        self.pool    = pool.ThreadedConnectionPool(0, maxconn, get_conn_string(config))
+        self.slots   = threading.BoundedSemaphore(maxconn)
+
+        # warm up the pool
+        conns = [self.getconn() for i in range(min(minconn, maxconn))]
+        for conn in conns:
+            self.putconn(conn)
+
+    def getconn(self):
+        """
+        Borrow a healthy connection; blocks while all connections are in use.
+
+        """
+        self.slots.acquire()
+
+        try:
+            for attempt in range(self.retries + 1):
+                try:
+                    conn = self.pool.getconn()
+                except psycopg2.Error as e:
+                    if attempt >= self.retries or not is_transient(e):
+                        raise
+                    time.sleep(backoff(attempt, self.base, self.maximum))
+                    continue
+
+                if is_healthy(conn):
+                    return conn
+
+                logger.info('DB connection :  discard broken pooled connection')
+                self.pool.putconn(conn, close = True)
+
+            raise psycopg2.OperationalError('no healthy connection after {} attempts'
+                                            .format(self.retries + 1))
+        except Exception:
+            self.slots.release()
+            raise
+
+    def putconn(self, conn, close=False):
+        """
+        Return a borrowed connection; a closed one is dropped from the pool.
+
+        """
+        try:
+            self.pool.putconn(conn, close = close or bool(conn.closed))
+        finally:
+            self.slots.release()
+
+    def run(self, function, idempotent=True):
+        """
+        Run function(conn) on a pooled connection, retrying on a fresh
+        connection when the connection is lost (see is_transient). The
+        function must commit its own work, so a failed attempt leaves nothing
+        behind.
+
+        Parameters:
+            function : called with the connection
+            idempotent (bool) : the function may run twice; when False, a
+                                connection lost during the function is not
+                                retried, as the server may have committed
+                                its work (e.g. an INSERT or COPY)
+
+        Returns:
+            the return value of function
+
+        """
+        for attempt in range(self.retries + 1):
+            conn = self.getconn()
+            broken = False
+
+            try:
+                return function(conn)
+
+            except psycopg2.Error as e:
+                lost = is_transient(e, conn)
+                broken = lost
+                try:
+                    conn.rollback()
+                except psycopg2.Error:
+                    broken = True
+
+                if not lost or not idempotent or attempt >= self.retries:
+                    raise
+                delay = backoff(attempt, self.base, self.maximum)
+                logger.info('DB connection :  transient error, retry in {:.1f} sec'
+                            .format(delay))
+
+            finally:
+                self.putconn(conn, close = broken)
+
+            time.sleep(delay)
+
+    def closeall(self):
+        self.pool.closeall()
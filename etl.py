@@ -1,55 +1,239 @@
+import argparse
 import configparser
+import sys
 import psycopg2
-from sql_queries import copy_table_queries, insert_table_queries
+from sql_queries import stage_queries, query_graph, dimension_tables, get_target
 import pandas as pd
 import json
 import time
 import mylib
 from mylib import logger
-import re
-from sql_queries import count_table_queries
-
-
-def load_staging_tables(cur, conn):
+from sql_queries import staging_fingerprint_queries
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import db
+import scheduler
+import local_ingest
+import transform
+import metrics
+import run_state
+import data_quality
+import maintenance
+import result_cache
+import autoscale
+import shadow
+
+
+def load_staging_tables(cur, conn, queries=None):
     """
     Load raw data to staging tables for Sparkify DB.
     
-    Execute each query from the *copy_table_queries* list; each query
+    Execute each query of the 'load_staging_tables' stage; each query
     loads a specific staging table in the data warehouse.
-    (list defined in sql_queries.py)
+    (registry defined in sql_queries.py)
 
     Parameters:
         cur (cursor object) : for executing PostgreSQL command in a db session
         conn (db session object) : connection to a database session
+        queries (list) : COPY queries (sql_queries.Query) to run; defaults to
+                         the stage, rendered from dwh.cfg
 
     Returns:
         none
 
     """
     logger.info('Load staging tables...')
+
+    if queries is None:
+        queries = stage_queries('load_staging_tables')
         
-    for query in copy_table_queries:
-        # the table name is the 2nd word in the query string
-        table = re.findall(r'\w+', query)[1]
+    for query in queries:
+        table = query.table
+        if run_state.is_done('load_staging_tables', table):
+            logger.info('staging table [ {} ] :  loaded by an earlier attempt'.format(table))
+            continue
         logger.info('load staging table [ {} ]...'.format(table))
 
         try:
-            cur.execute(query)
+            rows = metrics.execute(cur, query.sql, query.stage, table)
             conn.commit()
+            run_state.mark_done('load_staging_tables', table, rows = rows,
+                                fingerprint = staging_fingerprint(cur, conn, table))
             
         except psycopg2.Error as e: 
+            conn.rollback()
+            run_state.mark_failed('load_staging_tables', table, e)
             logger.info('Error: Staging table [ {} ]'.format(table))
             print(e)
             print(query)
 
 
+def staging_fingerprint(cur, conn, table):
+    """
+    Return the fingerprint of a staging table (row count and key sums, see
+    *staging_fingerprint_queries*), recorded when the table is loaded and
+    checked before a resumed run skips the load.
+
+    Parameters:
+        cur (cursor object) : for executing PostgreSQL command in a db session
+        conn (db session object) : connection to a database session
+        table (str) : staging table
+
+    Returns:
+        fingerprint (list) : the values as strings
+
+    """
+    cur.execute(staging_fingerprint_queries[table])
+    fingerprint = [str(value) for value in cur.fetchone()]
+    conn.commit()
+    return fingerprint
+
+
+def validate_staging(cur, conn):
+    """
+    Check that the staging tables loaded by an earlier attempt still hold
+    what was loaded; when one does not, the run starts over from empty
+    staging tables.
+
+    Parameters:
+        cur (cursor object) : for executing PostgreSQL command in a db session
+        conn (db session object) : connection to a database session
+
+    Returns:
+        valid (bool) : False when the run was started over
+
+    """
+    for table in staging_fingerprint_queries:
+        done = run_state.get_item('load_staging_tables', table)
+        if done is None:
+            continue
+
+        fingerprint = staging_fingerprint(cur, conn, table)
+        if done.get('fingerprint') == fingerprint:
+            logger.info('staging table [ {} ] :  unchanged since it was loaded'.format(table))
+            continue
+
+        logger.info('staging table [ {} ] :  changed since it was loaded ({} -> {})'
+                    .format(table, done.get('fingerprint'), fingerprint))
+        run_state.reset('staging table [ {} ] changed'.format(table))
+        for table in staging_fingerprint_queries:
+            cur.execute("TRUNCATE {}".format(table))
+        conn.commit()
+        return False
+
+    return True
+
+
+def execute_pooled(db_pool, query, stage, table):
+    """
+    Execute and commit one query on a connection borrowed from the pool; a
+    lost connection is not retried, as the query may have committed.
+
+    Parameters:
+        db_pool (db.Pool) : pool of db sessions shared by the workers
+        query (str) : SQL statement
+        stage (str) : ETL stage the query belongs to (for the metrics)
+        table (str) : target table of the query
+
+    Returns:
+        none
+
+    """
+    def run(conn):
+        cur = conn.cursor()
+        metrics.execute(cur, query, stage, table)
+        conn.commit()
+
+    # a COPY or INSERT may have committed before the connection was lost
+    db_pool.run(run, idempotent = False)
+
+
+def load_staging_table(db_pool, query):
+    """
+    Load one staging table on its own connection borrowed from the pool.
+
+    Parameters:
+        db_pool (db.Pool) : pool of db sessions shared by the workers
+        query (Query) : COPY query for a single staging table
+
+    Returns:
+        (table, status, seconds) : table name, 'ok', 'failed' or 'skipped'
+                                   (loaded by an earlier attempt), wall time
+
+    """
+    table = query.table
+    if run_state.is_done('load_staging_tables', table):
+        logger.info('staging table [ {} ] :  loaded by an earlier attempt'.format(table))
+        return table, 'skipped', 0.0
+    logger.info('load staging table [ {} ]...'.format(table))
+
+    start = time.time()
+    status = 'ok'
+
+    try:
+        execute_pooled(db_pool, query.sql, query.stage, table)
+        fingerprint = db_pool.run(lambda conn: staging_fingerprint(conn.cursor(), conn, table))
+        run_state.mark_done('load_staging_tables', table, fingerprint = fingerprint)
+
+    except psycopg2.Error as e:
+        status = 'failed'
+        run_state.mark_failed('load_staging_tables', table, e)
+        logger.info('Error: Staging table [ {} ]'.format(table))
+        print(e)
+        print(query.sql)
+
+    return table, status, time.time() - start
+
+
+def load_staging_tables_parallel(db_pool, workers=2, queries=None):
+    """
+    Load the staging tables concurrently, one pooled connection per COPY.
+
+    The staging loads do not depend on each other, so each query from
+    'load_staging_tables' stage runs on its own connection; a failed load is
+    logged and the remaining loads keep going.
+
+    Parameters:
+        db_pool (db.Pool) : pool of db sessions shared by the workers
+        workers (int) : number of concurrent loads
+        queries (list) : COPY queries (sql_queries.Query) to run; defaults to
+                         the stage
+
+    Returns:
+        timings (dict) : {table: (status, seconds)} for every staging load
+
+    """
+    logger.info('Load staging tables (parallel, {} workers)...'.format(workers))
+
+    if queries is None:
+        queries = stage_queries('load_staging_tables')
+
+    workers = max(1, min(int(workers), len(queries)))
+    timings = {}
+    start = time.time()
+
+    with ThreadPoolExecutor(max_workers = workers) as executor:
+        futures = [executor.submit(load_staging_table, db_pool, query)
+                   for query in queries]
+
+        for future in as_completed(futures):
+            table, status, seconds = future.result()
+            timings[table] = (status, seconds)
+            logger.info('staging table [ {} ] :  {} in {:.2f} sec'
+                        .format(table, status, seconds))
+
+    logger.info('staging tables loaded in {:.2f} sec'.format(time.time() - start))
+
+    return timings
+
+
 def insert_tables(cur, conn):
     """
     Pull data from staging tables into final analytics tables.
     
-    Execute each query from the *insert_table_queries* list; each query
-    loads a specific analytics table in the data warehouse.
-    (list defined in sql_queries.py)
+    Execute each query of the 'insert_tables' stage; each query loads a
+    specific analytics table in the data warehouse.
+    (registry defined in sql_queries.py) The inserts stop at the first failure;
+    tables inserted by an earlier attempt of the run are skipped.
 
     Parameters:
         cur (cursor object) : for executing PostgreSQL command in a db session
@@ -61,28 +245,246 @@ def insert_tables(cur, conn):
     """
     logger.info('Load final tables...')
 
-    for query in insert_table_queries:
-        # the table name is the 3rd word in the query string
-        table = re.findall(r'\w+', query)[2]
+    for query in stage_queries('insert_tables'):
+        table = query.table
+        if run_state.is_done('insert_tables', table):
+            logger.info('table [ {} ] :  inserted by an earlier attempt'.format(table))
+            continue
         logger.info('insert to table [ {} ]'.format(table))
 
         try:
-            cur.execute(query)
+            rows = metrics.execute(cur, query.sql, query.stage, table)
             conn.commit()
+            run_state.mark_done('insert_tables', table, rows = rows)
 
         except psycopg2.Error as e: 
+            conn.rollback()
+            run_state.mark_failed('insert_tables', table, e)
             logger.info('Error: Inserting to table [ {} ]'.format(table))
             print(e)
-            print(query)
+            print(query.sql)
+            # later inserts may read from this table (time from songplays)
+            break
+
+
+def insert_tables_incremental(cur, conn):
+    """
+    Merge only the song plays newer than the stored watermark into songplays.
+
+    Execute the 'insert_tables_incremental' queries in a single transaction: new
+    events (staging_events.ts above the watermark) are staged in a temp
+    table, matching rows in songplays are deleted on the natural event key
+    and re-inserted, the time table gets the new start times, the aggregate
+    tables get the plays of the rows not seen before, and the watermark
+    moves forward. Re-running the load does not duplicate rows.
+    The dimension tables are then loaded as usual.
+
+    Parameters:
+        cur (cursor object) : for executing PostgreSQL command in a db session
+        conn (db session object) : connection to a database session
+
+    Returns:
+        rows (int) : number of song plays merged, or None on error
+
+    """
+    logger.info('Load final tables (incremental)...')
+    rows = None
+
+    if run_state.is_done('insert_tables', 'songplays'):
+        logger.info('merge to table [ songplays ] :  done by an earlier attempt')
+    else:
+        try:
+            for query in stage_queries('insert_tables_incremental'):
+                count = metrics.execute(cur, query.sql, 'insert_tables', query.table)
+                if query.name == 'songplay_merge_insert':
+                    rows = count
+            conn.commit()
+            run_state.mark_done('insert_tables', 'songplays', rows = rows)
+            logger.info('merge to table [ songplays ] :  {} rows'.format(rows))
+
+        except psycopg2.Error as e:
+            conn.rollback()
+            rows = None
+            run_state.mark_failed('insert_tables', 'songplays', e)
+            logger.info('Error: Merging to table [ songplays ]')
+            print(e)
+            print(query.sql)
+
+    for query in stage_queries('insert_tables'):
+        table = query.table
+        if table not in dimension_tables:
+            continue
+        if run_state.is_done('insert_tables', table):
+            logger.info('table [ {} ] :  inserted by an earlier attempt'.format(table))
+            continue
+        logger.info('insert to table [ {} ]'.format(table))
+
+        try:
+            count = metrics.execute(cur, query.sql, query.stage, table)
+            conn.commit()
+            run_state.mark_done('insert_tables', table, rows = count)
+
+        except psycopg2.Error as e:
+            conn.rollback()
+            run_state.mark_failed('insert_tables', table, e)
+            logger.info('Error: Inserting to table [ {} ]'.format(table))
+            print(e)
+            print(query.sql)
+
+    return rows
+
+
+def rebuild_aggregates(cur, conn):
+    """
+    Rebuild the aggregate tables from songplays after a full load.
+
+    Execute the 'aggregates' queries in a single transaction, so the
+    analytics queries never see a half-built aggregate. (After an
+    incremental load the aggregates are updated as part of the merge.)
+
+    Parameters:
+        cur (cursor object) : for executing PostgreSQL command in a db session
+        conn (db session object) : connection to a database session
+
+    Returns:
+        none
+
+    """
+    logger.info('Rebuild aggregate tables...')
+
+    try:
+        for query in stage_queries('aggregates'):
+            metrics.execute(cur, query.sql, query.stage, query.table)
+        conn.commit()
+
+    except psycopg2.Error as e:
+        conn.rollback()
+        run_state.mark_failed('aggregates', query.table, e)
+        logger.info('Error: Rebuilding aggregate table [ {} ]'.format(query.table))
+        print(e)
+        print(query.sql)
+
+
+def check_load_mode(config):
+    """
+    Check that at most one load mode of the final tables is set.
+
+    Raises:
+        ValueError : [ETL] incremental and shadow_load are both true; the
+                     shadow load is a full rebuild, the incremental load a merge
+
+    """
+    if config.getboolean('ETL', 'INCREMENTAL', fallback = False) and \
+       config.getboolean('ETL', 'SHADOW_LOAD', fallback = False):
+        raise ValueError('[ETL] incremental and shadow_load are both true;  '
+                         'set only one of them')
+
+
+def insert_tables_shadow(cur, conn, config):
+    """
+    Build the analytics and aggregate tables into shadow copies and swap
+    them in with one transaction, so readers never see a partial load
+    (see shadow.py); the replaced tables are kept for the [SHADOW]
+    retention period.
+
+    Parameters:
+        cur (cursor object) : for executing PostgreSQL command in a db session
+        conn (db session object) : connection to a database session
+        config (config file object) : access to the configuration settings
+
+    Returns:
+        stamp (str) : version stamp of the replaced tables, or None on error
+
+    """
+    stamp = shadow.load_shadow(cur, conn, config)
+    if stamp is None:
+        run_state.mark_failed('insert_tables', 'shadow', 'shadow load failed')
+    return stamp
+
+
+def insert_table(db_pool, table, query):
+    """
+    Insert into one analytics table on its own connection borrowed from the pool.
+
+    Parameters:
+        db_pool (db.Pool) : pool of db sessions shared by the workers
+        table (str) : name of the analytics table
+        query (Query) : INSERT query for the table
+
+    Returns:
+        status (str) : 'ok' or 'failed'
+
+    """
+    logger.info('insert to table [ {} ]'.format(table))
+
+    try:
+        execute_pooled(db_pool, query.sql, query.stage, table)
+        run_state.mark_done('insert_tables', table)
+
+    except psycopg2.Error as e:
+        run_state.mark_failed('insert_tables', table, e)
+        logger.info('Error: Inserting to table [ {} ]'.format(table))
+        print(e)
+        print(query.sql)
+        return 'failed'
+
+    return 'ok'
+
+
+def insert_tables_parallel(db_pool, workers=4, graph=None):
+    """
+    Pull data from staging tables into the analytics tables, following the
+    insert dependency graph.
+
+    Each insert of the 'insert_tables' stage starts on its own pooled connection
+    as soon as the tables it reads from are loaded, so independent inserts
+    run at the same time. The per-table durations and the critical path are
+    printed when the graph is done.
+
+    Parameters:
+        db_pool (db.Pool) : pool of db sessions shared by the workers
+        workers (int) : maximum number of concurrent inserts
+        graph (dict) : {table: (query, [dependencies])}; defaults to the
+                       graph of the stage (sql_queries.query_graph), from
+                       the tables each query reads
+
+    Returns:
+        results (dict) : {table: (status, seconds)} for every insert
+
+    """
+    logger.info('Load final tables (parallel, {} workers)...'.format(workers))
+
+    if graph is None:
+        graph = query_graph('insert_tables')
+
+    # tables inserted by an earlier attempt of the run are done
+    done = [table for table in graph if run_state.is_done('insert_tables', table)]
+    if done:
+        logger.info('tables {} :  inserted by an earlier attempt'.format(done))
+    graph = {table: (query, [dep for dep in deps if dep not in done])
+             for table, (query, deps) in graph.items() if table not in done}
+    if not graph:
+        return {}
+
+    workers = max(1, min(int(workers), len(graph)))
+    start = time.time()
+
+    results = scheduler.run_graph(graph,
+                                  lambda table, query: insert_table(db_pool, table, query),
+                                  workers)
+
+    scheduler.report(graph, results, time.time() - start)
+
+    return results
 
 
 def count_table_rows(cur, conn):
     """
     Count the rows in analytics tables.
     
-    Execute each query from the *count_table_queries* list; each query
-    counts a specific analytics table in the data warehouse.
-    (list defined in sql_queries.py)
+    Execute each query of the 'count_table_rows' stage; each query counts
+    a specific analytics table in the data warehouse.
+    (registry defined in sql_queries.py)
 
     Parameters:
         cur (cursor object) : for executing PostgreSQL command in a db session
@@ -94,12 +496,11 @@ def count_table_rows(cur, conn):
     """
     logger.info('Check table counts...')
 
-    for query in count_table_queries:
-        # the table name is the last word in the query string
-        table = re.findall(r'\w+', query)[-1]
+    for query in stage_queries('count_table_rows'):
+        table = query.table
             
         try:
-            cur.execute(query)
+            metrics.execute(cur, query.sql, query.stage, table)
             conn.commit()
 
             # the query returns the row count
@@ -110,7 +511,7 @@ def count_table_rows(cur, conn):
         except psycopg2.Error as e: 
             logger.info('Error :  Issue counting table [ {} ]'.format(table))
             print(e)
-            print(query)
+            print(query.sql)
 
 
 def disable_result_cache(cur, conn):
@@ -155,18 +556,111 @@ def log_config_params(config):
     logger.info('SONG_DATA:  {}'.format(SONG_DATA))
 
 
+def run_autoscale(step, config, *args):
+    """
+    Run an autoscale step; a failed resize is logged and the ETL goes on
+    with the cluster as it is.
+
+    Returns:
+        the result of the step, or None on error
+
+    """
+    try:
+        return step(config, *args)
+
+    # any failure of a resize (API, waiter, unexpected response) leaves the
+    # cluster as it is rather than stopping the ETL
+    except Exception as e:
+        logger.info('Error :  autoscale [ {} ]'.format(step.__name__))
+        print(e)
+        return None
+
+
+def load_local_staging(cur, conn, config):
+    """
+    Load the staging tables from the local directories in the [LOCAL]
+    section, except those loaded by an earlier attempt of the run.
+
+    Parameters:
+        cur (cursor object) : for executing PostgreSQL command in a db session
+        conn (db session object) : connection to a database session
+        config (config file object) : access to the configuration settings
+
+    Returns:
+        none
+
+    """
+    done = [table for table in staging_fingerprint_queries
+            if run_state.is_done('load_staging_tables', table)]
+    for table in done:
+        logger.info('staging table [ {} ] :  loaded by an earlier attempt'.format(table))
+
+    timings = local_ingest.load_local_staging_tables(cur, conn, config, skip = done)
+
+    for table in staging_fingerprint_queries:
+        if table in done:
+            continue
+        if table in timings:
+            run_state.mark_done('load_staging_tables', table, rows = timings[table][0],
+                                fingerprint = staging_fingerprint(cur, conn, table))
+        else:
+            run_state.mark_failed('load_staging_tables', table, 'local load failed')
+
+
+def run_stage(stage, function, *args):
+    """
+    Run one ETL stage, unless an earlier attempt of the run completed it,
+    and record it in the run state when none of its queries failed.
+
+    Parameters:
+        stage (str) : name of the stage in the run state
+        function : the stage, called with *args
+
+    Returns:
+        ok (bool) : False when a query of the stage failed
+
+    """
+    if run_state.is_done(stage):
+        logger.info('stage [ {} ] :  done by an earlier attempt'.format(stage))
+        return True
+
+    function(*args)
+
+    failed = run_state.failed(stage)
+    if failed:
+        logger.info('Error: stage [ {} ] failed on {}'.format(stage, failed))
+        return False
+
+    run_state.mark_done(stage)
+    return True
+
+
 def main():
     """
     Build ETL Pipeline for Sparkify song play data.
     
     Instantiate a session to the Postgres database on the Redshift cluster, 
     and acquire a cursor object to process SQL queries.
+
+    The run stops at the first stage that fails; every completed stage and
+    query is kept in the run state file, and a run started with --resume
+    continues from there.
+
+    Returns:
+        status (int) : 0, or 1 when a stage failed
     
     """
+    parser = argparse.ArgumentParser(description = 'Run the Sparkify ETL')
+    parser.add_argument('--resume', action = 'store_true',
+                        help = 'continue an unfinished run, skipping the work it completed')
+    args = parser.parse_args()
+    mylib.setup_logger()
         
     logger.info('---[ Begin ETL ]---')
     mylib.log_timestamp()
+    run_id = metrics.start_run('etl')
     print("Logfile:  " + mylib.get_log_file_name())
+    print("Metrics:  " + metrics.get_metrics_file_name())
 
     # read config parameters for database connection string
     config = configparser.ConfigParser()
@@ -174,34 +668,141 @@ def main():
 
     log_config_params(config)
 
+    # COPY option set ([ETL] copy_options): [COPY], or [COPY:<name>] on top of it
+    staging_queries = [query.render(config) for query in stage_queries('load_staging_tables')]
+    local_staging = config.get('ETL', 'STAGING_SOURCE', fallback = 's3') == 'local'
+    target = get_target(config)
+
+    # COPY ... FROM STDIN (local staging, pandas engine) only works on a Postgres target,
+    # and the final tables are loaded one way only
+    pandas_engine = config.get('ETL', 'TRANSFORM_ENGINE', fallback = 'sql') == 'pandas'
     try:
-        conn_string = "host={} dbname={} user={} password={} port={}"
-        conn_string = conn_string.format(*config['CLUSTER'].values())
-        conn = psycopg2.connect( conn_string )
+        check_load_mode(config)
+        if local_staging:
+            local_ingest.check_target(config)
+        if pandas_engine:
+            local_ingest.check_target(config, 'transform_engine = pandas')
+    except ValueError as e:
+        logger.info('Error :  {}'.format(e))
+        print(e)
+        return 1
+
+    inputs = run_state.inputs_digest([config['LOCAL']['LOG_DATA'], config['LOCAL']['SONG_DATA']]
+                                     if local_staging else
+                                     [query.sql for query in staging_queries])
+    resumed = run_state.start(config, run_id, inputs, args.resume)
+    print("Run state:  " + run_state.get_state_file_name(config))
+
+    # size the cluster for the input before any session is opened
+    nodes_before = None
+    if config.getboolean('AUTOSCALE', 'ENABLED', fallback = False):
+        nodes_before = run_autoscale(autoscale.scale_for_load, config)
+
+    try:
+        conn = db.connect(config)
         cur = conn.cursor()
 
-        print(conn_string)
+        print(db.get_conn_string(config))
         logger.info('DB connection :  open')
 
     except Exception as e:
         logger.info("Error :  Could not make connection to the sparkify DB")
         print(e)
+        run_autoscale(autoscale.scale_back, config, nodes_before)
+        run_state.finish('failed')
+        return 1
+
+    if target == 'redshift':
+        disable_result_cache(cur, conn)
+
+    # one pool of warm connections, shared by the parallel stages
+    parallel_staging = config.getboolean('ETL', 'PARALLEL_STAGING', fallback = False)
+    parallel_inserts = config.getboolean('ETL', 'PARALLEL_INSERTS', fallback = False)
+    staging_workers  = config.getint('ETL', 'STAGING_WORKERS', fallback = 2)
+    insert_workers   = config.getint('ETL', 'INSERT_WORKERS', fallback = 4)
+    db_pool = None
+
+    if parallel_staging or parallel_inserts:
+        db_pool = db.Pool(config, maxconn = max(staging_workers, insert_workers))
 
-    disable_result_cache(cur, conn)
+    # the staging tables of the resumed run must still hold what it loaded
+    if resumed:
+        validate_staging(cur, conn)
 
     # Load Staging tables and Final analytics tables
     print("Load Staging tables...")
-    load_staging_tables(cur, conn)
+    if local_staging:
+        ok = run_stage('load_staging_tables', load_local_staging, cur, conn, config)
+    elif parallel_staging:
+        ok = run_stage('load_staging_tables', load_staging_tables_parallel,
+                       db_pool, staging_workers, staging_queries)
+    else:
+        ok = run_stage('load_staging_tables', load_staging_tables,
+                       cur, conn, staging_queries)
+
+    if ok:
+        print("Insert into Final tables...")
+        if pandas_engine:
+            ok = run_stage('insert_tables', transform.insert_tables_pandas, cur, conn) and \
+                 run_stage('aggregates', rebuild_aggregates, cur, conn)
+        elif config.getboolean('ETL', 'INCREMENTAL', fallback = False):
+            ok = run_stage('insert_tables', insert_tables_incremental, cur, conn)
+        elif config.getboolean('ETL', 'SHADOW_LOAD', fallback = False):
+            # the aggregates are built into their shadow copies too
+            ok = run_stage('insert_tables', insert_tables_shadow, cur, conn, config)
+        elif parallel_inserts:
+            ok = run_stage('insert_tables', insert_tables_parallel, db_pool, insert_workers) and \
+                 run_stage('aggregates', rebuild_aggregates, cur, conn)
+        else:
+            ok = run_stage('insert_tables', insert_tables, cur, conn) and \
+                 run_stage('aggregates', rebuild_aggregates, cur, conn)
+
+    if db_pool is not None:
+        db_pool.closeall()
+
+    # the load is done: back to the size before it, ahead of the maintenance
+    # and the data quality check; a resize ends the sessions, so the session
+    # is opened again afterwards
+    if nodes_before is not None:
+        conn.close()
+        run_autoscale(autoscale.scale_back, config, nodes_before)
+        try:
+            conn = db.connect(config)
+            cur = conn.cursor()
+            if target == 'redshift':
+                disable_result_cache(cur, conn)
+        except Exception as e:
+            logger.info("Error :  Could not make connection to the sparkify DB")
+            print(e)
+            conn = None
+            ok = False
 
-    print("Insert into Final tables...")
-    insert_tables(cur, conn)
+    if ok and config.getboolean('MAINTENANCE', 'ENABLED', fallback = False):
+        print('Table maintenance...')
+        run_stage('maintenance', maintenance.run_maintenance, conn, config)
 
-    print('Check table counts...')
-    count_table_rows(cur, conn)
+    if ok:
+        print('Check data quality...')
+        ok = run_stage('data_quality', data_quality.check_data_quality, cur, conn, config)
 
-    conn.close()
+    if conn is not None:
+        conn.close()
     logger.info('DB connection :  closed')
 
+    # a new load invalidates the cached analytics results
+    result_cache.stamp_load_version(config)
+
+    summary = metrics.write_summary()
+    logger.info('ETL run [ {} ] :  {} sec'.format(summary['run_id'], summary['seconds']))
+
+    if not ok:
+        run_state.finish('failed')
+        print("ETL stopped on a failed stage;  run 'python etl.py --resume' to continue")
+        return 1
+
+    run_state.finish()
+    return 0
+
 
 if __name__ == "__main__":
-    main()
+    sys.exit(main())
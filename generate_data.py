@@ -0,0 +1,247 @@
+import argparse
+import json
+import os
+import random
+import string
+import time
+
+# ---------------------------------------------------------------------------------
+# Generate a synthetic Sparkify dataset, laid out like the S3 song_data and
+# log_data prefixes, at a multiple of the size of the sample data
+# ---------------------------------------------------------------------------------
+
+
+# size of the sample dataset (see the table counts in README.md)
+SAMPLE_EVENTS  = 8056
+SAMPLE_SONGS   = 14896
+SAMPLE_ARTISTS = 10025
+SAMPLE_USERS   = 104
+
+# share of the song plays in the sample data that match a song (333 / 6820)
+MATCH_RATE     = 0.05
+NEXT_SONG_RATE = 0.82
+
+OTHER_PAGES = ['Home', 'Logout', 'Login', 'Settings', 'Help', 'About',
+               'Upgrade', 'Downgrade', 'Save Settings']
+
+LOG_JSONPATHS = ['artist', 'auth', 'firstName', 'gender', 'itemInSession',
+                 'lastName', 'length', 'level', 'location', 'method', 'page',
+                 'registration', 'sessionId', 'song', 'status', 'ts',
+                 'userAgent', 'userId']
+
+LOCATIONS  = ['Harrisburg-Carlisle, PA', 'San Jose-Sunnyvale-Santa Clara, CA',
+              'Atlanta-Sandy Springs-Roswell, GA', 'Chicago-Naperville-Elgin, IL-IN-WI',
+              'Lansing-East Lansing, MI', 'New York-Newark-Jersey City, NY-NJ-PA']
+USER_AGENTS = ['"Mozilla/5.0 (Macintosh; Intel Mac OS X 10_9_4) AppleWebKit/537.36 '
+               '(KHTML, like Gecko) Chrome/36.0.1985.125 Safari/537.36"',
+               'Mozilla/5.0 (Windows NT 6.1; WOW64; rv:31.0) Gecko/20100101 Firefox/31.0',
+               '"Mozilla/5.0 (iPhone; CPU iPhone OS 7_1_2 like Mac OS X) AppleWebKit/537.51.2 '
+               '(KHTML, like Gecko) Version/7.0 Mobile/11D257 Safari/9537.53"']
+WORDS = ['love', 'night', 'blue', 'heart', 'river', 'fire', 'dream', 'road',
+         'star', 'rain', 'home', 'gold', 'dance', 'summer', 'light', 'shadow']
+
+
+def random_id(rnd, prefix):
+    """
+    Return an 18 character id like the dataset's song, artist and track ids.
+
+    """
+    return prefix + ''.join(rnd.choices(string.ascii_uppercase + string.digits, k = 16))
+
+
+def random_title(rnd):
+    return ' '.join(rnd.choice(WORDS).title() for i in range(rnd.randint(1, 4)))
+
+
+def make_songs(rnd, scale):
+    """
+    Build the song and artist metadata at the given scale.
+
+    Returns:
+        songs (list) : records shaped like the song_data JSON files
+
+    """
+    artists = []
+    for i in range(max(1, int(SAMPLE_ARTISTS * scale))):
+        located = rnd.random() < 0.4
+        artists.append({'artist_id'        : random_id(rnd, 'AR'),
+                        'artist_name'      : '{} {}'.format(random_title(rnd), i),
+                        'artist_location'  : rnd.choice(LOCATIONS) if located else '',
+                        'artist_latitude'  : round(rnd.uniform(25, 48), 5) if located else None,
+                        'artist_longitude' : round(rnd.uniform(-122, -70), 5) if located else None
+                       })
+
+    songs = []
+    for i in range(max(1, int(SAMPLE_SONGS * scale))):
+        artist = rnd.choice(artists)
+        song = {'num_songs' : 1}
+        song.update(artist)
+        song.update({'song_id'  : random_id(rnd, 'SO'),
+                     'title'    : '{} {}'.format(random_title(rnd), i),
+                     'duration' : round(rnd.uniform(60, 600), 5),
+                     'year'     : rnd.choice([0, rnd.randint(1960, 2010)])
+                    })
+        songs.append(song)
+
+    return songs
+
+
+def write_songs(songs, song_dir, songs_per_file=1):
+    """
+    Write the songs under song_dir, in subdirectories named by the 3rd to
+    5th letters of the track id (song_data/A/B/C/TRABC...json).
+
+    """
+    rnd = random.Random(len(songs))
+    for i in range(0, len(songs), songs_per_file):
+        track = random_id(rnd, 'TR')
+        path = os.path.join(song_dir, track[2], track[3], track[4])
+        os.makedirs(path, exist_ok = True)
+
+        with open(os.path.join(path, track + '.json'), 'w') as f:
+            for song in songs[i:i + songs_per_file]:
+                f.write(json.dumps(song) + '\n')
+
+
+def write_events(rnd, songs, log_dir, scale, match_rate, year=2018, month=11, days=30):
+    """
+    Write the user activity logs under log_dir, one file per day
+    (log_data/2018/11/2018-11-12-events.json); each day is written as it is
+    generated, so memory does not grow with the scale.
+
+    Returns:
+        count (int) : number of events written
+
+    """
+    users = []
+    for i in range(max(1, int(SAMPLE_USERS * scale))):
+        users.append({'userId'       : str(i + 1),
+                      'firstName'    : rnd.choice(WORDS).title(),
+                      'lastName'     : rnd.choice(WORDS).title() + 's',
+                      'gender'       : rnd.choice('MF'),
+                      'level'        : rnd.choice(['free', 'paid']),
+                      'location'     : rnd.choice(LOCATIONS),
+                      'userAgent'    : rnd.choice(USER_AGENTS),
+                      'registration' : float(rnd.randint(1535000000000, 1541000000000))
+                     })
+
+    path = os.path.join(log_dir, str(year), '{:02d}'.format(month))
+    os.makedirs(path, exist_ok = True)
+
+    per_day = max(1, int(SAMPLE_EVENTS * scale) // days)
+    session_id = 0
+    count = 0
+
+    for day in range(1, days + 1):
+        day_start = int(time.mktime((year, month, day, 0, 0, 0, 0, 0, -1)) * 1000)
+        filename = '{}-{:02d}-{:02d}-events.json'.format(year, month, day)
+
+        with open(os.path.join(path, filename), 'w') as f:
+            written = 0
+            while written < per_day:
+                user = rnd.choice(users)
+                session_id += 1
+                ts = day_start + rnd.randint(0, 86000000)
+
+                # occasionally a user changes level between sessions
+                if rnd.random() < 0.02:
+                    user['level'] = 'paid' if user['level'] == 'free' else 'free'
+
+                for item in range(min(rnd.randint(1, 20), per_day - written)):
+                    event = make_event(rnd, user, songs, session_id, item, ts, match_rate)
+                    f.write(json.dumps(event) + '\n')
+                    ts += rnd.randint(1000, 400000)
+                    written += 1
+
+        count += written
+
+    return count
+
+
+def make_event(rnd, user, songs, session_id, item, ts, match_rate):
+    """
+    Build one log record; a NextSong event matches a known song with
+    probability match_rate.
+
+    """
+    next_song = rnd.random() < NEXT_SONG_RATE
+    artist = song = length = None
+
+    if next_song:
+        if rnd.random() < match_rate:
+            match  = rnd.choice(songs)
+            artist = match['artist_name']
+            song   = match['title']
+            length = match['duration']
+        else:
+            artist = random_title(rnd)
+            song   = random_title(rnd)
+            length = round(rnd.uniform(60, 600), 5)
+
+    event = {'artist'        : artist,
+             'auth'          : 'Logged In',
+             'itemInSession' : item,
+             'length'        : length,
+             'method'        : 'PUT' if next_song else 'GET',
+             'page'          : 'NextSong' if next_song else rnd.choice(OTHER_PAGES),
+             'sessionId'     : session_id,
+             'song'          : song,
+             'status'        : 200,
+             'ts'            : ts
+            }
+    for key in ['firstName', 'gender', 'lastName', 'level', 'location',
+                'registration', 'userAgent', 'userId']:
+        event[key] = user[key]
+
+    return event
+
+
+def generate(out_dir, scale=1.0, match_rate=MATCH_RATE, seed=0, songs_per_file=1):
+    """
+    Generate a synthetic dataset under out_dir: song_data/, log_data/ and
+    log_json_path.json.
+
+    Parameters:
+        out_dir (str) : output directory
+        scale (float) : size relative to the sample data (1, 10, 100, ...)
+        match_rate (float) : share of NextSong events that match a song
+        seed (int) : random seed, so a scale is reproducible
+        songs_per_file (int) : songs written per song_data file
+
+    Returns:
+        counts (dict) : {'songs': n, 'events': n}
+
+    """
+    rnd = random.Random(seed)
+
+    songs = make_songs(rnd, scale)
+    write_songs(songs, os.path.join(out_dir, 'song_data'), songs_per_file)
+    events = write_events(rnd, songs, os.path.join(out_dir, 'log_data'),
+                          scale, match_rate)
+
+    with open(os.path.join(out_dir, 'log_json_path.json'), 'w') as f:
+        json.dump({'jsonpaths': ["$['{}']".format(key) for key in LOG_JSONPATHS]},
+                  f, indent = 4)
+
+    return {'songs': len(songs), 'events': events}
+
+
+def main():
+    parser = argparse.ArgumentParser(description = 'Generate a synthetic Sparkify dataset')
+    parser.add_argument('--out', default = './data', help = 'output directory')
+    parser.add_argument('--scale', type = float, default = 1.0,
+                        help = 'size relative to the sample data, e.g. 1, 10, 100')
+    parser.add_argument('--match-rate', type = float, default = MATCH_RATE,
+                        help = 'share of song plays that match a song')
+    parser.add_argument('--seed', type = int, default = 0)
+    parser.add_argument('--songs-per-file', type = int, default = 1)
+    args = parser.parse_args()
+
+    counts = generate(args.out, args.scale, args.match_rate, args.seed,
+                      args.songs_per_file)
+    print('{songs} songs, {events} events written to {out}'
+          .format(out = args.out, **counts))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,350 @@
+import configparser
+import psycopg2
+import io
+import glob
+import os
+import re
+import json
+import time
+import mylib
+import db
+import metrics
+from mylib import logger
+from sql_queries import get_target
+
+# ---------------------------------------------------------------------------------
+# Load the staging tables from a local copy of the S3 datasets, using
+# COPY ... FROM STDIN, into a Postgres database used in dev and CI
+# ([ETL] target = postgres). Redshift does not accept COPY ... FROM STDIN;
+# it loads from S3 only.
+# ---------------------------------------------------------------------------------
+
+
+# staging table columns, in table order (event_key is an IDENTITY column)
+STAGING_EVENTS_COLUMNS = ['artist', 'auth', 'firstName', 'gender', 'itemInSession',
+                          'lastName', 'length', 'level', 'location', 'method',
+                          'page', 'registration', 'sessionId', 'song', 'status',
+                          'ts', 'userAgent', 'userId']
+
+STAGING_SONGS_COLUMNS  = ['song_id', 'artist_id', 'artist_latitude',
+                          'artist_longitude', 'artist_location', 'artist_name',
+                          'title', 'duration', 'year']
+
+BATCH_ROWS = 10000
+
+
+def check_target(config, use='local staging'):
+    """
+    Check that the target database takes COPY ... FROM STDIN, for a local
+    load or the pandas engine.
+
+    Raises:
+        ValueError : the target is Redshift, which only loads from S3
+
+    """
+    if get_target(config) != 'postgres':
+        raise ValueError('{} needs [ETL] target = postgres;  Redshift has no '
+                         'COPY ... FROM STDIN, stage the files in S3 instead'.format(use))
+
+
+def read_jsonpaths(path):
+    """
+    Read a JSONPaths file (the LOG_JSONPATH format used by COPY ... JSON).
+
+    Parameters:
+        path (str) : pathname of a file like {"jsonpaths": ["$['artist']", ...]}
+
+    Returns:
+        keys (list) : JSON key for each column of the staging table, in order
+
+    """
+    with open(path) as f:
+        jsonpaths = json.load(f)['jsonpaths']
+
+    keys = []
+    for jsonpath in jsonpaths:
+        match = re.match(r"^\$(?:\['([^']+)'\]|\.(\w+))$", jsonpath.strip())
+        if not match:
+            raise ValueError("unsupported JSONPath expression [ {} ]".format(jsonpath))
+        keys.append(match.group(1) or match.group(2))
+
+    return keys
+
+
+def iter_json_files(root):
+    """
+    Yield the pathnames of the JSON files under a directory, in sorted order;
+    like an S3 prefix, *root* may also be the start of the file names, e.g.
+    log_data/2018/11/2018-11-05 for the files of one day.
+
+    Parameters:
+        root (str) : top of a directory laid out like LOG_DATA or SONG_DATA,
+                     or a path prefix of files
+
+    """
+    if not os.path.isdir(root):
+        for path in sorted(glob.glob(glob.escape(root) + '*.json')):
+            yield path
+        return
+
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames.sort()
+        for filename in sorted(filenames):
+            if filename.endswith('.json'):
+                yield os.path.join(dirpath, filename)
+
+
+def iter_records(root):
+    """
+    Yield one JSON record at a time from every file under a directory;
+    the files hold one JSON object per line.
+
+    Parameters:
+        root (str) : top of a directory laid out like LOG_DATA or SONG_DATA
+
+    """
+    for path in iter_json_files(root):
+        with open(path) as f:
+            for line in f:
+                line = line.strip()
+                if line:
+                    yield json.loads(line)
+
+
+def json_auto_keys(record, columns):
+    """
+    Map staging table columns to record keys the way COPY ... JSON 'auto'
+    does: by name, ignoring case.
+
+    Parameters:
+        record (dict) : one JSON record
+        columns (list) : staging table columns
+
+    Returns:
+        keys (list) : JSON key for each column (None when it is missing)
+
+    """
+    lower = {key.lower(): key for key in record}
+    return [lower.get(column.lower()) for column in columns]
+
+
+def to_copy_text(value):
+    """
+    Format one value for COPY ... FROM STDIN (text format).
+
+    """
+    if value is None:
+        return '\\N'
+    if isinstance(value, bool):
+        return 'true' if value else 'false'
+    return str(value).replace('\\', '\\\\').replace('\t', '\\t') \
+                     .replace('\n', '\\n').replace('\r', '\\r')
+
+
+def copy_records(cur, conn, table, columns, rows, batch_rows=BATCH_ROWS, commit=True):
+    """
+    Stream rows into a table with COPY ... FROM STDIN, one bounded batch at
+    a time, so memory use does not grow with the size of the input.
+
+    Parameters:
+        cur (cursor object) : for executing PostgreSQL command in a db session
+        conn (db session object) : connection to a database session
+        table (str) : target table
+        columns (list) : target columns, in the order of each row
+        rows (iterable) : tuples of column values
+        batch_rows (int) : maximum number of rows buffered per COPY
+        commit (bool) : commit the load; False leaves it to the caller's transaction
+
+    Returns:
+        count (int) : number of rows copied
+
+    """
+    query = "COPY {} ({}) FROM STDIN".format(table, ', '.join(columns))
+    buffer = io.StringIO()
+    count = 0
+    pending = 0
+
+    for row in rows:
+        buffer.write('\t'.join(to_copy_text(value) for value in row))
+        buffer.write('\n')
+        pending += 1
+
+        if pending >= batch_rows:
+            buffer.seek(0)
+            cur.copy_expert(query, buffer)
+            count += pending
+            pending = 0
+            buffer = io.StringIO()
+
+    if pending:
+        buffer.seek(0)
+        cur.copy_expert(query, buffer)
+        count += pending
+
+    if commit:
+        conn.commit()
+    return count
+
+
+def load_staging_events(cur, conn, log_data, log_jsonpath, batch_rows=BATCH_ROWS,
+                        table='staging_events', commit=True):
+    """
+    Load the staging_events table from a local LOG_DATA directory, mapping
+    the JSON keys to the columns with the LOG_JSONPATH file.
+
+    Parameters:
+        cur (cursor object) : for executing PostgreSQL command in a db session
+        conn (db session object) : connection to a database session
+        log_data (str) : local directory laid out like LOG_DATA
+        log_jsonpath (str) : local copy of the LOG_JSONPATH file; when empty,
+                             the keys are matched to the columns by name
+        batch_rows (int) : maximum number of rows buffered per COPY
+        table (str) : target table with the staging_events columns
+        commit (bool) : commit the load; False leaves it to the caller's transaction
+
+    Returns:
+        count (int) : number of rows loaded
+
+    """
+    if log_jsonpath:
+        keys = read_jsonpaths(log_jsonpath)
+    else:
+        keys = STAGING_EVENTS_COLUMNS
+
+    if len(keys) != len(STAGING_EVENTS_COLUMNS):
+        raise ValueError("LOG_JSONPATH has {} paths, staging_events has {} columns"
+                         .format(len(keys), len(STAGING_EVENTS_COLUMNS)))
+
+    rows = (tuple(record.get(key) for key in keys)
+            for record in iter_records(log_data))
+
+    return copy_records(cur, conn, table, STAGING_EVENTS_COLUMNS,
+                        rows, batch_rows, commit)
+
+
+def load_staging_songs(cur, conn, song_data, batch_rows=BATCH_ROWS):
+    """
+    Load the staging_songs table from a local SONG_DATA directory, matching
+    the JSON keys to the columns by name (like COPY ... JSON 'auto').
+
+    Parameters:
+        cur (cursor object) : for executing PostgreSQL command in a db session
+        conn (db session object) : connection to a database session
+        song_data (str) : local directory laid out like SONG_DATA
+        batch_rows (int) : maximum number of rows buffered per COPY
+
+    Returns:
+        count (int) : number of rows loaded
+
+    """
+    def rows():
+        for record in iter_records(song_data):
+            keys = json_auto_keys(record, STAGING_SONGS_COLUMNS)
+            yield tuple(record[key] if key else None for key in keys)
+
+    return copy_records(cur, conn, 'staging_songs', STAGING_SONGS_COLUMNS,
+                        rows(), batch_rows)
+
+
+def load_local_staging_tables(cur, conn, config, skip=()):
+    """
+    Load both staging tables from the local directories in the [LOCAL]
+    section of the config file into a Postgres target, and log the
+    throughput of each load.
+
+    Parameters:
+        cur (cursor object) : for executing PostgreSQL command in a db session
+        conn (db session object) : connection to a database session
+        config (config file object) : access to the configuration settings
+        skip (list) : staging tables not to load, e.g. loaded by an earlier
+                      attempt of the run
+
+    Returns:
+        timings (dict) : {table: (rows, seconds)} for every table loaded
+
+    Raises:
+        ValueError : the target is not Postgres (check_target)
+
+    """
+    check_target(config)
+    logger.info('Load staging tables (local)...')
+
+    batch_rows = config.getint('LOCAL', 'BATCH_ROWS', fallback = BATCH_ROWS)
+    loads = [('staging_events',
+              lambda: load_staging_events(cur, conn,
+                                          config['LOCAL']['LOG_DATA'],
+                                          config['LOCAL'].get('LOG_JSONPATH'),
+                                          batch_rows)),
+             ('staging_songs',
+              lambda: load_staging_songs(cur, conn,
+                                         config['LOCAL']['SONG_DATA'],
+                                         batch_rows))
+            ]
+
+    timings = {}
+    for table, load in loads:
+        if table in skip:
+            continue
+        logger.info('load staging table [ {} ]...'.format(table))
+        start = time.time()
+
+        try:
+            rows = load()
+        except (psycopg2.Error, OSError, ValueError) as e:
+            conn.rollback()
+            metrics.record('load_staging_tables', table, time.time() - start,
+                           status = 'failed', error = str(e))
+            logger.info('Error: Staging table [ {} ]'.format(table))
+            print(e)
+            continue
+
+        seconds = time.time() - start
+        timings[table] = (rows, seconds)
+        metrics.record('load_staging_tables', table, seconds, rows)
+        logger.info('staging table [ {} ] :  {} rows in {:.2f} sec  ({:.0f} rows/sec)'
+                    .format(table, rows, seconds, rows / seconds if seconds else 0))
+
+    return timings
+
+
+def main():
+    """
+    Load the staging tables from the local dataset directories.
+
+    """
+    mylib.setup_logger()
+    logger.info('---[ Local Ingest ]---')
+    mylib.log_timestamp()
+    metrics.start_run('local_ingest')
+    print("Logfile:  " + mylib.get_log_file_name())
+
+    config = configparser.ConfigParser()
+    config.read('dwh.cfg')
+
+    try:
+        check_target(config)
+    except ValueError as e:
+        logger.info('Error :  {}'.format(e))
+        print(e)
+        return
+
+    try:
+        conn = db.connect(config)
+        cur = conn.cursor()
+        logger.info('DB connection :  open')
+
+    except Exception as e:
+        logger.info("Error :  Could not make connection to the sparkify DB")
+        print(e)
+        return
+
+    load_local_staging_tables(cur, conn, config)
+
+    conn.close()
+    logger.info('DB connection :  closed')
+
+    metrics.write_summary()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,148 @@
+import time
+import psycopg2
+from mylib import logger
+import metrics
+
+# ---------------------------------------------------------------------------------
+# Maintenance stage after the loads: VACUUM SORT ONLY / VACUUM DELETE ONLY /
+# ANALYZE PREDICATE COLUMNS, each only on the tables where the unsorted,
+# deleted or stale-statistics percentage is above its threshold
+# ---------------------------------------------------------------------------------
+
+
+table_health_query = ("""
+    SELECT  "table",
+            COALESCE(unsorted, 0)                       AS unsorted,
+            COALESCE(stats_off, 0)                      AS stats_off,
+            COALESCE(tbl_rows, 0)                       AS tbl_rows,
+            COALESCE(estimated_visible_rows, tbl_rows)  AS visible_rows,
+            COALESCE(size, 0)                           AS size_mb
+    FROM    svv_table_info
+    WHERE   schema = 'public';
+""")
+
+TABLES        = ['songplays', 'users', 'songs', 'artists', 'time',
+                 'song_plays_daily', 'user_plays_daily', 'session_songs']
+MAX_UNSORTED  = 10.0
+MAX_DELETED   = 10.0
+MAX_STATS_OFF = 10.0
+
+
+def read_table_health(cur):
+    """
+    Read the unsorted %, stats staleness %, deleted rows % and size per table.
+
+    Returns:
+        health (dict) : {table: {'unsorted', 'stats_off', 'deleted', 'rows', 'size_mb'}}
+
+    """
+    cur.execute(table_health_query)
+
+    health = {}
+    for table, unsorted, stats_off, rows, visible, size_mb in cur.fetchall():
+        rows, visible = int(rows), int(visible)
+        health[table] = {'unsorted'  : float(unsorted),
+                         'stats_off' : float(stats_off),
+                         'deleted'   : 100.0 * (rows - visible) / rows if rows else 0.0,
+                         'rows'      : rows,
+                         'size_mb'   : int(size_mb)
+                        }
+    return health
+
+
+def plan_maintenance(health, tables=TABLES, max_unsorted=MAX_UNSORTED,
+                     max_deleted=MAX_DELETED, max_stats_off=MAX_STATS_OFF):
+    """
+    Choose the maintenance operations for each table that needs them.
+
+    Returns:
+        plan (list) : (table, statement, reason) in the order to run them;
+                      a VACUUM comes before the ANALYZE of the same table
+
+    """
+    plan = []
+    for table in tables:
+        if table not in health:
+            continue
+        stats = health[table]
+
+        if stats['deleted'] > max_deleted:
+            plan.append((table, 'VACUUM DELETE ONLY {}'.format(table),
+                         '{:.1f}% deleted rows'.format(stats['deleted'])))
+        if stats['unsorted'] > max_unsorted:
+            plan.append((table, 'VACUUM SORT ONLY {}'.format(table),
+                         '{:.1f}% unsorted'.format(stats['unsorted'])))
+        if stats['stats_off'] > max_stats_off:
+            plan.append((table, 'ANALYZE {} PREDICATE COLUMNS'.format(table),
+                         '{:.1f}% stats off'.format(stats['stats_off'])))
+    return plan
+
+
+def run_maintenance(conn, config):
+    """
+    Run the maintenance stage; VACUUM cannot run inside a transaction, so
+    the session is switched to autocommit for the duration of the stage.
+
+    Parameters:
+        conn (db session object) : connection to a database session
+        config (config file object) : access to the [MAINTENANCE] settings
+
+    Returns:
+        done (list) : (table, statement, seconds, before, after) per operation
+
+    """
+    logger.info('Table maintenance...')
+
+    tables = [table.strip() for table in
+              config.get('MAINTENANCE', 'TABLES', fallback = ','.join(TABLES)).split(',')]
+    thresholds = dict(
+        max_unsorted  = config.getfloat('MAINTENANCE', 'MAX_UNSORTED', fallback = MAX_UNSORTED),
+        max_deleted   = config.getfloat('MAINTENANCE', 'MAX_DELETED', fallback = MAX_DELETED),
+        max_stats_off = config.getfloat('MAINTENANCE', 'MAX_STATS_OFF', fallback = MAX_STATS_OFF))
+
+    conn.commit()
+    autocommit = conn.autocommit
+    conn.autocommit = True
+    cur = conn.cursor()
+    done = []
+
+    try:
+        health = read_table_health(cur)
+        plan = plan_maintenance(health, tables, **thresholds)
+        if not plan:
+            logger.info('maintenance :  all tables within thresholds')
+
+        for table, statement, reason in plan:
+            logger.info('maintenance [ {} ] :  {}  ({})'.format(table, statement, reason))
+            before = health[table]
+            start = time.time()
+
+            try:
+                metrics.execute(cur, statement, 'maintenance', table)
+            except psycopg2.Error as e:
+                logger.info('Error :  maintenance [ {} ]'.format(table))
+                print(e)
+                print(statement)
+                continue
+
+            seconds = time.time() - start
+            health = read_table_health(cur)
+            after = health.get(table, before)
+            done.append((table, statement, seconds, before, after))
+
+            logger.info('maintenance [ {} ] :  {:.2f} sec,  unsorted {:.1f}% -> {:.1f}%,  '
+                        'deleted {:.1f}% -> {:.1f}%,  stats off {:.1f}% -> {:.1f}%,  '
+                        'size {} MB -> {} MB'
+                        .format(table, seconds, before['unsorted'], after['unsorted'],
+                                before['deleted'], after['deleted'],
+                                before['stats_off'], after['stats_off'],
+                                before['size_mb'], after['size_mb']))
+
+    except psycopg2.Error as e:
+        logger.info('Error :  reading table health')
+        print(e)
+
+    finally:
+        conn.autocommit = autocommit
+
+    return done
@@ -1,284 +1,557 @@
+import argparse
 import configparser
-import psycopg2
-import pandas as pd
-import boto3
 import json
+import os
 import time
+from concurrent.futures import ThreadPoolExecutor
+import boto3
+from botocore.exceptions import ClientError
+import psycopg2
+import mylib
+from mylib import logger
+import db
 
 # ---------------------------------------------------------------------------------
-# Mange the Redshift Cluster using the AWS python SDK 
+# Manage the Redshift Cluster using the AWS python SDK
+#
+#     python manage_redshift_cluster.py start     # running / resume / restore / create
+#     python manage_redshift_cluster.py stop      # pause, or delete with a final snapshot
+#     python manage_redshift_cluster.py status
+#     python manage_redshift_cluster.py delete    # cluster, then the IAM role
+#
+# The functions take the boto3 clients as arguments, so they run the same
+# against AWS and against moto (mock_aws); pass sleep = lambda seconds: None
+# to skip the waits there.
 # ---------------------------------------------------------------------------------
 
 
-def load_config():
+ASSUME_ROLE_POLICY = {'Statement' : [{'Action'    : 'sts:AssumeRole',
+                                      'Effect'    : 'Allow',
+                                      'Principal' : {'Service': 'redshift.amazonaws.com'}
+                                     }],
+                      'Version'   : '2012-10-17'
+                     }
+
+CLUSTER_PROPS = ['ClusterIdentifier', 'NodeType', 'ClusterStatus', 'MasterUsername',
+                 'DBName', 'Endpoint', 'NumberOfNodes', 'VpcId']
+
+# status polls start short and back off to POLL_MAX seconds, so readiness is
+# reported within seconds of the cluster becoming available
+POLL_MIN       = 5
+POLL_MAX       = 30
+POLL_FACTOR    = 1.5
+CREATE_TIMEOUT = 900
+DELETE_TIMEOUT = 900
+
+# [LIFECYCLE] defaults
+STOP_MODE      = 'pause'
+SNAPSHOTS_KEPT = 2
+HISTORY_FILE   = './logs/cluster-lifecycle.jsonl'
+
+
+def load_config(path='dwh.cfg'):
     """
     Load DWH Cluster and DB Params from config file
 
     """
-
     config = configparser.ConfigParser()
-    config.read_file(open('dwh.cfg'))
-
-    DWH_CLUSTER_TYPE       = config['DWH']['DWH_CLUSTER_TYPE']
-    DWH_NUM_NODES          = config['DWH']['DWH_NUM_NODES']
-    DWH_NODE_TYPE          = config['DWH']['DWH_NODE_TYPE']
-    DWH_CLUSTER_IDENTIFIER = config['DWH']['DWH_CLUSTER_IDENTIFIER']
-    DWH_REGION             = config['DWH']['DWH_REGION']
-
-    HOST                   = config['CLUSTER']['HOST']
-    DB_NAME                = config['CLUSTER']['DB_NAME']
-    DB_USER                = config['CLUSTER']['DB_USER']
-    DB_PASSWORD            = config['CLUSTER']['DB_PASSWORD']
-    DB_PORT                = config['CLUSTER']['DB_PORT']
-
-    IAM_ROLE_NAME          = config['IAM_ROLE']['IAM_ROLE_NAME']
-    IAM_POLICY_ARN         = config['IAM_ROLE']['IAM_POLICY_ARN']
-    ARN                    = config['IAM_ROLE']['ARN']
-
-    return DWH_CLUSTER_TYPE, DWH_NUM_NODES, DWH_NODE_TYPE, \
-           DWH_CLUSTER_IDENTIFIER, DWH_REGION, \
-           HOST, DB_NAME, DB_USER, DB_PASSWORD, DB_PORT, \
-           IAM_ROLE_NAME, IAM_POLICY_ARN, ARN
-
-
-DWH_CLUSTER_TYPE, DWH_NUM_NODES, DWH_NODE_TYPE, \
-DWH_CLUSTER_IDENTIFIER, DWH_REGION, \
-HOST, DB_NAME, DB_USER, DB_PASSWORD, DB_PORT, \
-IAM_ROLE_NAME, IAM_POLICY_ARN, ARN  \
-    = load_config()
-
-
-def print_config():
-    """
-    """
-    db_config = pd.DataFrame({"Param":
-                    ["DWH_CLUSTER_TYPE", "DWH_NUM_NODES", "DWH_NODE_TYPE",
-                    "DWH_CLUSTER_IDENTIFIER", "DWH_REGION",
-                    "HOST", "DB_NAME", "DB_USER", "DB_PASSWORD", "DB_PORT",
-                    "IAM_ROLE_NAME", "IAM_POLICY_ARN", "ARN"
-                    ],
-                "Value":
-                    [DWH_CLUSTER_TYPE, DWH_NUM_NODES, DWH_NODE_TYPE, 
-                    DWH_CLUSTER_IDENTIFIER, DWH_REGION,
-                    HOST, DB_NAME, DB_USER, DB_PASSWORD, DB_PORT, 
-                    IAM_ROLE_NAME, IAM_POLICY_ARN, ARN
-                    ]
-                })
-    print(db_config)
-
-
-#------------------------------------------------------------------------------
-# Load AWS Params from separate config file
-
-config_aws = configparser.ConfigParser()
-config_aws.read_file(open('aws.cfg'))
-
-AWS_KEY     = config_aws['AWS']['KEY']
-AWS_SECRET  = config_aws['AWS']['SECRET']
-
-
-# Create clients for IAM and Redshift
-
-iam = boto3.client('iam',
-                    region_name           = DWH_REGION,
-                    aws_access_key_id     = AWS_KEY,
-                    aws_secret_access_key = AWS_SECRET
-                   )
-
-redshift = boto3.client('redshift',
-                         region_name           = DWH_REGION,
-                         aws_access_key_id     = AWS_KEY,
-                         aws_secret_access_key = AWS_SECRET
-                       )
-
-
-#------------------------------------------------------------------------------
-# Create an IAM Role that makes Redshift able to access S3 bucket (ReadOnly)
-
-try:
-    print('1.1 Creating a new IAM Role')
-    dwhRole = iam.create_role(
-        Path                     = '/',
-        RoleName                 = IAM_ROLE_NAME,
-        Description              = "Allows Redshift clusters to call AWS services on your behalf.",
-        AssumeRolePolicyDocument = json.dumps(
-            {'Statement' : [{'Action'    : 'sts:AssumeRole',
-                             'Effect'    : 'Allow',
-                             'Principal' : {'Service': 'redshift.amazonaws.com'}
-                            }],
-             'Version'   : '2012-10-17'
-            }
-        )
-    )
-except Exception as e:
-    print(e)
+    config.read_file(open(path))
+    return config
 
 
-print('1.2 Attaching Policy')
-iam.attach_role_policy(RoleName = IAM_ROLE_NAME,
-                       PolicyArn = "arn:aws:iam::aws:policy/AmazonS3ReadOnlyAccess"
-                      )['ResponseMetadata']['HTTPStatusCode']
+def log_config(config):
+    """
+    Write the cluster, DB and IAM role parameters to the logfile.
 
+    """
+    for section in ['DWH', 'CLUSTER', 'IAM_ROLE']:
+        for key, value in config[section].items():
+            logger.info('{}:  {}'.format(key.upper(), value))
 
-print('1.3 Get the IAM role ARN')
-roleArn = iam.get_role(RoleName = IAM_ROLE_NAME)['Role']['Arn']
-
-print(roleArn)
 
+def get_clients(config, aws_file='aws.cfg', session=None):
+    """
+    Create the IAM, Redshift and S3 clients and the EC2 resource.
 
-#------------------------------------------------------------------------------
-# Create a RedShift Cluster
+    The keys come from *aws_file* when it exists, otherwise from the default
+    credential chain (environment, profile, instance role, or moto).
 
-try:
-    response = redshift.create_cluster(        
-        # parameters for hardware
-        ClusterType        = DWH_CLUSTER_TYPE,
-        NodeType           = DWH_NODE_TYPE,
-        NumberOfNodes      = int(DWH_NUM_NODES),
-        
-        # parameters for identifiers & credentials
-        DBName             = DB_NAME,
-        ClusterIdentifier  = DWH_CLUSTER_IDENTIFIER,
-        MasterUsername     = DB_USER,
-        MasterUserPassword = DB_PASSWORD,
+    Returns:
+        clients (dict) : {'iam', 'redshift', 's3', 'ec2'}
 
-        #  parameter for role (to allow s3 access)
-        IamRoles           = [roleArn]
-    )
-except Exception as e:
-    print(e)
+    """
+    if session is None:
+        keys = {}
+        if os.path.exists(aws_file):
+            config_aws = configparser.ConfigParser()
+            config_aws.read(aws_file)
+            keys = dict(aws_access_key_id     = config_aws['AWS']['KEY'],
+                        aws_secret_access_key = config_aws['AWS']['SECRET'])
+        session = boto3.session.Session(region_name = config['DWH']['DWH_REGION'], **keys)
+
+    return {'iam'      : session.client('iam'),
+            'redshift' : session.client('redshift'),
+            's3'       : session.client('s3'),
+            'ec2'      : session.resource('ec2')
+           }
+
+
+def create_iam_role(iam, role_name):
+    """
+    Create an IAM Role that Redshift can assume; an existing role is reused.
 
+    Returns:
+        arn (str) : the role ARN
 
-#------------------------------------------------------------------------------
-# Describe the cluster to see its status
+    """
+    logger.info('Creating a new IAM Role')
+    try:
+        iam.create_role(Path                     = '/',
+                        RoleName                 = role_name,
+                        Description              = "Allows Redshift clusters to call "
+                                                   "AWS services on your behalf.",
+                        AssumeRolePolicyDocument = json.dumps(ASSUME_ROLE_POLICY))
+    except ClientError as e:
+        if e.response['Error']['Code'] != 'EntityAlreadyExists':
+            raise
+        logger.info('IAM Role exists:  {}'.format(role_name))
+
+    arn = iam.get_role(RoleName = role_name)['Role']['Arn']
+    logger.info('New IAM Role ARN:  {}'.format(arn))
+    return arn
+
+
+def attach_policy(iam, role_name, policy_arn):
+    """
+    Attach the policy that makes Redshift able to access S3 bucket (ReadOnly).
 
-def pretty_Redshift_props(props):
     """
+    iam.attach_role_policy(RoleName = role_name, PolicyArn = policy_arn)
+    logger.info('Attached policy:  {}'.format(policy_arn))
+
+
+def remove_iam_role(iam, role_name, policy_arn):
     """
-        
-    pd.set_option('display.max_colwidth', -1)
-    keysToShow = ["ClusterIdentifier", "NodeType", "ClusterStatus", "MasterUsername", 
-                  "DBName", "Endpoint", "NumberOfNodes", 'VpcId']
-    x = [(k, v) for k,v in props.items() if k in keysToShow]
-    return pd.DataFrame(data = x, columns = ["Key", "Value"])
+    Detach the policy from the IAM Role and delete the role.
 
+    """
+    try:
+        iam.detach_role_policy(RoleName = role_name, PolicyArn = policy_arn)
+        iam.delete_role(RoleName = role_name)
+        logger.info('Deleted IAM Role:  {}'.format(role_name))
+    except ClientError as e:
+        if e.response['Error']['Code'] != 'NoSuchEntity':
+            raise
+        logger.info('IAM Role not found:  {}'.format(role_name))
 
-myClusterProps = redshift.describe_clusters(ClusterIdentifier = DWH_CLUSTER_IDENTIFIER)['Clusters'][0]
-pretty_Redshift_props(myClusterProps)
 
-#------------------------------------------------------------------------------
-# WAIT until the cluster is running
+def create_cluster(redshift, config, role_arns=None):
+    """
+    Request a new Redshift cluster; an existing cluster is reused.
 
-bClusterAvailable = False
-nMinutes = 0
+    Returns:
+        props (dict) : the cluster description
 
-while True:
-    time.sleep(60)
-    nMinutes += 1
-    print("waiting {} minutes...".format(nMinutes))
+    """
+    dwh = config['DWH']
+    cluster = config['CLUSTER']
+    try:
+        props = redshift.create_cluster(
+            # parameters for hardware
+            ClusterType        = dwh['DWH_CLUSTER_TYPE'],
+            NodeType           = dwh['DWH_NODE_TYPE'],
+            NumberOfNodes      = int(dwh['DWH_NUM_NODES']),
+
+            # parameters for identifiers & credentials
+            DBName             = cluster['DB_NAME'],
+            ClusterIdentifier  = dwh['DWH_CLUSTER_IDENTIFIER'],
+            MasterUsername     = cluster['DB_USER'],
+            MasterUserPassword = cluster['DB_PASSWORD'],
+
+            #  parameter for role (to allow s3 access)
+            IamRoles           = role_arns or []
+        )['Cluster']
+        logger.info('Create cluster successful')
+    except ClientError as e:
+        if e.response['Error']['Code'] != 'ClusterAlreadyExists':
+            raise
+        logger.info('Cluster exists:  {}'.format(dwh['DWH_CLUSTER_IDENTIFIER']))
+        props = describe_cluster(redshift, dwh['DWH_CLUSTER_IDENTIFIER'])
+
+    log_cluster(props)
+    return props
+
+
+def describe_cluster(redshift, cluster_id):
+    """
+    Return the cluster description, or None when there is no such cluster.
 
-    # then check the status
-    myClusterProps = redshift.describe_clusters(ClusterIdentifier = DWH_CLUSTER_IDENTIFIER)['Clusters'][0]
-    
-    if  myClusterProps['ClusterStatus'] == 'available':
-        bClusterAvailable = True
-        break
-    
-    if nMinutes >= 7:
-        print("7 minute time limit reached")
-        break
-    
-# cluster should be available now, OR the 7 minute limit has passed
-pretty_Redshift_props(myClusterProps)
+    """
+    try:
+        return redshift.describe_clusters(ClusterIdentifier = cluster_id)['Clusters'][0]
+    except ClientError as e:
+        if e.response['Error']['Code'] == 'ClusterNotFound':
+            return None
+        raise
 
 
-#------------------------------------------------------------------------------
-# Write the cluster endpoint and role ARN to the config file
+def log_cluster(props):
+    """
+    Write the main cluster properties to the logfile.
 
-if bClusterAvailable:
-    HOST = myClusterProps['Endpoint']['Address']
-    ARN = myClusterProps['IamRoles'][0]['IamRoleArn']
-    print("HOST :: ", HOST)
-    print("ARN  :: ", ARN)
+    """
+    for key in CLUSTER_PROPS:
+        if key in props:
+            logger.info('{}:  {}'.format(key, props[key]))
 
-    config['CLUSTER']['HOST'] = HOST
-    config['IAM_ROLE']['ARN'] = "'{}'".format(ARN)
 
+def is_ready(props, status, nodes=None):
+    """
+    True when the cluster has *status* (None: it is gone), all its IAM roles
+    are applied and, when given, it has *nodes* nodes.
 
-#------------------------------------------------------------------------------
-# Open an incoming  TCP port to access the cluster endpoint
+    """
+    if status is None or props is None:
+        return props is None and status is None
+    if nodes is not None and props['NumberOfNodes'] != nodes:
+        return False
+    return (props['ClusterStatus'] == status and
+            all(role.get('ApplyStatus', 'in-sync') == 'in-sync'
+                for role in props.get('IamRoles', [])))
 
-try:
-    vpc = ec2.Vpc(id = myClusterProps['VpcId'])
-    defaultSg = list(vpc.security_groups.all())[0]
-    print(defaultSg)
-    
-    defaultSg.authorize_ingress(
-        GroupName  = defaultSg.group_name,  # TODO: fill out
-        CidrIp     = '0.0.0.0/0',  # TODO: fill out
-        IpProtocol = 'TCP',  # TODO: fill out
-        FromPort   = int(DB_PORT),
-        ToPort     = int(DB_PORT)
-    )
-except Exception as e:
-    print(e)
 
+def wait_for_cluster(redshift, cluster_id, status='available', timeout=CREATE_TIMEOUT,
+                     sleep=time.sleep, nodes=None):
+    """
+    Poll the cluster until it reaches *status*, with intervals growing from
+    POLL_MIN to POLL_MAX seconds; every status change is logged.
 
-#------------------------------------------------------------------------------
-# Make sure you can connect to the cluster
+    Parameters:
+        redshift (client) : boto3 Redshift client
+        cluster_id (str) : cluster identifier
+        status (str) : status to wait for, or None to wait until it is deleted
+        timeout (float) : seconds before giving up
+        sleep (function) : called with the seconds to wait between polls
+        nodes (int) : also wait for this number of nodes (after a resize)
 
-try:
-    conn_string = "host={} dbname={} user={} password={} port={}"
-    conn_string = conn_string.format(*config['CLUSTER'].values())
-    conn = psycopg2.connect( conn_string )
-    cur = conn.cursor()
-    print(conn_string)
+    Returns:
+        props (dict) : the cluster description (None once deleted)
 
-except Exception as e:
-    print(e)
+    Raises:
+        TimeoutError : the cluster did not reach the status in time
 
+    """
+    start = time.time()
+    interval = POLL_MIN
+    last = None
 
-#------------------------------------------------------------------------------
-#------------------------------------------------------------------------------
-# Clean up your resources
+    while True:
+        props = describe_cluster(redshift, cluster_id)
+        current = props['ClusterStatus'] if props else 'deleted'
+        if current != last:
+            logger.info('ClusterStatus:  {}'.format(current))
+            last = current
 
-redshift.delete_cluster( ClusterIdentifier = DWH_CLUSTER_IDENTIFIER, 
-                         SkipFinalClusterSnapshot = True )
+        if is_ready(props, status, nodes):
+            return props
 
+        if time.time() - start > timeout:
+            raise TimeoutError('cluster {} not {} after {} sec'
+                               .format(cluster_id, status or 'deleted', timeout))
 
-myClusterProps = redshift.describe_clusters(ClusterIdentifier = DWH_CLUSTER_IDENTIFIER)['Clusters'][0]
-pretty_Redshift_props(myClusterProps)
+        sleep(interval)
+        interval = min(POLL_MAX, interval * POLL_FACTOR)
 
-# ### WAIT...keep checking until the cluster is deleted
 
-bClusterDeleted = False
-nMinutes = 0
+def open_port(ec2, props, port):
+    """
+    Open an incoming TCP port to access the cluster endpoint.
 
-try:
-    while True:
-        time.sleep(60)
-        nMinutes += 1
-        print("waiting... {} minutes".format(nMinutes))
+    """
+    if not props.get('VpcId'):
+        logger.info('Cluster is not in a VPC, no port to open')
+        return
+
+    vpc = ec2.Vpc(id = props['VpcId'])
+    default_sg = [sg for sg in vpc.security_groups.all() if sg.group_name == 'default'][0]
+    try:
+        default_sg.authorize_ingress(GroupId    = default_sg.id,
+                                     CidrIp     = '0.0.0.0/0',
+                                     IpProtocol = 'TCP',
+                                     FromPort   = int(port),
+                                     ToPort     = int(port))
+        logger.info('Opened TCP port on cluster endpoint')
+    except ClientError as e:
+        if e.response['Error']['Code'] != 'InvalidPermission.Duplicate':
+            raise
+        logger.info('TCP port already open on cluster endpoint')
+
+
+def save_cluster_config(config, props, path='dwh.cfg'):
+    """
+    Write the cluster endpoint and role ARN to the config file.
 
-        # then check the status
-        myClusterProps = redshift.describe_clusters(ClusterIdentifier = DWH_CLUSTER_IDENTIFIER)['Clusters'][0]
+    """
+    config['CLUSTER']['HOST'] = props['Endpoint']['Address']
+    if props.get('IamRoles'):
+        config['IAM_ROLE']['ARN'] = "'{}'".format(props['IamRoles'][0]['IamRoleArn'])
 
-        if nMinutes >= 10:
-            print("10 minute time limit reached. Cluster may not have been deleted yet.")
-            break
+    logger.info('HOST:  {}'.format(config['CLUSTER']['HOST']))
+    logger.info('ARN:   {}'.format(config['IAM_ROLE']['ARN']))
 
-        if  myClusterProps['ClusterStatus'] == 'deleting':
-            continue
+    with open(path, 'w') as f:
+        config.write(f)
 
-except Exception as e:
-    bClusterDeleted = True
-    print(e)
-    print("Meaning the Cluster was successfully deleted.")
 
+def latest_snapshot(redshift, cluster_id):
+    """
+    Return the identifier of the newest available manual snapshot of the
+    cluster, or None.
 
-if bClusterDeleted:
-    iam.detach_role_policy(RoleName = IAM_ROLE_NAME, 
-                           PolicyArn = "arn:aws:iam::aws:policy/AmazonS3ReadOnlyAccess")
-    iam.delete_role(RoleName = IAM_ROLE_NAME)
+    """
+    snapshots = redshift.describe_cluster_snapshots(ClusterIdentifier = cluster_id,
+                                                    SnapshotType      = 'manual')['Snapshots']
+    snapshots = [snap for snap in snapshots if snap['Status'] == 'available']
+    if not snapshots:
+        return None
+    return max(snapshots, key = lambda snap: snap['SnapshotCreateTime'])['SnapshotIdentifier']
+
+
+def prune_snapshots(redshift, cluster_id, keep=SNAPSHOTS_KEPT):
+    """
+    Delete all but the newest *keep* manual snapshots of the cluster.
+
+    """
+    snapshots = redshift.describe_cluster_snapshots(ClusterIdentifier = cluster_id,
+                                                    SnapshotType      = 'manual')['Snapshots']
+    snapshots = sorted(snapshots, key = lambda snap: snap['SnapshotCreateTime'], reverse = True)
+    for snap in snapshots[keep:]:
+        redshift.delete_cluster_snapshot(SnapshotIdentifier = snap['SnapshotIdentifier'])
+        logger.info('Deleted snapshot:  {}'.format(snap['SnapshotIdentifier']))
+
+
+def choose_start_path(redshift, cluster_id, sleep=time.sleep):
+    """
+    Pick the fastest way to an available cluster: a running cluster as is,
+    then resume a paused cluster (a pausing one once it is paused), then
+    restore the latest snapshot, and only then create a new cluster.
+
+    Returns:
+        (path, snapshot) : 'running', 'wait', 'resume', 'restore' or 'create',
+                           and the snapshot identifier for 'restore'
 
+    """
+    props = describe_cluster(redshift, cluster_id)
+
+    if props is not None:
+        status = props['ClusterStatus']
+        if status == 'available':
+            return 'running', None
+        if status == 'paused':
+            return 'resume', None
+        if status == 'pausing':
+            # a pausing cluster never becomes available by itself
+            wait_for_cluster(redshift, cluster_id, 'paused', sleep = sleep)
+            return 'resume', None
+        if status not in ('deleting', 'final-snapshot'):
+            return 'wait', None
+        # a cluster on its way out: its final snapshot is the restore point
+        wait_for_cluster(redshift, cluster_id, None, DELETE_TIMEOUT, sleep)
+
+    snapshot = latest_snapshot(redshift, cluster_id)
+    if snapshot is not None:
+        return 'restore', snapshot
+
+    return 'create', None
+
+
+def record_lifecycle(config, action, path, seconds, cluster_id, snapshot=None):
+    """
+    Append the lifecycle action, the path taken and its duration to the
+    history file (one JSON object per line).
+
+    """
+    history_file = config.get('LIFECYCLE', 'HISTORY_FILE', fallback = HISTORY_FILE)
+    os.makedirs(os.path.dirname(history_file) or '.', exist_ok = True)
+
+    entry = {'time'     : time.strftime('%Y-%m-%dT%H:%M:%S'),
+             'cluster'  : cluster_id,
+             'action'   : action,
+             'path'     : path,
+             'snapshot' : snapshot,
+             'seconds'  : round(seconds, 1)
+            }
+    with open(history_file, 'a') as f:
+        f.write(json.dumps(entry) + '\n')
+
+    logger.info('{} cluster by [ {} ] :  {:.0f} sec'.format(action, path, seconds))
+    return entry
+
+
+def start_cluster(config, clients, sleep=time.sleep):
+    """
+    Bring up the cluster by the fastest available path (see
+    choose_start_path). For a restore or a new cluster only the role itself
+    must exist before the cluster is requested; its S3 policy is attached
+    while the cluster comes up, and the cluster is reported as soon as it is
+    available. The path and the time to *available* are recorded.
 
+    Returns:
+        props (dict) : the description of the available cluster
+
+    """
+    redshift = clients['redshift']
+    cluster_id = config['DWH']['DWH_CLUSTER_IDENTIFIER']
+    role_name = config['IAM_ROLE']['IAM_ROLE_NAME']
+    start = time.time()
+
+    path, snapshot = choose_start_path(redshift, cluster_id, sleep)
+    logger.info('start path:  {}{}'.format(path, ' ({})'.format(snapshot) if snapshot else ''))
+
+    with ThreadPoolExecutor(max_workers = 1) as executor:
+        policy = None
+        if path in ('restore', 'create'):
+            role_arn = create_iam_role(clients['iam'], role_name)
+            policy = executor.submit(attach_policy, clients['iam'], role_name,
+                                     config['IAM_ROLE']['IAM_POLICY_ARN'])
+
+        if path == 'resume':
+            redshift.resume_cluster(ClusterIdentifier = cluster_id)
+        elif path == 'restore':
+            redshift.restore_from_cluster_snapshot(ClusterIdentifier  = cluster_id,
+                                                   SnapshotIdentifier = snapshot,
+                                                   IamRoles           = [role_arn])
+        elif path == 'create':
+            create_cluster(redshift, config, [role_arn])
+
+        props = wait_for_cluster(redshift, cluster_id, 'available', sleep = sleep)
+        if policy is not None:
+            policy.result()
+
+    record_lifecycle(config, 'start', path, time.time() - start, cluster_id, snapshot)
+
+    return props
+
+
+def stop_cluster(config, clients, mode=None, sleep=time.sleep):
+    """
+    Stop the cluster so that the next start is fast:
+
+        pause    : pause it (compute is released, the data stays);
+                   the next start resumes it
+        snapshot : delete it with a final snapshot, keeping the newest
+                   *snapshots_kept*; the next start restores the snapshot
+        delete   : delete it without a snapshot, and the IAM role
+
+    Parameters:
+        mode (str) : one of the above; defaults to STOP_MODE in [LIFECYCLE]
+
+    """
+    redshift = clients['redshift']
+    cluster_id = config['DWH']['DWH_CLUSTER_IDENTIFIER']
+    mode = mode or config.get('LIFECYCLE', 'STOP_MODE', fallback = STOP_MODE)
+    start = time.time()
+    snapshot = None
+
+    if mode == 'delete':
+        delete_cluster(config, clients, sleep)
+
+    elif describe_cluster(redshift, cluster_id) is None:
+        logger.info('ClusterStatus:  deleted')
+        return
+
+    elif mode == 'pause':
+        status = describe_cluster(redshift, cluster_id)['ClusterStatus']
+        if status == 'paused':
+            logger.info('ClusterStatus:  paused')
+            return
+        # a pausing cluster only needs the wait; one on its way up must be
+        # available before it can be paused
+        if status != 'pausing':
+            if status in ('resuming', 'modifying', 'creating'):
+                wait_for_cluster(redshift, cluster_id, 'available', sleep = sleep)
+            redshift.pause_cluster(ClusterIdentifier = cluster_id)
+        wait_for_cluster(redshift, cluster_id, 'paused', sleep = sleep)
+
+    elif mode == 'snapshot':
+        snapshot = '{}-{}'.format(cluster_id.lower(), time.strftime('%Y%m%d-%H%M%S'))
+        redshift.delete_cluster(ClusterIdentifier              = cluster_id,
+                                SkipFinalClusterSnapshot       = False,
+                                FinalClusterSnapshotIdentifier = snapshot)
+        wait_for_cluster(redshift, cluster_id, None, DELETE_TIMEOUT, sleep)
+        prune_snapshots(redshift, cluster_id,
+                        config.getint('LIFECYCLE', 'SNAPSHOTS_KEPT', fallback = SNAPSHOTS_KEPT))
+
+    else:
+        raise ValueError('unknown stop mode:  {}'.format(mode))
+
+    record_lifecycle(config, 'stop', mode, time.time() - start, cluster_id, snapshot)
+
+
+def delete_cluster(config, clients, sleep=time.sleep):
+    """
+    Delete the cluster, wait until it is gone, then delete the IAM role.
+
+    """
+    cluster_id = config['DWH']['DWH_CLUSTER_IDENTIFIER']
+    start = time.time()
+
+    if describe_cluster(clients['redshift'], cluster_id) is not None:
+        clients['redshift'].delete_cluster(ClusterIdentifier        = cluster_id,
+                                           SkipFinalClusterSnapshot = True)
+        wait_for_cluster(clients['redshift'], cluster_id, None, DELETE_TIMEOUT, sleep)
+        logger.info('time to delete cluster:  {:.0f} sec'.format(time.time() - start))
+
+    remove_iam_role(clients['iam'], config['IAM_ROLE']['IAM_ROLE_NAME'],
+                    config['IAM_ROLE']['IAM_POLICY_ARN'])
+
+
+def main():
+    parser = argparse.ArgumentParser(description = 'Manage the Redshift cluster')
+    parser.add_argument('action', choices = ['start', 'stop', 'status', 'delete'])
+    parser.add_argument('--mode', choices = ['pause', 'snapshot', 'delete'],
+                        help = 'how to stop the cluster (default: stop_mode in [LIFECYCLE])')
+    args = parser.parse_args()
+    mylib.setup_logger()
+
+    logger.info('===[  {} Cluster  ]==='.format(args.action.capitalize()))
+    mylib.log_timestamp()
+
+    config = load_config()
+    clients = get_clients(config)
+    cluster_id = config['DWH']['DWH_CLUSTER_IDENTIFIER']
+
+    if args.action == 'status':
+        props = describe_cluster(clients['redshift'], cluster_id)
+        if props is None:
+            logger.info('ClusterStatus:  deleted')
+            logger.info('latest snapshot:  {}'.format(latest_snapshot(clients['redshift'],
+                                                                      cluster_id)))
+        else:
+            log_cluster(props)
+
+    elif args.action == 'stop':
+        stop_cluster(config, clients, args.mode)
+
+    elif args.action == 'delete':
+        delete_cluster(config, clients)
+
+    else:
+        log_config(config)
+        props = start_cluster(config, clients)
+        save_cluster_config(config, props)
+        open_port(clients['ec2'], props, config['CLUSTER']['DB_PORT'])
+
+        # Make sure you can connect to the cluster
+        try:
+            conn = db.connect(config)
+            logger.info('connected to database:  {}'.format(config['CLUSTER']['DB_NAME']))
+            conn.close()
+            logger.info('Ready for ETL...')
+        except psycopg2.Error as e:
+            logger.info('Error :  Could not connect to the cluster')
+            print(e)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,183 @@
+import json
+import os
+import threading
+import time
+import uuid
+import mylib
+
+# ---------------------------------------------------------------------------------
+# Per-query metrics for the ETL, written as JSON lines next to the logfile:
+#     ./logs/etl-YYYYMMDD.log  ->  ./logs/etl-YYYYMMDD-metrics.jsonl
+#
+# Each executed query records its stage, target table, wall time, rows
+# affected and (on Redshift) the backend query id; write_summary() adds one
+# summary record per run.
+# ---------------------------------------------------------------------------------
+
+
+LOCK    = threading.Lock()
+RUN     = {'run_id': None, 'name': None, 'start': None}
+RECORDS = []
+
+
+def get_metrics_file_name():
+    """
+    Return the metrics pathname that goes with the current logfile.
+
+    """
+    logfile = mylib.get_log_file_name()
+    if logfile.endswith('.log'):
+        logfile = logfile[:-len('.log')]
+    return logfile + '-metrics.jsonl'
+
+
+def start_run(name):
+    """
+    Start a new run; every record written until the next start_run() is
+    stamped with its run id.
+
+    Parameters:
+        name (str) : name of the program, e.g. 'etl' or 'create_tables'
+
+    Returns:
+        run_id (str) : id of the new run
+
+    """
+    with LOCK:
+        RUN['run_id'] = uuid.uuid4().hex[:12]
+        RUN['name']   = name
+        RUN['start']  = time.time()
+        del RECORDS[:]
+
+    return RUN['run_id']
+
+
+def write_line(record):
+    # ./logs is otherwise only created by the log writer, with its first record
+    path = get_metrics_file_name()
+    os.makedirs(os.path.dirname(path) or '.', exist_ok = True)
+    with open(path, 'a') as f:
+        f.write(json.dumps(record) + '\n')
+
+
+def record(stage, table, seconds, rows=None, status='ok', query_id=None, error=None):
+    """
+    Record the metrics of one executed query (or bulk load).
+
+    Parameters:
+        stage (str) : ETL stage, e.g. 'load_staging_tables'
+        table (str) : target table
+        seconds (float) : wall time
+        rows (int) : rows affected, when known
+        status (str) : 'ok' or 'failed'
+        query_id (int) : backend query id, when known
+        error (str) : error message of a failed query
+
+    """
+    entry = {'type'     : 'query',
+             'run_id'   : RUN['run_id'],
+             'run'      : RUN['name'],
+             'time'     : time.strftime('%Y-%m-%dT%H:%M:%S'),
+             'stage'    : stage,
+             'table'    : table,
+             'seconds'  : round(seconds, 3),
+             'rows'     : rows,
+             'query_id' : query_id,
+             'status'   : status
+            }
+    if error:
+        entry['error'] = error.strip()
+
+    with LOCK:
+        RECORDS.append(entry)
+        write_line(entry)
+
+
+def is_redshift(conn):
+    """
+    Redshift reports itself as PostgreSQL 8.0.2; a Postgres target is newer.
+
+    """
+    version = getattr(conn, 'server_version', None)
+    return version is not None and version < 90000
+
+
+def last_query_id(conn):
+    """
+    Return the id of the last query run in the session (Redshift only).
+
+    """
+    if not is_redshift(conn):
+        return None
+
+    cur = conn.cursor()
+    try:
+        cur.execute("SELECT pg_last_query_id()")
+        return cur.fetchone()[0]
+    finally:
+        cur.close()
+
+
+def execute(cur, query, stage, table):
+    """
+    Execute a query and record its metrics; errors are recorded, then raised.
+
+    Parameters:
+        cur (cursor object) : for executing PostgreSQL command in a db session
+        query (str) : SQL statement
+        stage (str) : ETL stage the query belongs to
+        table (str) : target table of the query
+
+    Returns:
+        rows (int) : rows affected, or None when the backend does not say
+
+    """
+    start = time.time()
+
+    try:
+        cur.execute(query)
+    except Exception as e:
+        record(stage, table, time.time() - start, status = 'failed', error = str(e))
+        raise
+
+    seconds = time.time() - start
+    rows = cur.rowcount if cur.rowcount is not None and cur.rowcount >= 0 else None
+    record(stage, table, seconds, rows, query_id = last_query_id(cur.connection))
+
+    return rows
+
+
+def write_summary():
+    """
+    Write one summary record for the run: totals per stage and wall time.
+
+    Returns:
+        summary (dict) : the summary record
+
+    """
+    with LOCK:
+        stages = {}
+        for entry in RECORDS:
+            stage = stages.setdefault(entry['stage'],
+                                      {'queries': 0, 'failed': 0, 'seconds': 0.0, 'rows': 0})
+            stage['queries'] += 1
+            stage['seconds'] += entry['seconds']
+            stage['rows']    += entry['rows'] or 0
+            if entry['status'] != 'ok':
+                stage['failed'] += 1
+
+        for stage in stages.values():
+            stage['seconds'] = round(stage['seconds'], 3)
+            stage['rows_per_sec'] = round(stage['rows'] / stage['seconds'], 1) \
+                                    if stage['seconds'] else None
+
+        summary = {'type'    : 'summary',
+                   'run_id'  : RUN['run_id'],
+                   'run'     : RUN['name'],
+                   'time'    : time.strftime('%Y-%m-%dT%H:%M:%S'),
+                   'seconds' : round(time.time() - RUN['start'], 3) if RUN['start'] else None,
+                   'stages'  : stages
+                  }
+        write_line(summary)
+
+    return summary
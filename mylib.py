@@ -1,4 +1,9 @@
+import atexit
 import logging
+import logging.handlers
+import os
+import queue
+import threading
 import time
 
 
@@ -14,27 +19,101 @@ def set_log_file_name():
 
 
 def get_log_file_name():
-    return LOGFILE
-    
+    """
+    Return the pathname of the logfile currently written to.
+
+    """
+    return HANDLER.logfile
+
+
+class DailyFileHandler(logging.handlers.TimedRotatingFileHandler):
+    """
+    File handler for ./logs/etl-YYYYMMDD.log that switches to the file of
+    the new date at midnight by itself. The file, and its directory, are
+    created with the first record rather than when the handler is set up.
+
+    """
+
+    def __init__(self):
+        self.logfile = set_log_file_name()
+        super().__init__(self.logfile, when = 'midnight', delay = True)
+
+    def _open(self):
+        os.makedirs(os.path.dirname(self.baseFilename), exist_ok = True)
+        return super()._open()
+
+    def doRollover(self):
+        """
+        Start the file of the current date; the file of the day before is
+        kept as it is, under its own date.
+
+        """
+        if self.stream:
+            self.stream.close()
+            self.stream = None
+        self.logfile = set_log_file_name()
+        self.baseFilename = os.path.abspath(self.logfile)
+        self.rolloverAt = self.computeRollover(int(time.time()))
+
+
+class LogQueueHandler(logging.handlers.QueueHandler):
+    """
+    Queue handler of the root logger: a record is only put on the queue,
+    and a background listener (started with the first record) writes it to
+    the logfile, so a query thread never waits on the file.
 
-def setup_logger(logfile):
     """
-    Create instances of logger and file handler.
-    Create formatter and add to file handler.
-    Add file handler to logger instance and set level to info.
+
+    def enqueue(self, record):
+        start_listener()
+        super().enqueue(record)
+
+
+def start_listener():
+    """
+    Start the background writer of the log queue, once.
+
+    """
+    with LOCK:
+        if LISTENER['listener'] is None:
+            listener = logging.handlers.QueueListener(LOG_QUEUE, HANDLER,
+                                                      respect_handler_level = True)
+            listener.start()
+            LISTENER['listener'] = listener
+            atexit.register(stop_listener)
+
+
+def stop_listener():
+    """
+    Write the records still in the queue and stop the background writer;
+    runs at exit.
+
+    """
+    with LOCK:
+        listener, LISTENER['listener'] = LISTENER['listener'], None
+    if listener is not None:
+        listener.stop()
+        HANDLER.close()
+
+
+def setup_logger(logfile=None):
+    """
+    Create instances of logger and queue handler.
+    Add the queue handler to the root logger, unless it is already there,
+    and set level to info; records go through the queue to the daily
+    logfile (HANDLER).
 
     Arguments:
-        logfile - file pathname for logfile
+        logfile - ignored; the logfile follows the current date
 
     Return:
         fl - Logger object
 
     """
     fl = logging.getLogger()
-    fh = logging.FileHandler(logfile)
-    formatter = logging.Formatter(fmt = FORMAT, datefmt = FORMAT_DATE)
-    fh.setFormatter(formatter)
-    fl.addHandler(fh)
+    with LOCK:
+        if QUEUE_HANDLER not in fl.handlers:
+            fl.addHandler(QUEUE_HANDLER)
     fl.setLevel(logging.INFO)
 
     return fl
@@ -43,14 +122,14 @@ def setup_logger(logfile):
 def reset_logger():
     """
     Reset the logger object.
-    This needs to be done when the date changes at midnight!
+    The logfile switches to the new date at midnight by itself; this only
+    makes sure the queue handler is attached, without adding another one.
 
     Return:
         fl - Logger object
 
     """
-    logfile = set_log_file_name()
-    return setup_logger(logfile)
+    return setup_logger()
 
 
 def log_timestamp():
@@ -63,8 +142,16 @@ def log_timestamp():
 
 # ------------------------------------------------------------------------------
 
-LOGFILE     = set_log_file_name()
 FORMAT      = '%(asctime)s :  %(message)s'
 FORMAT_DATE = '%I:%M:%S %p'
 
-logger = setup_logger(LOGFILE)
+LOCK      = threading.Lock()
+LISTENER  = {'listener': None}
+LOG_QUEUE = queue.Queue()
+
+HANDLER = DailyFileHandler()
+HANDLER.setFormatter(logging.Formatter(fmt = FORMAT, datefmt = FORMAT_DATE))
+QUEUE_HANDLER = LogQueueHandler(LOG_QUEUE)
+
+# the root logger; the entry points attach the logfile with setup_logger()
+logger = logging.getLogger()
@@ -0,0 +1,184 @@
+import datetime
+import hashlib
+import json
+import os
+import pickle
+import re
+import pandas as pd
+from mylib import logger
+
+# ---------------------------------------------------------------------------------
+# Client-side result cache for the analytics queries.
+#
+# Entries are keyed by the normalized SQL, the bind parameters and the load
+# version; every ETL run stamps a new load version, so results of an older
+# load are never served and are purged. The cache directory is kept under a
+# size limit by evicting the least recently used entries.
+# ---------------------------------------------------------------------------------
+
+
+CACHE_DIR    = './cache'
+MAX_MB       = 256
+VERSION_FILE = 'load_version'
+
+
+def get_settings(config):
+    """
+    Return (cache directory, size limit in bytes) from the [CACHE] section.
+
+    """
+    if config is None:
+        return CACHE_DIR, MAX_MB * 1024 * 1024
+    return (config.get('CACHE', 'DIR', fallback = CACHE_DIR),
+            int(config.getfloat('CACHE', 'MAX_MB', fallback = MAX_MB) * 1024 * 1024))
+
+
+def normalize_sql(sql):
+    """
+    Normalize a query for the cache key: collapse whitespace outside of
+    quoted strings and drop the trailing semicolon.
+
+    """
+    parts = re.split(r"('(?:[^']|'')*'|\"[^\"]*\")", sql)
+    for i in range(0, len(parts), 2):
+        parts[i] = re.sub(r'\s+', ' ', parts[i])
+    return ''.join(parts).strip().rstrip(';').strip()
+
+
+def get_load_version(cache_dir=CACHE_DIR):
+    """
+    Return the load version stamped by the last ETL run, or None.
+
+    """
+    try:
+        with open(os.path.join(cache_dir, VERSION_FILE)) as f:
+            return f.read().strip() or None
+    except OSError:
+        return None
+
+
+def stamp_load_version(config=None, version=None):
+    """
+    Record a new load version after an ETL run, and purge the cache entries
+    of older loads. A stamp equal to the current version (two loads within
+    the same microsecond, or an explicit *version*) purges every entry.
+
+    Parameters:
+        config (config file object) : access to the [CACHE] settings
+        version (str) : version to stamp; defaults to the current time, to
+                        the microsecond
+
+    Returns:
+        version (str) : the new load version
+
+    """
+    cache_dir, max_bytes = get_settings(config)
+    os.makedirs(cache_dir, exist_ok = True)
+
+    previous = get_load_version(cache_dir)
+    version = version or datetime.datetime.now().strftime('%Y%m%d%H%M%S%f')
+    tmp = os.path.join(cache_dir, VERSION_FILE + '.tmp')
+    with open(tmp, 'w') as f:
+        f.write(version)
+    os.replace(tmp, os.path.join(cache_dir, VERSION_FILE))
+
+    purged = 0
+    for name in os.listdir(cache_dir):
+        if name.endswith('.pkl') and (version == previous or
+                                      not name.startswith(version + '-')):
+            os.remove(os.path.join(cache_dir, name))
+            purged += 1
+
+    logger.info('result cache :  load version {} ({} entries purged)'.format(version, purged))
+    return version
+
+
+def cache_key(sql, params, version):
+    """
+    Return the file name of the cache entry for a query.
+
+    """
+    text = json.dumps([normalize_sql(sql), params], sort_keys = True, default = str)
+    return '{}-{}.pkl'.format(version, hashlib.sha256(text.encode('utf-8')).hexdigest())
+
+
+def evict(cache_dir, max_bytes):
+    """
+    Remove the least recently used entries until the cache fits its limit.
+
+    """
+    entries = []
+    for name in os.listdir(cache_dir):
+        if name.endswith('.pkl'):
+            path = os.path.join(cache_dir, name)
+            stat = os.stat(path)
+            entries.append((stat.st_mtime, stat.st_size, path))
+
+    total = sum(size for mtime, size, path in entries)
+    for mtime, size, path in sorted(entries):
+        if total <= max_bytes:
+            break
+        os.remove(path)
+        total -= size
+
+
+def cached_query(cur, sql, params=None, config=None):
+    """
+    Run a query through the result cache.
+
+    Without a load version (no ETL run stamped one yet) the query always
+    runs on the cluster and nothing is cached.
+
+    Parameters:
+        cur (cursor object) : for executing PostgreSQL command in a db session
+        sql (str) : the query
+        params (dict or tuple) : bind parameters
+        config (config file object) : access to the [CACHE] settings
+
+    Returns:
+        (columns, rows) : column names, and the rows as a list of tuples
+
+    """
+    cache_dir, max_bytes = get_settings(config)
+    version = get_load_version(cache_dir)
+
+    if version is not None:
+        path = os.path.join(cache_dir, cache_key(sql, params, version))
+        try:
+            with open(path, 'rb') as f:
+                result = pickle.load(f)
+            os.utime(path)
+            logger.info('result cache :  hit')
+            return result
+        except (OSError, EOFError, pickle.UnpicklingError):
+            pass
+
+    cur.execute(sql, params)
+    columns = [column[0] for column in cur.description]
+    result = (columns, cur.fetchall())
+
+    if version is not None:
+        tmp = path + '.tmp'
+        with open(tmp, 'wb') as f:
+            pickle.dump(result, f, protocol = pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, path)
+        evict(cache_dir, max_bytes)
+        logger.info('result cache :  miss')
+
+    return result
+
+
+def read_sql(sql, conn, params=None, config=None):
+    """
+    Like pandas.read_sql, through the result cache.
+
+    Returns:
+        df (DataFrame) : the query result
+
+    """
+    cur = conn.cursor()
+    try:
+        columns, rows = cached_query(cur, sql, params, config)
+    finally:
+        cur.close()
+    return pd.DataFrame(rows, columns = columns)
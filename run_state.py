@@ -0,0 +1,219 @@
+import hashlib
+import json
+import os
+import threading
+import time
+from mylib import logger
+
+# ---------------------------------------------------------------------------------
+# Persistent run state of the ETL, for checkpoint / resume:
+#     ./logs/etl_state.json
+#
+# Every completed stage, and every completed query within a stage (by target
+# table), is written to the state file as soon as it is done. A run started
+# with resume skips the work an unfinished earlier run with the same inputs
+# already did; a new run, or a finished one, starts from scratch.
+# ---------------------------------------------------------------------------------
+
+
+STATE_FILE = './logs/etl_state.json'
+
+LOCK  = threading.Lock()
+STATE = {'file': None, 'run': None, 'failed': {}}
+
+
+def get_state_file_name(config):
+    """
+    Return the run state pathname from the [ETL] section.
+
+    """
+    return config.get('ETL', 'STATE_FILE', fallback = STATE_FILE) or STATE_FILE
+
+
+def inputs_digest(queries):
+    """
+    Return a digest of the staging inputs (the COPY statements, or the local
+    paths), so that a run is only resumed against the same inputs.
+
+    """
+    return hashlib.sha1('\n'.join(queries).encode('utf-8')).hexdigest()[:16]
+
+
+def read(path):
+    """
+    Return the run state stored in *path*, or None.
+
+    """
+    if not os.path.exists(path):
+        return None
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except ValueError:
+        logger.info('run state :  unreadable state file {}, ignored'.format(path))
+        return None
+
+
+def save():
+    """
+    Write the run state; the file is replaced atomically, so an interrupted
+    write leaves the previous state.
+
+    """
+    path = STATE['file']
+    temp = path + '.tmp'
+    with open(temp, 'w') as f:
+        json.dump(STATE['run'], f, indent = 2)
+    os.replace(temp, path)
+
+
+def new_run(run_id, inputs):
+    return {'run_id'  : run_id,
+            'inputs'  : inputs,
+            'status'  : 'running',
+            'started' : time.strftime('%Y-%m-%d %H:%M:%S'),
+            'attempts': 1,
+            'stages'  : {},
+            'items'   : {},
+            'failed'  : {}}
+
+
+def start(config, run_id, inputs, resume=False):
+    """
+    Start the run state of an ETL run.
+
+    With *resume*, the state of an unfinished earlier run with the same
+    inputs is continued; otherwise (or when there is nothing to resume) a
+    new state is started.
+
+    Parameters:
+        config (config file object) : access to the [ETL] settings
+        run_id (str) : id of this run (metrics.start_run)
+        inputs (str) : digest of the staging inputs (inputs_digest)
+        resume (bool) : continue an unfinished run
+
+    Returns:
+        resumed (bool) : True when an earlier run is continued
+
+    """
+    path = get_state_file_name(config)
+    os.makedirs(os.path.dirname(path) or '.', exist_ok = True)
+    previous = read(path) if resume else None
+
+    with LOCK:
+        STATE['file'] = path
+        STATE['failed'] = {}
+
+        if previous is None:
+            if resume:
+                logger.info('run state :  nothing to resume, new run')
+            STATE['run'] = new_run(run_id, inputs)
+        elif previous.get('status') == 'complete':
+            logger.info('run state :  run [ {} ] is complete, new run'.format(previous['run_id']))
+            STATE['run'] = new_run(run_id, inputs)
+        elif previous.get('inputs') != inputs:
+            logger.info('run state :  inputs of run [ {} ] changed, new run'
+                        .format(previous['run_id']))
+            STATE['run'] = new_run(run_id, inputs)
+        else:
+            previous['attempts'] = previous.get('attempts', 1) + 1
+            previous['status'] = 'running'
+            previous['failed'] = {}
+            STATE['run'] = previous
+            logger.info('run state :  resume run [ {} ], attempt {}, stages done {}'
+                        .format(previous['run_id'], previous['attempts'],
+                                sorted(previous['stages'])))
+
+        save()
+        return STATE['run'] is previous
+
+
+def reset(reason):
+    """
+    Drop the completed work of the run, e.g. when the staging tables no
+    longer match what was loaded.
+
+    """
+    with LOCK:
+        logger.info('run state :  {}, starting over'.format(reason))
+        STATE['run']['stages'] = {}
+        STATE['run']['items'] = {}
+        save()
+
+
+def is_done(stage, item=None):
+    """
+    Return True when a stage, or an item (target table) of a stage, was
+    completed by this run or the run it resumes.
+
+    """
+    with LOCK:
+        if STATE['run'] is None:
+            return False
+        if item is None:
+            return stage in STATE['run']['stages']
+        return item in STATE['run']['items'].get(stage, {})
+
+
+def get_item(stage, item):
+    """
+    Return the info recorded with a completed item, or None.
+
+    """
+    with LOCK:
+        if STATE['run'] is None:
+            return None
+        return STATE['run']['items'].get(stage, {}).get(item)
+
+
+def mark_done(stage, item=None, **info):
+    """
+    Record a completed stage, or a completed item of a stage together with
+    its *info* (e.g. rows, fingerprint).
+
+    """
+    with LOCK:
+        if STATE['run'] is None:
+            return
+        entry = dict(info, finished = time.strftime('%Y-%m-%d %H:%M:%S'))
+        if item is None:
+            STATE['run']['stages'][stage] = entry
+        else:
+            STATE['run']['items'].setdefault(stage, {})[item] = entry
+            STATE['run']['failed'].get(stage, {}).pop(item, None)
+        save()
+
+
+def mark_failed(stage, item, error):
+    """
+    Record a failed item of a stage; the stage is then not complete.
+
+    """
+    with LOCK:
+        STATE['failed'].setdefault(stage, {})[item] = str(error)
+        if STATE['run'] is None:
+            return
+        STATE['run']['failed'].setdefault(stage, {})[item] = str(error)[:1024]
+        save()
+
+
+def failed(stage):
+    """
+    Return the items of a stage that failed in this attempt.
+
+    """
+    with LOCK:
+        return sorted(STATE['failed'].get(stage, {}))
+
+
+def finish(status='complete'):
+    """
+    Mark the run complete, or stopped at a failed stage.
+
+    """
+    with LOCK:
+        if STATE['run'] is None:
+            return
+        STATE['run']['status'] = status
+        STATE['run']['finished'] = time.strftime('%Y-%m-%d %H:%M:%S')
+        save()
@@ -0,0 +1,164 @@
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from mylib import logger
+
+
+# ---------------------------------------------------------------------------------
+# Dependency-aware scheduler for the ETL query graph
+# ---------------------------------------------------------------------------------
+
+
+def check_graph(graph):
+    """
+    Validate a dependency graph before it is scheduled.
+
+    Parameters:
+        graph (dict) : {node: (payload, [dependencies])}
+
+    Returns:
+        none
+
+    Raises:
+        ValueError : a dependency is not a node of the graph, or the graph
+                     contains a cycle
+
+    """
+    for node, (payload, deps) in graph.items():
+        for dep in deps:
+            if dep not in graph:
+                raise ValueError("node [ {} ] depends on unknown node [ {} ]"
+                                 .format(node, dep))
+
+    # Kahn's algorithm; any node left over is part of a cycle
+    pending = {node: set(deps) for node, (payload, deps) in graph.items()}
+    while pending:
+        ready = [node for node, deps in pending.items() if not deps]
+        if not ready:
+            raise ValueError("dependency cycle between nodes {}"
+                             .format(sorted(pending)))
+        for node in ready:
+            del pending[node]
+        for deps in pending.values():
+            deps.difference_update(ready)
+
+
+def critical_path(graph, durations):
+    """
+    Find the chain of dependent nodes with the longest total duration.
+
+    Parameters:
+        graph (dict) : {node: (payload, [dependencies])}
+        durations (dict) : {node: seconds} for every node that ran
+
+    Returns:
+        (path, seconds) : list of nodes on the critical path, and its length
+
+    """
+    finish = {}
+    previous = {}
+
+    def longest(node):
+        if node not in finish:
+            deps = [dep for dep in graph[node][1] if dep in durations]
+            best = max(deps, key = longest, default = None)
+            previous[node] = best
+            finish[node] = durations.get(node, 0.0) + \
+                           (finish[best] if best is not None else 0.0)
+        return finish[node]
+
+    if not durations:
+        return [], 0.0
+
+    end = max(durations, key = longest)
+    path = []
+    node = end
+    while node is not None:
+        path.append(node)
+        node = previous[node]
+
+    return path[::-1], finish[end]
+
+
+def run_graph(graph, run_node, workers=4):
+    """
+    Run every node of a dependency graph, independent nodes concurrently.
+
+    A node is submitted as soon as all of its dependencies have finished
+    successfully; nodes downstream of a failure are skipped.
+
+    Parameters:
+        graph (dict) : {node: (payload, [dependencies])}
+        run_node (function) : called as run_node(node, payload) and returns
+                              'ok' or 'failed'
+        workers (int) : maximum number of nodes running at the same time
+
+    Returns:
+        results (dict) : {node: (status, seconds)}; status is 'ok', 'failed'
+                         or 'skipped'
+
+    """
+    check_graph(graph)
+
+    def timed(node, payload):
+        start = time.time()
+        status = run_node(node, payload)
+        return status, time.time() - start
+
+    results = {}
+    waiting = dict(graph)
+    running = {}
+
+    with ThreadPoolExecutor(max_workers = max(1, int(workers))) as executor:
+        while waiting or running:
+            for node, (payload, deps) in list(waiting.items()):
+                if any(dep in results and results[dep][0] != 'ok'
+                       for dep in deps):
+                    results[node] = ('skipped', 0.0)
+                    del waiting[node]
+                    logger.info('skip node [ {} ] :  dependency failed'.format(node))
+                elif all(dep in results for dep in deps):
+                    running[executor.submit(timed, node, payload)] = node
+                    del waiting[node]
+
+            if not running:
+                continue
+
+            done, not_done = wait(running, return_when = FIRST_COMPLETED)
+            for future in done:
+                node = running.pop(future)
+                try:
+                    results[node] = future.result()
+                except Exception as e:
+                    logger.info('Error :  node [ {} ] raised {}'.format(node, e))
+                    results[node] = ('failed', 0.0)
+
+    return results
+
+
+def report(graph, results, wall_time):
+    """
+    Log and print per-node durations and the critical path of a graph run.
+
+    Parameters:
+        graph (dict) : {node: (payload, [dependencies])}
+        results (dict) : {node: (status, seconds)} returned by run_graph()
+        wall_time (float) : elapsed seconds for the whole graph
+
+    Returns:
+        none
+
+    """
+    for node, (status, seconds) in sorted(results.items(),
+                                          key = lambda item: -item[1][1]):
+        line = 'node [ {} ] :  {} in {:.2f} sec'.format(node, status, seconds)
+        logger.info(line)
+        print(line)
+
+    durations = {node: seconds for node, (status, seconds) in results.items()
+                 if status == 'ok'}
+    path, seconds = critical_path(graph, durations)
+
+    line = 'critical path :  {}  ({:.2f} sec of {:.2f} sec wall time)' \
+           .format(' -> '.join(path), seconds, wall_time)
+    logger.info(line)
+    print(line)
@@ -0,0 +1,349 @@
+import argparse
+import configparser
+import itertools
+import json
+import math
+import re
+from decimal import Decimal
+import mylib
+from mylib import logger
+from local_ingest import (STAGING_EVENTS_COLUMNS, STAGING_SONGS_COLUMNS,
+                          read_jsonpaths, iter_records, json_auto_keys)
+from table_advisor import parse_create
+from sql_queries import stage_queries
+
+# ---------------------------------------------------------------------------------
+# Schema profiler: scan sample input JSON for the real max lengths, cardinalities
+# and numeric ranges of the staging columns, and recommend narrower types and
+# column ENCODE settings for the staging tables and the tables loaded from them
+#
+#     python schema_profiler.py --out schema_profile.json     # sample from [LOCAL]
+#     python schema_profiler.py --ddl tables.sql              # ... and write the DDL
+#
+# With profile_file set in the [SCHEMA] section, create_tables.py creates the
+# tables with the profiled types and encodings.
+# ---------------------------------------------------------------------------------
+
+
+SAMPLE_ROWS  = 100000
+HEADROOM     = 1.5
+# distinct values counted per column; above this the column is high-cardinality
+DISTINCT_CAP = 10000
+# VARCHAR columns with at most this many distinct values are BYTEDICT encoded
+BYTEDICT_MAX = 255
+MIN_VARCHAR  = 8
+
+# analytics columns loaded from a staging column - they get its profile
+DERIVED = {'songplays' : {'sp_level'      : ('staging_events', 'level'),
+                          'sp_song_id'    : ('staging_songs',  'song_id'),
+                          'sp_artist_id'  : ('staging_songs',  'artist_id'),
+                          'sp_location'   : ('staging_events', 'location'),
+                          'sp_user_agent' : ('staging_events', 'userAgent')},
+           'users'     : {'u_first_name'  : ('staging_events', 'firstName'),
+                          'u_last_name'   : ('staging_events', 'lastName'),
+                          'u_gender'      : ('staging_events', 'gender'),
+                          'u_level'       : ('staging_events', 'level')},
+           'songs'     : {'s_song_id'     : ('staging_songs',  'song_id'),
+                          's_title'       : ('staging_songs',  'title'),
+                          's_artist_id'   : ('staging_songs',  'artist_id'),
+                          's_year'        : ('staging_songs',  'year'),
+                          's_duration'    : ('staging_songs',  'duration')},
+           'artists'   : {'a_artist_id'   : ('staging_songs',  'artist_id'),
+                          'a_name'        : ('staging_songs',  'artist_name'),
+                          'a_location'    : ('staging_songs',  'artist_location'),
+                          'a_latitude'    : ('staging_songs',  'artist_latitude'),
+                          'a_longitude'   : ('staging_songs',  'artist_longitude')}
+          }
+
+INT_TYPES = [('SMALLINT', 2 ** 15 - 1), ('INTEGER', 2 ** 31 - 1), ('BIGINT', 2 ** 63 - 1)]
+AZ64_TYPES = ('SMALLINT', 'INTEGER', 'BIGINT', 'DECIMAL', 'DATE', 'TIMESTAMP')
+
+# column definition line of a CREATE TABLE in sql_queries.py
+COLUMN_LINE = re.compile(r'^(\s+)(\w+)(\s+)(DOUBLE PRECISION|\w+(?:\([^)]*\))?)(.*?)(,?)\s*$')
+
+
+def profile_rows(rows, columns, sample_rows=SAMPLE_ROWS):
+    """
+    Profile the values of each column.
+
+    Parameters:
+        rows (iterable) : tuples of column values
+        columns (list) : column names, in the order of each row
+        sample_rows (int) : rows scanned at most
+
+    Returns:
+        stats (dict) : {column: {'rows', 'nulls', 'kind', 'max_bytes',
+                                 'distinct', 'min', 'max'}}
+
+    """
+    stats = {column: {'rows': 0, 'nulls': 0, 'kind': None, 'max_bytes': 0,
+                      'distinct': set(), 'min': None, 'max': None}
+             for column in columns}
+
+    for row in itertools.islice(rows, sample_rows):
+        for column, value in zip(columns, row):
+            column_stats = stats[column]
+            column_stats['rows'] += 1
+            if value is None or value == '':
+                column_stats['nulls'] += 1
+                continue
+
+            if isinstance(value, bool):
+                kind = 'bool'
+            elif isinstance(value, int):
+                kind = 'int'
+            elif isinstance(value, (float, Decimal)):
+                kind = 'float'
+            else:
+                kind = 'str'
+                value = str(value)
+            previous = column_stats['kind']
+            if previous is None or previous == kind:
+                column_stats['kind'] = kind
+            elif {previous, kind} == {'int', 'float'}:
+                column_stats['kind'] = 'float'
+            else:
+                column_stats['kind'] = 'str'
+
+            if kind in ('int', 'float'):
+                if column_stats['min'] is None:
+                    column_stats['min'] = column_stats['max'] = value
+                column_stats['min'] = min(column_stats['min'], value)
+                column_stats['max'] = max(column_stats['max'], value)
+
+            column_stats['max_bytes'] = max(column_stats['max_bytes'],
+                                            len(str(value).encode('utf-8')))
+            if isinstance(column_stats['distinct'], set):
+                column_stats['distinct'].add(value)
+                if len(column_stats['distinct']) > DISTINCT_CAP:
+                    column_stats['distinct'] = DISTINCT_CAP + 1
+
+    for column_stats in stats.values():
+        if isinstance(column_stats['distinct'], set):
+            column_stats['distinct'] = len(column_stats['distinct'])
+
+    return stats
+
+
+def profile_input(log_data, log_jsonpath, song_data, sample_rows=SAMPLE_ROWS):
+    """
+    Profile the staging columns from local copies of LOG_DATA and SONG_DATA,
+    mapping the JSON keys to the columns the way the COPY does.
+
+    Returns:
+        stats (dict) : {'staging_events': {...}, 'staging_songs': {...}}
+
+    """
+    keys = read_jsonpaths(log_jsonpath) if log_jsonpath else STAGING_EVENTS_COLUMNS
+    events = (tuple(record.get(key) for key in keys) for record in iter_records(log_data))
+
+    def songs():
+        for record in iter_records(song_data):
+            song_keys = json_auto_keys(record, STAGING_SONGS_COLUMNS)
+            yield tuple(record[key] if key else None for key in song_keys)
+
+    return {'staging_events' : profile_rows(events, STAGING_EVENTS_COLUMNS, sample_rows),
+            'staging_songs'  : profile_rows(songs(), STAGING_SONGS_COLUMNS, sample_rows)}
+
+
+def varchar_length(max_bytes, headroom=HEADROOM):
+    """
+    Return a VARCHAR length for values of up to *max_bytes*, with headroom,
+    rounded up to a multiple of 8.
+
+    """
+    length = max(MIN_VARCHAR, int(math.ceil(max_bytes * headroom)))
+    return min(65535, int(math.ceil(length / 8.0)) * 8)
+
+
+def recommend_column(declared, column_stats, leading, headroom=HEADROOM):
+    """
+    Recommend the type and encoding of one column. Types are only ever made
+    narrower within their family (VARCHAR length, integer width); columns
+    without profile keep their type.
+
+    Parameters:
+        declared (str) : type in the current DDL, e.g. 'VARCHAR(MAX)'
+        column_stats (dict) : profile of the column, or None
+        leading (bool) : the column leads the sort key
+
+    Returns:
+        (type, encode) : e.g. ('VARCHAR(64)', 'ZSTD')
+
+    """
+    column_type = declared
+    base = declared.split('(')[0]
+
+    if column_stats and column_stats['rows'] > column_stats['nulls']:
+        if base == 'VARCHAR':
+            limit = declared[len('VARCHAR('):-1]
+            length = varchar_length(column_stats['max_bytes'], headroom)
+            if limit == 'MAX' or length < int(limit):
+                column_type = 'VARCHAR({})'.format(length)
+
+        elif base in dict(INT_TYPES) and column_stats['kind'] == 'int':
+            largest = max(abs(column_stats['min']), abs(column_stats['max'])) * headroom
+            names = [name for name, limit in INT_TYPES]
+            for name, limit in INT_TYPES[:names.index(base) + 1]:
+                if largest <= limit:
+                    column_type = name
+                    break
+
+    base = column_type.split('(')[0]
+    if leading:
+        encode = 'RAW'
+    elif base in AZ64_TYPES:
+        encode = 'AZ64'
+    elif (base == 'VARCHAR' and column_stats and
+          0 < column_stats['distinct'] <= BYTEDICT_MAX):
+        encode = 'BYTEDICT'
+    else:
+        encode = 'ZSTD'
+
+    return column_type, encode
+
+
+def sort_column(query):
+    """
+    Return the leading sort key column of a registered CREATE TABLE query,
+    or None.
+
+    """
+    match = re.search(r'SORTKEY\(\s*(\w+)', query.template)
+    if match:
+        return match.group(1)
+    for line in parse_create(query)[2]:
+        if re.search(r'\bSORTKEY\b', line):
+            return line.split()[0]
+    return None
+
+
+def recommend(stats, queries=None, headroom=HEADROOM):
+    """
+    Recommend the type and encoding of every column of the tables.
+
+    Parameters:
+        queries (list) : registered CREATE TABLE queries; defaults to the
+                         'create_tables' stage
+
+    Returns:
+        columns (dict) : {table: {column: {'type', 'encode', 'declared'}}}
+
+    """
+    if queries is None:
+        queries = stage_queries('create_tables')
+
+    recommended = {}
+    for query in queries:
+        table, columns, lines = parse_create(query)
+        leading = sort_column(query)
+        recommended[table] = {}
+
+        for line in lines:
+            match = COLUMN_LINE.match(line)
+            if not match:
+                continue
+            column, declared = match.group(2), match.group(4)
+
+            source = DERIVED.get(table, {}).get(column, (table, column))
+            column_stats = stats.get(source[0], {}).get(source[1])
+
+            column_type, encode = recommend_column(declared, column_stats,
+                                                   column == leading, headroom)
+            recommended[table][column] = {'type'     : column_type,
+                                          'encode'   : encode,
+                                          'declared' : declared}
+    return recommended
+
+
+def apply_profile(queries, recommended):
+    """
+    Rewrite CREATE TABLE queries with the recommended types and encodings,
+    keeping their layout.
+
+    Parameters:
+        queries (list) : registered CREATE TABLE queries (sql_queries.Query),
+                         rendered for the target
+        recommended (dict) : the 'columns' of a profile
+
+    Returns:
+        queries (list) : copies of the queries with the rewritten statements
+
+    """
+    rewritten = []
+    for query in queries:
+        columns = recommended.get(query.table, {})
+        lines = []
+
+        for line in query.sql.split('\n'):
+            match = COLUMN_LINE.match(line)
+            if match and match.group(2) in columns:
+                indent, column, space, declared, rest, comma = match.groups()
+                spec = columns[column]
+                rest = re.sub(r'\s*ENCODE\s+\w+', '', rest)
+                line = '{}{}{}{}{} ENCODE {}{}'.format(indent, column, space,
+                                                       spec['type'].ljust(len(declared)),
+                                                       rest, spec['encode'], comma)
+            lines.append(line)
+
+        rewritten.append(query.with_sql('\n'.join(lines)))
+    return rewritten
+
+
+def load_profile(path):
+    """
+    Return the recommended columns stored in a profile file.
+
+    """
+    with open(path) as f:
+        return json.load(f)['columns']
+
+
+def main():
+    parser = argparse.ArgumentParser(description = 'Profile the input and tighten the DDL')
+    parser.add_argument('--log-data', help = 'local LOG_DATA directory (default: [LOCAL])')
+    parser.add_argument('--song-data', help = 'local SONG_DATA directory (default: [LOCAL])')
+    parser.add_argument('--sample', type = int, default = SAMPLE_ROWS,
+                        help = 'records scanned per dataset')
+    parser.add_argument('--out', default = 'schema_profile.json',
+                        help = 'profile file (set it as profile_file in [SCHEMA])')
+    parser.add_argument('--ddl', help = 'also write the tightened CREATE TABLE statements')
+    args = parser.parse_args()
+    mylib.setup_logger()
+
+    logger.info('---[ Schema Profiler ]---')
+    mylib.log_timestamp()
+
+    config = configparser.ConfigParser()
+    config.read('dwh.cfg')
+    headroom = config.getfloat('SCHEMA', 'HEADROOM', fallback = HEADROOM)
+
+    stats = profile_input(args.log_data or config['LOCAL']['LOG_DATA'],
+                          config['LOCAL'].get('LOG_JSONPATH'),
+                          args.song_data or config['LOCAL']['SONG_DATA'],
+                          args.sample)
+    queries = [query.render(config) for query in stage_queries('create_tables')]
+    recommended = recommend(stats, queries, headroom)
+
+    for table, columns in recommended.items():
+        for column, spec in columns.items():
+            if spec['type'] != spec['declared']:
+                logger.info('profile [ {}.{} ] :  {} -> {} ENCODE {}'
+                            .format(table, column, spec['declared'], spec['type'],
+                                    spec['encode']))
+
+    with open(args.out, 'w') as f:
+        json.dump({'headroom' : headroom,
+                   'stats'    : stats,
+                   'columns'  : recommended
+                  }, f, indent = 2, default = str)
+    print('Profile written to {}'.format(args.out))
+
+    if args.ddl:
+        with open(args.ddl, 'w') as f:
+            f.write('\n'.join(query.sql for query in apply_profile(queries, recommended)))
+        print('DDL written to {}'.format(args.ddl))
+
+
+if __name__ == "__main__":
+    main()
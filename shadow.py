@@ -0,0 +1,268 @@
+import argparse
+import configparser
+import re
+import time
+import psycopg2
+import mylib
+from mylib import logger
+import db
+import metrics
+from sql_queries import (stage_queries, shadow_tables, shadow_table_create, shadow_table_drop,
+                         shadow_table_rename, table_names_select)
+
+# ---------------------------------------------------------------------------------
+# Shadow-table load: every analytics and aggregate table is built from the
+# staging tables into <table>__shadow while the live tables stay readable,
+# then all of them are renamed into place in one transaction. The replaced
+# tables are kept as <table>__v<YYYYmmddHHMMSS> for RETENTION_HOURS, so a bad
+# load can be rolled back by renaming them back.
+#
+#     python shadow.py --list
+#     python shadow.py --rollback
+#     python shadow.py --prune
+# ---------------------------------------------------------------------------------
+
+
+SHADOW          = '__shadow'
+VERSION         = '__v'
+STAMP_FORMAT    = '%Y%m%d%H%M%S'
+RETENTION_HOURS = 24.0
+
+
+def shadow_name(table):
+    return table + SHADOW
+
+
+def version_name(table, stamp):
+    return table + VERSION + stamp
+
+
+def shadow_query(query, tables=shadow_tables):
+    """
+    Return the query with the tables replaced by their shadow copies, e.g.
+    'INSERT INTO time ... FROM songplays' into time__shadow from
+    songplays__shadow; the staging tables are left as they are.
+
+    """
+    pattern = r'\b({})\b'.format('|'.join(re.escape(table) for table in tables))
+    return re.sub(pattern, r'\1' + SHADOW, query)
+
+
+def create_shadow_tables(cur, conn, tables=shadow_tables):
+    """
+    Create an empty shadow copy of each table, with the same columns,
+    defaults, distribution and sort keys.
+
+    """
+    for table in tables:
+        metrics.execute(cur, shadow_table_drop.format(shadow = shadow_name(table)),
+                        'shadow_load', shadow_name(table))
+        metrics.execute(cur, shadow_table_create.format(shadow = shadow_name(table),
+                                                        table  = table),
+                        'shadow_load', shadow_name(table))
+    conn.commit()
+
+
+def drop_shadow_tables(cur, conn, tables=shadow_tables):
+    """
+    Drop the shadow copies, e.g. after a failed build.
+
+    """
+    for table in tables:
+        cur.execute(shadow_table_drop.format(shadow = shadow_name(table)))
+    conn.commit()
+
+
+def build_shadow_tables(cur, conn):
+    """
+    Fill the shadow tables from the staging tables: the analytics inserts,
+    then the aggregate rebuild, each rewritten to the shadow copies.
+
+    Raises:
+        psycopg2.Error : a query failed; the caller drops the shadow tables
+
+    """
+    for query in stage_queries('insert_tables') + stage_queries('aggregates'):
+        table = shadow_name(query.table)
+        logger.info('shadow load [ {} ]'.format(table))
+        metrics.execute(cur, shadow_query(query.sql), 'shadow_load', table)
+        conn.commit()
+
+
+def swap_tables(cur, conn, stamp, tables=shadow_tables):
+    """
+    Rename every live table to its version name and its shadow copy to the
+    live name, in one transaction; readers see either the old or the new
+    set of tables, never a mix.
+
+    """
+    try:
+        for table in tables:
+            cur.execute(shadow_table_rename.format(table = table,
+                                                   name  = version_name(table, stamp)))
+            cur.execute(shadow_table_rename.format(table = shadow_name(table),
+                                                   name  = table))
+        conn.commit()
+
+    except psycopg2.Error:
+        conn.rollback()
+        raise
+
+
+def list_versions(cur, conn, tables=shadow_tables):
+    """
+    Return the versions kept by earlier swaps that have a copy of every table.
+
+    Returns:
+        stamps (list) : version stamps, oldest first
+
+    """
+    cur.execute(table_names_select)
+    names = {row[0] for row in cur.fetchall()}
+    conn.commit()
+
+    pattern = re.compile(r'^{}{}(\d{{14}})$'.format(re.escape(tables[0]), re.escape(VERSION)))
+    stamps = [match.group(1) for match in map(pattern.match, names) if match]
+    return sorted(stamp for stamp in stamps
+                  if all(version_name(table, stamp) in names for table in tables))
+
+
+def prune_versions(cur, conn, retention_hours=RETENTION_HOURS, now=None, tables=shadow_tables):
+    """
+    Drop the versions older than the retention period.
+
+    Returns:
+        dropped (list) : the version stamps dropped
+
+    """
+    now = time.time() if now is None else now
+    dropped = []
+
+    for stamp in list_versions(cur, conn, tables):
+        age = (now - time.mktime(time.strptime(stamp, STAMP_FORMAT))) / 3600
+        if age <= retention_hours:
+            continue
+        for table in tables:
+            cur.execute("DROP TABLE IF EXISTS {}".format(version_name(table, stamp)))
+        conn.commit()
+        dropped.append(stamp)
+        logger.info('shadow :  dropped version [ {} ], {:.1f} hours old'.format(stamp, age))
+
+    return dropped
+
+
+def load_shadow(cur, conn, config):
+    """
+    Build the analytics and aggregate tables into shadow copies and swap
+    them in; the replaced tables are kept as a version, and versions older
+    than RETENTION_HOURS ([SHADOW] section) are dropped.
+
+    Parameters:
+        cur (cursor object) : for executing PostgreSQL command in a db session
+        conn (db session object) : connection to a database session
+        config (config file object) : access to the [SHADOW] settings
+
+    Returns:
+        stamp (str) : version stamp of the replaced tables, or None on error
+
+    """
+    logger.info('Load final tables (shadow)...')
+    start = time.time()
+
+    try:
+        create_shadow_tables(cur, conn)
+        build_shadow_tables(cur, conn)
+        stamp = time.strftime(STAMP_FORMAT)
+        swap_tables(cur, conn, stamp)
+
+    except psycopg2.Error as e:
+        conn.rollback()
+        logger.info('Error: Shadow load, live tables unchanged')
+        print(e)
+        drop_shadow_tables(cur, conn)
+        return None
+
+    logger.info('shadow :  tables swapped in after {:.2f} sec, previous tables kept as '
+                'version [ {} ]'.format(time.time() - start, stamp))
+    metrics.record('shadow_load', 'swap', time.time() - start)
+
+    prune_versions(cur, conn, config.getfloat('SHADOW', 'RETENTION_HOURS',
+                                              fallback = RETENTION_HOURS))
+    return stamp
+
+
+def rollback(cur, conn, stamp=None):
+    """
+    Swap the newest kept version (or *stamp*) back in; the tables it
+    replaces are kept as a version in turn.
+
+    Returns:
+        stamp (str) : the version swapped in, or None when there is none
+
+    """
+    versions = list_versions(cur, conn)
+    if stamp is None and versions:
+        stamp = versions[-1]
+    if stamp not in versions:
+        logger.info('shadow :  no version [ {} ] to roll back to'.format(stamp))
+        return None
+
+    now = time.strftime(STAMP_FORMAT)
+    try:
+        for table in shadow_tables:
+            cur.execute(shadow_table_rename.format(table = table,
+                                                   name  = version_name(table, now)))
+            cur.execute(shadow_table_rename.format(table = version_name(table, stamp),
+                                                   name  = table))
+        conn.commit()
+
+    except psycopg2.Error:
+        conn.rollback()
+        raise
+
+    logger.info('shadow :  rolled back to version [ {} ], replaced tables kept as [ {} ]'
+                .format(stamp, now))
+    return stamp
+
+
+def main():
+    """
+    List, prune or roll back the table versions kept by shadow loads.
+
+    """
+    parser = argparse.ArgumentParser(description = 'Manage the Sparkify shadow-load versions')
+    parser.add_argument('--list', action = 'store_true', help = 'list the kept versions')
+    parser.add_argument('--prune', action = 'store_true',
+                        help = 'drop the versions older than the retention period')
+    parser.add_argument('--rollback', nargs = '?', const = 'latest', metavar = 'STAMP',
+                        help = 'swap the newest (or the given) version back in')
+    args = parser.parse_args()
+    mylib.setup_logger()
+
+    config = configparser.ConfigParser()
+    config.read('dwh.cfg')
+
+    try:
+        conn = db.connect(config)
+        cur = conn.cursor()
+    except psycopg2.Error as e:
+        logger.info("Error :  Could not make connection to the sparkify DB")
+        print(e)
+        return
+
+    try:
+        if args.rollback:
+            stamp = rollback(cur, conn, None if args.rollback == 'latest' else args.rollback)
+            print('Rolled back to version {}'.format(stamp) if stamp else 'No version to roll back to')
+        elif args.prune:
+            retention = config.getfloat('SHADOW', 'RETENTION_HOURS', fallback = RETENTION_HOURS)
+            print('Dropped versions:  {}'.format(prune_versions(cur, conn, retention)))
+        else:
+            for stamp in list_versions(cur, conn):
+                print(stamp)
+    finally:
+        conn.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,9 +1,76 @@
 import configparser
+import re
 
 
-# CONFIG
-config = configparser.ConfigParser()
-config.read('dwh.cfg')
+# CONFIG - read from dwh.cfg when a statement that needs it is first rendered
+# (see get_config), so that importing the queries has no side effects
+CONFIG_FILE = 'dwh.cfg'
+CONFIG      = {}
+
+
+def get_config():
+    """
+    Return the config file object, read from dwh.cfg on first use.
+
+    """
+    if 'config' not in CONFIG:
+        config = configparser.ConfigParser()
+        config.read(CONFIG_FILE)
+        CONFIG['config'] = config
+    return CONFIG['config']
+
+
+# TARGET - the statements are written for Redshift; [ETL] target = postgres
+# rewrites them for a Postgres database (dev and CI, loaded by local_ingest.py)
+TARGET = 'redshift'
+
+# Redshift-only DDL and functions, and their Postgres equivalents
+postgres_rewrites = [
+    (r'\bINTEGER\s+IDENTITY\(\s*\d+\s*,\s*\d+\s*\)',             'SERIAL'),
+    (r'\bBIGINT\s+IDENTITY\(\s*\d+\s*,\s*\d+\s*\)',              'BIGSERIAL'),
+    (r'\bVARCHAR\(\s*MAX\s*\)',                                   'VARCHAR'),
+    (r'\s*\b(?:COMPOUND\s+|INTERLEAVED\s+)?SORTKEY\s*\([^)]*\)',   ''),
+    (r'\s*\bDISTKEY\s*\([^)]*\)',                                 ''),
+    (r'\s*\bDISTSTYLE\s+\w+',                                     ''),
+    (r'\s+\b(?:SORTKEY|DISTKEY)\b',                                ''),
+    (r'\s+\bENCODE\s+\w+',                                        ''),
+    (r'\bGETDATE\(\s*\)',                                         'NOW()'),
+    (r'\bTRUNC\(\s*(\w+)\s*\)',                                   r'CAST( \1 AS DATE )'),
+    (r'\bDATE_PART\(\s*weekday\s*,',                               "DATE_PART('dow',"),
+    (r'\bDATE_PART\(\s*(\w+)\s*,',                                 r"DATE_PART('\1',")
+]
+
+
+def get_target(config):
+    """
+    Return the database the statements are rendered for, from [ETL] target:
+    'redshift' or 'postgres'.
+
+    """
+    target = config.get('ETL', 'TARGET', fallback = TARGET) or TARGET
+    if target not in ('redshift', 'postgres'):
+        raise ValueError("unknown [ETL] target [ {} ]".format(target))
+    return target
+
+
+def postgres_query(sql):
+    """
+    Return a Redshift statement rewritten for Postgres: no distribution or
+    sort keys and encodings, SERIAL for IDENTITY, VARCHAR for VARCHAR(MAX),
+    and the Postgres forms of GETDATE, TRUNC and DATE_PART.
+
+    """
+    for pattern, replacement in postgres_rewrites:
+        sql = re.sub(pattern, replacement, sql, flags = re.IGNORECASE)
+    return sql
+
+
+def target_query(sql, target):
+    """
+    Return the statement for the target database.
+
+    """
+    return postgres_query(sql) if target == 'postgres' else sql
 
 #------------------------------------------------------------------------------
 # DROP TABLES
@@ -15,6 +82,11 @@ user_table_drop           = "DROP TABLE IF EXISTS users"
 song_table_drop           = "DROP TABLE IF EXISTS songs"
 artist_table_drop         = "DROP TABLE IF EXISTS artists"
 time_table_drop           = "DROP TABLE IF EXISTS time"
+watermark_table_drop      = "DROP TABLE IF EXISTS etl_watermark"
+backfill_table_drop       = "DROP TABLE IF EXISTS etl_backfill"
+song_plays_daily_drop     = "DROP TABLE IF EXISTS song_plays_daily"
+user_plays_daily_drop     = "DROP TABLE IF EXISTS user_plays_daily"
+session_songs_drop        = "DROP TABLE IF EXISTS session_songs"
 
 #------------------------------------------------------------------------------
 # CREATE TABLES - STAGING
@@ -86,7 +158,9 @@ user_table_create = ("""
         u_first_name    VARCHAR(MAX)    NOT NULL,
         u_last_name     VARCHAR(MAX)    NOT NULL,
         u_gender        VARCHAR(8),
-        u_level         VARCHAR(8)      NOT NULL
+        u_level         VARCHAR(8)      NOT NULL,
+        u_ts            BIGINT,
+        u_row_hash      CHAR(32)
     )
     DISTSTYLE ALL;
 """)
@@ -98,7 +172,8 @@ song_table_create = ("""
         s_title         VARCHAR(MAX)    NOT NULL,
         s_artist_id     VARCHAR(22)     NOT NULL    DISTKEY,
         s_year          INTEGER,
-        s_duration      DOUBLE PRECISION
+        s_duration      DOUBLE PRECISION,
+        s_row_hash      CHAR(32)
     );
 """)
 
@@ -109,7 +184,8 @@ artist_table_create = ("""
         a_name          VARCHAR(MAX)    NOT NULL,
         a_location      VARCHAR(MAX),
         a_latitude      DOUBLE PRECISION,
-        a_longitude     DOUBLE PRECISION
+        a_longitude     DOUBLE PRECISION,
+        a_row_hash      CHAR(32)
     );
 """)
 
@@ -127,27 +203,170 @@ time_table_create = ("""
     DISTSTYLE AUTO;
 """)
 
+#------------------------------------------------------------------------------
+# CREATE TABLES - ETL CONTROL
+
+# high-water mark (staging_events.ts, in epoch ms) of the last incremental load
+watermark_table_create = ("""
+    CREATE TABLE IF NOT EXISTS etl_watermark
+    (
+        wm_table        VARCHAR(64)     NOT NULL    PRIMARY KEY,
+        wm_ts           BIGINT          NOT NULL,
+        wm_updated      TIMESTAMP       NOT NULL
+    )
+    DISTSTYLE ALL;
+""")
+
+# status of each day partition of a backfill (see backfill.py)
+backfill_table_create = ("""
+    CREATE TABLE IF NOT EXISTS etl_backfill
+    (
+        bf_day          DATE            NOT NULL    PRIMARY KEY,
+        bf_source       VARCHAR(512)    NOT NULL,
+        bf_status       VARCHAR(16)     NOT NULL,
+        bf_rows         INTEGER,
+        bf_seconds      FLOAT,
+        bf_error        VARCHAR(1024),
+        bf_updated      TIMESTAMP       NOT NULL
+    )
+    DISTSTYLE ALL;
+""")
+
+#------------------------------------------------------------------------------
+# CREATE TABLES - AGGREGATES (maintained by the ETL, read by the analytics queries)
+
+song_plays_daily_create = ("""
+    CREATE TABLE IF NOT EXISTS song_plays_daily
+    (
+        spd_day         DATE            NOT NULL    SORTKEY,
+        spd_song_id     VARCHAR(22)     NOT NULL,
+        spd_artist_id   VARCHAR(22)     NOT NULL,
+        spd_plays       BIGINT          NOT NULL
+    )
+    DISTSTYLE AUTO;
+""")
+
+user_plays_daily_create = ("""
+    CREATE TABLE IF NOT EXISTS user_plays_daily
+    (
+        upd_day         DATE            NOT NULL    SORTKEY,
+        upd_user_id     INTEGER         NOT NULL,
+        upd_level       VARCHAR(8)      NOT NULL,
+        upd_plays       BIGINT          NOT NULL
+    )
+    DISTSTYLE AUTO;
+""")
+
+session_songs_create = ("""
+    CREATE TABLE IF NOT EXISTS session_songs
+    (
+        ss_user_id      INTEGER         NOT NULL,
+        ss_level        VARCHAR(8)      NOT NULL,
+        ss_session_id   INTEGER         NOT NULL,
+        ss_day          DATE            NOT NULL,
+        ss_songs        BIGINT          NOT NULL
+    )
+    DISTSTYLE AUTO
+    SORTKEY( ss_user_id, ss_day );
+""")
+
 #------------------------------------------------------------------------------
 # STAGING TABLES
 
-staging_events_copy = ("""
-    COPY     staging_events
-    FROM     {}
-    IAM_ROLE {}
-    JSON     {}
-""").format(config['S3']['LOG_DATA'],
-            config['IAM_ROLE']['ARN'],
-            config['S3']['LOG_JSONPATH']
-           )
-
-staging_songs_copy = ("""
-    COPY     staging_songs
-    FROM     {}
-    IAM_ROLE {}
-    JSON     'auto'
-""").format(config['S3']['SONG_DATA'],
-            config['IAM_ROLE']['ARN']
-           )
+# COPY options from a config section - [COPY], or a named option set
+# [COPY:<name>] on top of it (see copy_options_section)
+staging_copy = ("""
+    COPY     {table}
+    FROM     {source}
+    IAM_ROLE {role}
+    JSON     {jsonpath}
+{options}""")
+
+
+def copy_options_section(config, name=None):
+    """
+    Return the COPY settings: the [COPY] section, overridden by the
+    [COPY:<name>] section when a name is given.
+
+    """
+    settings = dict(config['COPY']) if config.has_section('COPY') else {}
+    if name:
+        settings.update(config['COPY:{}'.format(name)])
+    return settings
+
+
+def copy_options(settings):
+    """
+    Return the COPY option lines for the settings, e.g. GZIP, COMPUPDATE OFF,
+    STATUPDATE OFF, MAXERROR 10, TRUNCATECOLUMNS, TIMEFORMAT 'auto'.
+
+    """
+    options = []
+
+    compression = settings.get('compression', '').strip().upper()
+    if compression and compression != 'NONE':
+        if compression not in ('GZIP', 'ZSTD', 'BZIP2'):
+            raise ValueError("unsupported COPY compression [ {} ]".format(compression))
+        options.append(compression)
+
+    for key in ['compupdate', 'statupdate']:
+        value = settings.get(key, '').strip().upper()
+        if value:
+            options.append('{} {}'.format(key.upper(), value))
+
+    if int(settings.get('maxerror') or 0):
+        options.append('MAXERROR {}'.format(int(settings['maxerror'])))
+
+    if settings.get('truncatecolumns', '').strip().lower() in ('true', 'on', 'yes', '1'):
+        options.append('TRUNCATECOLUMNS')
+
+    timeformat = settings.get('timeformat', '').strip().strip("'")
+    if timeformat:
+        options.append("TIMEFORMAT '{}'".format(timeformat))
+
+    return ''.join('    {}\n'.format(option) for option in options)
+
+
+def copy_query(config, table, name=None):
+    """
+    Return the COPY statement of one staging table for an option set; the
+    option set may also point at other input (e.g. a compressed copy) with
+    log_data and song_data.
+
+    """
+    settings = copy_options_section(config, name)
+
+    if table == 'staging_events':
+        source   = settings.get('log_data') or config['S3']['LOG_DATA']
+        jsonpath = config['S3']['LOG_JSONPATH']
+    else:
+        source   = settings.get('song_data') or config['S3']['SONG_DATA']
+        jsonpath = "'auto'"
+
+    return staging_copy.format(table    = table,
+                               source   = source,
+                               role     = config['IAM_ROLE']['ARN'],
+                               jsonpath = jsonpath,
+                               options  = copy_options(settings))
+
+
+def copy_queries(config, name=None):
+    """
+    Return the staging COPY statements for an option set.
+
+    """
+    return [copy_query(config, 'staging_events', name),
+            copy_query(config, 'staging_songs', name)]
+
+
+def etl_copy_query(table):
+    """
+    Return a function rendering the COPY statement of *table* from a config,
+    with the option set named by [ETL] copy_options.
+
+    """
+    return lambda config: copy_query(config, table,
+                                      config.get('ETL', 'COPY_OPTIONS', fallback = '') or None)
 
 #------------------------------------------------------------------------------
 # FINAL TABLES
@@ -177,58 +396,551 @@ songplay_table_insert = ("""
     )
 """)
 
-user_table_insert = ("""
-    INSERT INTO users
+# DIMENSION UPSERTS - the latest staging row per key, with an MD5 hash of its
+# attribute columns; rows whose hash is unchanged are not written, changed
+# rows are deleted and re-inserted, and new keys are inserted
+
+# {table: (key, attribute columns, hash column, version column or None,
+#          SELECT of key, attributes and version from {source})}
+dimension_tables = {
+    'users'   : ('u_user_id',
+                 ['u_first_name', 'u_last_name', 'u_gender', 'u_level'],
+                 'u_row_hash', 'u_ts',
+                 """
+                    SELECT  userId::INTEGER     AS u_user_id,
+                            firstName           AS u_first_name,
+                            lastName            AS u_last_name,
+                            gender              AS u_gender,
+                            level               AS u_level,
+                            ts                  AS version
+                    FROM    {source}
+                    WHERE   page = 'NextSong'  AND
+                            userId IS NOT NULL"""),
+    'songs'   : ('s_song_id',
+                 ['s_title', 's_artist_id', 's_year', 's_duration'],
+                 's_row_hash', None,
+                 """
+                    SELECT  song_id             AS s_song_id,
+                            title               AS s_title,
+                            artist_id           AS s_artist_id,
+                            year                AS s_year,
+                            duration            AS s_duration,
+                            0                   AS version
+                    FROM    {source}
+                    WHERE   song_id IS NOT NULL"""),
+    'artists' : ('a_artist_id',
+                 ['a_name', 'a_location', 'a_latitude', 'a_longitude'],
+                 'a_row_hash', None,
+                 """
+                    SELECT  artist_id           AS a_artist_id,
+                            artist_name         AS a_name,
+                            artist_location     AS a_location,
+                            artist_latitude     AS a_latitude,
+                            artist_longitude    AS a_longitude,
+                            0                   AS version
+                    FROM    {source}
+                    WHERE   artist_id IS NOT NULL""")
+}
+
+# one row per key: the highest version (ts of the user's latest event), ties
+# broken on the hash so that the choice is stable between runs
+dimension_latest = ("""
+        SELECT  *
+        FROM    ( SELECT  h.*,
+                          ROW_NUMBER() OVER ( PARTITION BY {key}
+                                              ORDER BY version DESC, row_hash ) AS row_rank
+                  FROM    ( SELECT  s.*,
+                                    MD5( {hash} )  AS row_hash
+                            FROM    ( {select} ) AS s ) AS h ) AS r
+        WHERE   row_rank = 1""")
+
+# delete the rows whose attributes changed (not for an older version) ...
+dimension_changed_delete = ("""
+    DELETE FROM {table}
+    WHERE       {key} IN ( SELECT  l.{key}
+                           FROM    ( {latest} ) AS l
+                           JOIN    {table} AS d
+                           ON      d.{key} = l.{key}
+                           WHERE   COALESCE( d.{hash_column}, '' ) <> l.row_hash{newer} );
+""")
+
+# ... and insert them again, with the keys that are new
+dimension_changed_insert = ("""
+    INSERT INTO {table}
     (
-        u_user_id, u_first_name, u_last_name, u_gender, u_level
+        {key}, {columns}, {hash_column}{version_column}
     )
-    SELECT  DISTINCT userId::INTEGER,
-            firstName, lastName, gender, level
-    FROM    staging_events
-    WHERE   page = 'NextSong' AND
-            userId IS NOT NULL
+    SELECT  l.{key}, {l_columns}, l.row_hash{l_version}
+    FROM    ( {latest} ) AS l
+    WHERE   NOT EXISTS ( SELECT  1
+                         FROM    {table} AS d
+                         WHERE   d.{key} = l.{key} );
 """)
 
-song_table_insert = ("""
-    INSERT INTO songs
+# a source already in the shape of the dimension - key, attributes and
+# version (e.g. rows built by the pandas engine, see transform.py)
+dimension_prepared_select = ("""
+                    SELECT  {key}, {columns}, version
+                    FROM    {{source}}""")
+
+dimension_load_create = ("""
+    CREATE TEMP TABLE {load} AS
+    SELECT  {key}, {columns}, {version} AS version
+    FROM    {table}
+    WHERE   1 = 0;
+""")
+
+dimension_load_drop = "DROP TABLE IF EXISTS {load}"
+
+
+def dimension_load_queries(table, load):
+    """
+    Return the (drop, create) of an empty temp table *load* in the prepared
+    shape of a dimension: key, attribute columns and version.
+
+    """
+    key, columns, hash_column, version_column, select = dimension_tables[table]
+    return (dimension_load_drop.format(load = load),
+            dimension_load_create.format(load    = load,
+                                         key     = key,
+                                         columns = ', '.join(columns),
+                                         version = version_column or '0::BIGINT',
+                                         table   = table))
+
+
+def dimension_upsert(table, source, prepared=False):
+    """
+    Return the upsert of a dimension table from a staging table (or, when
+    *prepared*, from a table with the key, attribute columns and version):
+    a DELETE of the changed rows and an INSERT of the changed and new ones,
+    as one string (one round trip, one transaction).
+
+    """
+    key, columns, hash_column, version_column, select = dimension_tables[table]
+    if prepared:
+        select = dimension_prepared_select.format(key = key, columns = ', '.join(columns))
+
+    latest = dimension_latest.format(
+        key    = key,
+        hash   = " || '|' || ".join("COALESCE( {}::VARCHAR, '' )".format(column)
+                                    for column in columns),
+        select = select.format(source = source))
+
+    params = dict(table          = table,
+                  key            = key,
+                  columns        = ', '.join(columns),
+                  l_columns      = ', '.join('l.' + column for column in columns),
+                  hash_column    = hash_column,
+                  version_column = ', ' + version_column if version_column else '',
+                  l_version      = ', l.version' if version_column else '',
+                  newer          = '  AND\n                                   '
+                                   'l.version >= COALESCE( d.{}, 0 )'.format(version_column)
+                                   if version_column else '',
+                  latest         = latest)
+
+    return dimension_changed_delete.format(**params) + dimension_changed_insert.format(**params)
+
+user_table_insert   = dimension_upsert('users', 'staging_events')
+song_table_insert   = dimension_upsert('songs', 'staging_songs')
+artist_table_insert = dimension_upsert('artists', 'staging_songs')
+
+time_table_insert = ("""
+    INSERT INTO time
     (
-        s_song_id, s_title, s_artist_id, s_year, s_duration
+        t_start_time, t_hour, t_day, t_week, t_month, t_year, t_weekday   
     )
-    SELECT  DISTINCT song_id,
-            title, artist_id, year, duration
-    FROM    staging_songs
-    WHERE   song_id IS NOT NULL;
+    (
+        SELECT  DISTINCT sp_start_time                  AS date,
+                DATE_PART(hour, sp_start_time)::INT     AS hour,
+                DATE_PART(day, sp_start_time)::INT      AS day,
+                DATE_PART(week, sp_start_time)::INT     AS week,
+                DATE_PART(month, sp_start_time)::INT    AS month,
+                DATE_PART(year, sp_start_time)::INT     AS year,
+                DATE_PART(weekday, sp_start_time)::INT  AS weekday
+        FROM    songplays
+    );
 """)
 
-artist_table_insert = ("""
-    INSERT INTO artists
+#------------------------------------------------------------------------------
+# FINAL TABLES - INCREMENTAL (watermark + staging merge)
+
+# new song plays since the last watermark, keyed on the natural event key
+# ( sp_start_time, sp_user_id, sp_session_id )
+songplay_new_create = ("""
+    CREATE TEMP TABLE songplays_new AS
     (
-        a_artist_id, a_name, a_location, a_latitude, a_longitude
+        WITH e  AS (
+                SELECT  *
+                FROM    staging_events
+                WHERE   page = 'NextSong'  AND
+                        ts > ( SELECT  COALESCE( MAX(wm_ts), 0 )
+                               FROM    etl_watermark
+                               WHERE   wm_table = 'songplays' )
+        )
+
+        SELECT  DISTINCT
+                e.ts,
+                TIMESTAMP 'epoch' + e.ts/1000 * INTERVAL '1 second'  AS sp_start_time,
+                e.userId::INTEGER       AS sp_user_id,
+                e.level                 AS sp_level,
+                s.song_id               AS sp_song_id,
+                s.artist_id             AS sp_artist_id,
+                e.sessionId             AS sp_session_id,
+                e.location              AS sp_location,
+                e.userAgent             AS sp_user_agent
+        FROM    e,
+                staging_songs AS s
+        WHERE   e.song = s.title  AND
+                e.artist = s.artist_name
+    );
+""")
+
+songplay_merge_delete = ("""
+    DELETE FROM songplays
+    USING       songplays_new AS n
+    WHERE       songplays.sp_start_time = n.sp_start_time  AND
+                songplays.sp_user_id    = n.sp_user_id     AND
+                songplays.sp_session_id = n.sp_session_id;
+""")
+
+songplay_merge_insert = ("""
+    INSERT INTO songplays
+    (
+        sp_start_time, sp_user_id, sp_level, sp_song_id, 
+        sp_artist_id, sp_session_id, sp_location, sp_user_agent
     )
-    SELECT  DISTINCT artist_id,
-            artist_name, artist_location,
-            artist_latitude, artist_longitude
-    FROM    staging_songs
-    WHERE   artist_id IS NOT NULL;
+    SELECT  sp_start_time, sp_user_id, sp_level, sp_song_id,
+            sp_artist_id, sp_session_id, sp_location, sp_user_agent
+    FROM    songplays_new;
 """)
 
-time_table_insert = ("""
+time_merge_insert = ("""
+    INSERT INTO time
+    (
+        t_start_time, t_hour, t_day, t_week, t_month, t_year, t_weekday   
+    )
+    (
+        SELECT  DISTINCT sp_start_time                  AS date,
+                DATE_PART(hour, sp_start_time)::INT     AS hour,
+                DATE_PART(day, sp_start_time)::INT      AS day,
+                DATE_PART(week, sp_start_time)::INT     AS week,
+                DATE_PART(month, sp_start_time)::INT    AS month,
+                DATE_PART(year, sp_start_time)::INT     AS year,
+                DATE_PART(weekday, sp_start_time)::INT  AS weekday
+        FROM    songplays_new
+        WHERE   sp_start_time NOT IN ( SELECT t_start_time FROM time )
+    );
+""")
+
+# only move the watermark when new song plays were merged
+watermark_merge_delete = ("""
+    DELETE FROM etl_watermark
+    WHERE       wm_table = 'songplays'  AND
+                EXISTS ( SELECT 1 FROM songplays_new );
+""")
+
+watermark_merge_insert = ("""
+    INSERT INTO etl_watermark ( wm_table, wm_ts, wm_updated )
+    SELECT      'songplays', MAX(ts), GETDATE()
+    FROM        songplays_new
+    HAVING      COUNT(*) > 0;
+""")
+
+# the new song plays whose event key is not in songplays yet - the rows this
+# run adds, from which the aggregates are updated
+songplay_added_create = ("""
+    CREATE TEMP TABLE songplays_added AS
+    (
+        SELECT  n.*
+        FROM    songplays_new AS n
+        WHERE   NOT EXISTS ( SELECT  1
+                             FROM    songplays AS sp
+                             WHERE   sp.sp_start_time = n.sp_start_time  AND
+                                     sp.sp_user_id    = n.sp_user_id     AND
+                                     sp.sp_session_id = n.sp_session_id )
+    );
+""")
+
+songplay_new_drop   = "DROP TABLE IF EXISTS songplays_new"
+songplay_added_drop = "DROP TABLE IF EXISTS songplays_added"
+
+#------------------------------------------------------------------------------
+# AGGREGATES - rebuilt from songplays after a full load, and updated from
+# songplays_added (only this run's rows) after an incremental load
+
+# {table: (columns, SELECT of the aggregate from a song play table, key match)}
+aggregate_tables = {
+    'song_plays_daily' : ('spd_day, spd_song_id, spd_artist_id, spd_plays',
+                          """
+            SELECT   TRUNC(sp_start_time)   AS day,
+                     sp_song_id             AS song_id,
+                     sp_artist_id           AS artist_id,
+                     COUNT(*)               AS plays
+            FROM     {}
+            GROUP BY 1, 2, 3
+""",
+                          'spd_day = d.day  AND  spd_song_id = d.song_id  AND  '
+                          'spd_artist_id = d.artist_id'),
+    'user_plays_daily' : ('upd_day, upd_user_id, upd_level, upd_plays',
+                          """
+            SELECT   TRUNC(sp_start_time)   AS day,
+                     sp_user_id             AS user_id,
+                     sp_level               AS level,
+                     COUNT(*)               AS plays
+            FROM     {}
+            GROUP BY 1, 2, 3
+""",
+                          'upd_day = d.day  AND  upd_user_id = d.user_id  AND  '
+                          'upd_level = d.level'),
+    'session_songs'    : ('ss_user_id, ss_level, ss_session_id, ss_day, ss_songs',
+                          """
+            SELECT   sp_user_id             AS user_id,
+                     sp_level               AS level,
+                     sp_session_id          AS session_id,
+                     TRUNC(sp_start_time)   AS day,
+                     COUNT(*)               AS plays
+            FROM     {}
+            GROUP BY 1, 2, 3, 4
+""",
+                          'ss_user_id = d.user_id  AND  ss_level = d.level  AND  '
+                          'ss_session_id = d.session_id  AND  ss_day = d.day')
+}
+
+aggregate_rebuild = ("""
+    INSERT INTO {table} ( {columns} )
+    {select}
+""")
+
+# add the plays of this run to the existing aggregate rows ...
+aggregate_update = ("""
+    UPDATE  {table}
+    SET     {plays} = {plays} + d.plays
+    FROM    ( {select} ) AS d
+    WHERE   {match};
+""")
+
+# ... and insert the aggregate rows that are new
+aggregate_insert_new = ("""
+    INSERT INTO {table} ( {columns} )
+    SELECT  d.*
+    FROM    ( {select} ) AS d
+    WHERE   NOT EXISTS ( SELECT 1 FROM {table} WHERE {match} );
+""")
+
+def aggregate_table_queries(table, source, rebuild):
+    """
+    Return the queries that rebuild one aggregate table from *source*, or
+    that add the plays in *source* to it.
+
+    """
+    columns, select, match = aggregate_tables[table]
+    params = dict(table = table, columns = columns, match = match,
+                  plays = columns.split(', ')[-1], select = select.format(source))
+    if rebuild:
+        return ["DELETE FROM {}".format(table), aggregate_rebuild.format(**params)]
+    return [aggregate_update.format(**params), aggregate_insert_new.format(**params)]
+
+
+def aggregate_queries(source, rebuild):
+    """
+    Return the queries of every aggregate table (aggregate_table_queries).
+
+    """
+    queries = []
+    for table in aggregate_tables:
+        queries += aggregate_table_queries(table, source, rebuild)
+    return queries
+
+aggregate_rebuild_queries     = aggregate_queries('songplays', rebuild = True)
+aggregate_incremental_queries = aggregate_queries('songplays_added', rebuild = False)
+
+#------------------------------------------------------------------------------
+# BACKFILL - one day partition of LOG_DATA at a time (see backfill.py)
+#
+# The partition is copied into a temp table of the session, and its song plays
+# are joined with staging_songs into another, so partitions load and transform
+# in parallel; only the replace of its day in songplays, time, users and the
+# aggregates runs under the lock on the shared tables, in one transaction.
+
+# INCLUDING DEFAULTS keeps the IDENTITY (SERIAL on Postgres) of event_key,
+# which the COPY of the 18 event columns leaves to the table
+partition_events_drop   = "DROP TABLE IF EXISTS staging_events_day"
+partition_events_create = "CREATE TEMP TABLE staging_events_day ( LIKE staging_events INCLUDING DEFAULTS )"
+
+partition_lock = ("""
+    LOCK songplays, users, time, song_plays_daily, user_plays_daily,
+         session_songs, etl_backfill
+""")
+
+partition_songplays_drop = "DROP TABLE IF EXISTS songplays_day"
+
+# only the events of the day itself, so that a re-run replaces exactly the
+# rows it deleted; staging_events_day also holds the file of the day before,
+# whose events after UTC midnight belong to this day
+partition_songplays_create = ("""
+    CREATE TEMP TABLE songplays_day AS
+    (
+        WITH e  AS (
+                SELECT  *
+                FROM    staging_events_day
+                WHERE   page = 'NextSong'  AND
+                        ts >= {start_ts}  AND
+                        ts <  {end_ts}
+        )
+
+        SELECT  DISTINCT
+                TIMESTAMP 'epoch' + e.ts/1000 * INTERVAL '1 second'  AS sp_start_time,
+                e.userId::INTEGER                                    AS sp_user_id,
+                e.level                                              AS sp_level,
+                s.song_id                                            AS sp_song_id,
+                s.artist_id                                          AS sp_artist_id,
+                e.sessionId                                          AS sp_session_id,
+                e.location                                           AS sp_location,
+                e.userAgent                                          AS sp_user_agent
+        FROM    e,
+                staging_songs AS s
+        WHERE   e.song = s.title  AND
+                e.artist = s.artist_name
+    );
+""")
+
+partition_songplay_delete = ("""
+    DELETE FROM songplays
+    WHERE       sp_start_time >= '{day}'  AND
+                sp_start_time <  '{next_day}';
+""")
+
+partition_songplay_insert = ("""
+    INSERT INTO songplays
+    (
+        sp_start_time, sp_user_id, sp_level, sp_song_id, 
+        sp_artist_id, sp_session_id, sp_location, sp_user_agent
+    )
+    SELECT  sp_start_time, sp_user_id, sp_level, sp_song_id,
+            sp_artist_id, sp_session_id, sp_location, sp_user_agent
+    FROM    songplays_day;
+""")
+
+partition_time_delete = ("""
+    DELETE FROM time
+    WHERE       t_start_time >= '{day}'  AND
+                t_start_time <  '{next_day}';
+""")
+
+partition_time_insert = ("""
     INSERT INTO time
     (
         t_start_time, t_hour, t_day, t_week, t_month, t_year, t_weekday   
     )
     (
-        SELECT  DISTINCT sp_start_time          AS date,
-                DATE_PART(hour, date)::INT      AS hour,
-                DATE_PART(day, date)::INT       AS day,
-                DATE_PART(week, date)::INT      AS week,
-                DATE_PART(month, date)::INT     AS month,
-                DATE_PART(year, date)::INT      AS year,
-                DATE_PART(weekday, date)::INT   AS weekday
+        SELECT  DISTINCT sp_start_time                  AS date,
+                DATE_PART(hour, sp_start_time)::INT     AS hour,
+                DATE_PART(day, sp_start_time)::INT      AS day,
+                DATE_PART(week, sp_start_time)::INT     AS week,
+                DATE_PART(month, sp_start_time)::INT    AS month,
+                DATE_PART(year, sp_start_time)::INT     AS year,
+                DATE_PART(weekday, sp_start_time)::INT  AS weekday
         FROM    songplays
+        WHERE   sp_start_time >= '{day}'  AND
+                sp_start_time <  '{next_day}'
     );
 """)
 
+partition_songplays = ("""( SELECT  *
+                       FROM    songplays
+                       WHERE   sp_start_time >= '{day}'  AND
+                               sp_start_time <  '{next_day}' ) AS sp""")
+
+partition_status_delete = ("""
+    DELETE FROM etl_backfill
+    WHERE       bf_day = %(day)s;
+""")
+
+partition_status_insert = ("""
+    INSERT INTO etl_backfill
+    (
+        bf_day, bf_source, bf_status, bf_rows, bf_seconds, bf_error, bf_updated
+    )
+    VALUES ( %(day)s, %(source)s, %(status)s, %(rows)s, %(seconds)s, %(error)s, %(updated)s );
+""")
+
+partition_status_select = ("""
+    SELECT   bf_day, bf_source, bf_status, bf_rows, bf_seconds, bf_error, bf_updated
+    FROM     etl_backfill
+    ORDER BY bf_day;
+""")
+
+def partition_copy_query(config, source, name=None):
+    """
+    Return the COPY of one log data partition (an S3 prefix such as
+    s3://udacity-dend/log_data/2018/11/2018-11-05) into staging_events_day,
+    with the options of the COPY option set.
+
+    """
+    return staging_copy.format(table    = 'staging_events_day',
+                               source   = "'{}'".format(source),
+                               role     = config['IAM_ROLE']['ARN'],
+                               jsonpath = config['S3']['LOG_JSONPATH'],
+                               options  = copy_options(copy_options_section(config, name)))
+
+
+def partition_transform_queries(start_ts, end_ts):
+    """
+    Return the queries that join the song plays of one day from
+    staging_events_day into the temp table songplays_day; they run before
+    *partition_lock*, so partitions transform in parallel.
+
+    Parameters:
+        start_ts, end_ts (int) : the day in epoch ms (staging_events.ts)
+
+    """
+    return [partition_songplays_drop,
+            partition_songplays_create.format(start_ts = start_ts, end_ts = end_ts)]
+
+
+def partition_queries(day, next_day):
+    """
+    Return the queries that replace one day in songplays, time, users and
+    the aggregate tables with the rows of songplays_day and
+    staging_events_day; run in order, in a single transaction, after
+    *partition_lock*.
+
+    Parameters:
+        day, next_day (datetime.date) : the day, and the day after it
+
+    """
+    params = dict(day = day.isoformat(), next_day = next_day.isoformat())
+
+    queries = [partition_songplay_delete.format(**params),
+               partition_songplay_insert.format(**params),
+               partition_time_delete.format(**params),
+               partition_time_insert.format(**params),
+               dimension_upsert('users', 'staging_events_day')]
+
+    source = partition_songplays.format(**params)
+    for table, (columns, select, match) in aggregate_tables.items():
+        day_column = [column for column in columns.split(', ') if column.endswith('_day')][0]
+        queries += ["DELETE FROM {} WHERE {} >= '{}' AND {} < '{}'"
+                    .format(table, day_column, params['day'], day_column, params['next_day']),
+                    aggregate_rebuild.format(table = table, columns = columns,
+                                             select = select.format(source))]
+    return queries
+
+#------------------------------------------------------------------------------
+# SHADOW LOAD - the analytics tables are built as <table>__shadow copies and
+# renamed into place in one transaction; the replaced tables are kept as
+# <table>__v<YYYYmmddHHMMSS> (see shadow.py)
+
+shadow_table_drop   = "DROP TABLE IF EXISTS {shadow}"
+shadow_table_create = "CREATE TABLE {shadow} ( LIKE {table} INCLUDING DEFAULTS )"
+shadow_table_rename = "ALTER TABLE {table} RENAME TO {name}"
+
+table_names_select = ("""
+    SELECT  tablename
+    FROM    pg_tables
+    WHERE   schemaname = current_schema();
+""")
+
 #------------------------------------------------------------------------------
 # COUNT TABLE ROWS
 
@@ -260,6 +972,119 @@ time_table_count = ("""
     SELECT COUNT(*) FROM time
 """)
 
+# fingerprint of a loaded staging table - checked before a resumed run
+# skips its load
+staging_fingerprint_queries = {
+    'staging_events' : ("""
+        SELECT  COUNT(*), COALESCE( SUM(ts), 0 ), COALESCE( MAX(ts), 0 )
+        FROM    staging_events
+    """),
+    'staging_songs'  : ("""
+        SELECT  COUNT(*), COUNT( DISTINCT song_id ), COALESCE( MAX(song_id), '' )
+        FROM    staging_songs
+    """)
+}
+
+#------------------------------------------------------------------------------
+# DATA QUALITY - all counts, null counts, orphan keys and duplicate keys in
+# one round trip, scanning each table once
+
+data_quality_query = ("""
+    WITH se AS (
+            SELECT  COUNT(*)                                             AS rows,
+                    SUM( CASE WHEN page = 'NextSong' THEN 1 ELSE 0 END ) AS next_song,
+                    SUM( CASE WHEN page = 'NextSong' AND
+                                   NULLIF(userId, '') IS NULL
+                              THEN 1 ELSE 0 END )                        AS null_user_id
+            FROM    staging_events
+        ),
+        ss AS (
+            SELECT  COUNT(*)                    AS rows,
+                    COUNT(*) - COUNT(song_id)   AS null_song_id,
+                    COUNT(*) - COUNT(artist_id) AS null_artist_id
+            FROM    staging_songs
+        ),
+        sp AS (
+            SELECT  COUNT(*)                                AS rows,
+                    COUNT(*) - COUNT(p.sp_location)         AS null_location,
+                    COUNT(*) - COUNT(p.sp_user_agent)       AS null_user_agent,
+                    COUNT(*) - COUNT(DISTINCT p.sp_start_time::VARCHAR || '|' ||
+                                              p.sp_user_id::VARCHAR    || '|' ||
+                                              p.sp_session_id::VARCHAR)   AS duplicate_keys,
+                    SUM( CASE WHEN s.k IS NULL THEN 1 ELSE 0 END )  AS orphan_songs,
+                    SUM( CASE WHEN a.k IS NULL THEN 1 ELSE 0 END )  AS orphan_artists,
+                    SUM( CASE WHEN u.k IS NULL THEN 1 ELSE 0 END )  AS orphan_users,
+                    SUM( CASE WHEN t.k IS NULL THEN 1 ELSE 0 END )  AS orphan_time
+            FROM    songplays AS p
+            LEFT JOIN ( SELECT DISTINCT s_song_id    AS k FROM songs   ) AS s
+                   ON p.sp_song_id    = s.k
+            LEFT JOIN ( SELECT DISTINCT a_artist_id  AS k FROM artists ) AS a
+                   ON p.sp_artist_id  = a.k
+            LEFT JOIN ( SELECT DISTINCT u_user_id    AS k FROM users   ) AS u
+                   ON p.sp_user_id    = u.k
+            LEFT JOIN ( SELECT DISTINCT t_start_time AS k FROM time    ) AS t
+                   ON p.sp_start_time = t.k
+        ),
+        u AS (
+            SELECT  COUNT(*)                                AS rows,
+                    COUNT(*) - COUNT(DISTINCT u_user_id)    AS duplicate_keys,
+                    COUNT(*) - COUNT(u_gender)              AS null_gender
+            FROM    users
+        ),
+        s AS (
+            SELECT  COUNT(*)                                AS rows,
+                    COUNT(*) - COUNT(DISTINCT s_song_id)    AS duplicate_keys,
+                    COUNT(*) - COUNT(s_duration)            AS null_duration
+            FROM    songs
+        ),
+        a AS (
+            SELECT  COUNT(*)                                AS rows,
+                    COUNT(*) - COUNT(DISTINCT a_artist_id)  AS duplicate_keys,
+                    COUNT(*) - COUNT(a_latitude)            AS null_latitude
+            FROM    artists
+        ),
+        t AS (
+            SELECT  COUNT(*)                                AS rows,
+                    COUNT(*) - COUNT(DISTINCT t_start_time) AS duplicate_keys
+            FROM    time
+        ),
+        ag AS (
+            SELECT  ( SELECT COALESCE( SUM(spd_plays), 0 ) FROM song_plays_daily ) AS song_plays_daily,
+                    ( SELECT COALESCE( SUM(upd_plays), 0 ) FROM user_plays_daily ) AS user_plays_daily,
+                    ( SELECT COALESCE( SUM(ss_songs), 0 )  FROM session_songs )    AS session_songs
+        )
+
+    SELECT  se.rows             AS staging_events__rows,
+            se.next_song        AS staging_events__next_song,
+            se.null_user_id     AS staging_events__null_user_id,
+            ss.rows             AS staging_songs__rows,
+            ss.null_song_id     AS staging_songs__null_song_id,
+            ss.null_artist_id   AS staging_songs__null_artist_id,
+            sp.rows             AS songplays__rows,
+            sp.null_location    AS songplays__null_location,
+            sp.null_user_agent  AS songplays__null_user_agent,
+            sp.duplicate_keys   AS songplays__duplicate_keys,
+            sp.orphan_songs     AS songplays__orphan_songs,
+            sp.orphan_artists   AS songplays__orphan_artists,
+            sp.orphan_users     AS songplays__orphan_users,
+            sp.orphan_time      AS songplays__orphan_time,
+            u.rows              AS users__rows,
+            u.duplicate_keys    AS users__duplicate_keys,
+            u.null_gender       AS users__null_gender,
+            s.rows              AS songs__rows,
+            s.duplicate_keys    AS songs__duplicate_keys,
+            s.null_duration     AS songs__null_duration,
+            a.rows              AS artists__rows,
+            a.duplicate_keys    AS artists__duplicate_keys,
+            a.null_latitude     AS artists__null_latitude,
+            t.rows              AS time__rows,
+            t.duplicate_keys    AS time__duplicate_keys,
+            ag.song_plays_daily AS aggregates__song_plays_daily,
+            ag.user_plays_daily AS aggregates__user_plays_daily,
+            ag.session_songs    AS aggregates__session_songs
+    FROM    se, ss, sp, u, s, a, t, ag;
+""")
+
 #------------------------------------------------------------------------------
 # SAMPLE QUERIES
 
@@ -287,8 +1112,7 @@ top_10_users = ("""
              SELECT sp_songplay_id, u_first_name, u_last_name, u_user_id
              FROM   songplays
              JOIN   users
-             ON     sp_user_id  = u_user_id  AND
-                    sp_level    = u_level
+             ON     sp_user_id  = u_user_id
         )
 
     SELECT   DISTINCT( u_first_name || ' ' || u_last_name ) AS "user name",
@@ -305,8 +1129,7 @@ top_user_id = ("""
             SELECT  sp_session_id, u_user_id
             FROM    songplays
             JOIN    users
-            ON      sp_user_id = u_user_id  AND
-                    sp_level   = u_level
+            ON      sp_user_id = u_user_id
         ),
         session_counts AS (
             SELECT   u_user_id,
@@ -338,8 +1161,7 @@ top_5_sessions_top_user_49 = ("""
                     sp_session_id, sp_start_time, s_title
             FROM    songplays_user
             JOIN    users
-            ON      sp_user_id  = u_user_id  AND
-                    sp_level    = u_level
+            ON      sp_user_id  = u_user_id
             JOIN    songs
             ON      sp_song_id  = s_song_id
         )
@@ -358,35 +1180,365 @@ top_5_sessions_top_user_49 = ("""
 """)
 
 #------------------------------------------------------------------------------
-# QUERY LISTS - SETUP TABLES
-
-create_table_queries = [staging_events_table_create, 
-                        staging_songs_table_create, 
-                        songplay_table_create, 
-                        user_table_create, 
-                        song_table_create, 
-                        artist_table_create, 
-                        time_table_create
-                       ]
-drop_table_queries = [staging_events_table_drop, 
-                      staging_songs_table_drop, 
-                      songplay_table_drop,
-                      user_table_drop, 
-                      song_table_drop, 
-                      artist_table_drop, 
-                      time_table_drop
-                     ]
-
-copy_table_queries = [staging_events_copy, 
-                      staging_songs_copy
-                     ]
-
-insert_table_queries = [songplay_table_insert, 
-                        user_table_insert,
-                        song_table_insert, 
-                        artist_table_insert, 
-                        time_table_insert
-                       ]
+# PARAMETERIZED ANALYTICS QUERIES - bind parameters (psycopg2 pyformat):
+#     %(start)s, %(end)s   date range on the song play day; NULL for no bound
+#     %(limit)s            number of rows
+#     %(user_id)s          user
+
+# restrict songplays to the date range
+songplays_in_range = ("""
+             SELECT *
+             FROM   songplays
+             WHERE  ( %(start)s::TIMESTAMP IS NULL OR sp_start_time >= %(start)s::TIMESTAMP )  AND
+                    ( %(end)s::TIMESTAMP   IS NULL OR sp_start_time <  %(end)s::TIMESTAMP )
+""")
+
+# the same date range on a DATE column of an aggregate table
+day_in_range = ("""( %(start)s::DATE IS NULL OR {0} >= %(start)s::DATE )  AND
+                      ( %(end)s::DATE   IS NULL OR {0} <  %(end)s::DATE )""")
+
+# top_songs, top_users and user_sessions read from the aggregate tables, so
+# their cost does not grow with songplays
+top_songs = ("""
+    WITH song_plays AS (
+             SELECT   spd_song_id, spd_artist_id,
+                      SUM(spd_plays)    AS plays
+             FROM     song_plays_daily
+             WHERE    """ + day_in_range.format('spd_day') + """
+             GROUP BY spd_song_id, spd_artist_id
+    )
+
+    SELECT   s_title        AS "song title",
+             a_name         AS "artist name",
+             SUM(plays)     AS count
+    FROM     song_plays
+    JOIN     songs
+    ON       spd_song_id   = s_song_id
+    JOIN     artists
+    ON       spd_artist_id = a_artist_id
+    GROUP BY s_title, a_name
+    ORDER BY count DESC, s_title, a_name
+    LIMIT    %(limit)s;
+""")
+
+top_users = ("""
+    WITH user_plays AS (
+             SELECT   upd_user_id, upd_level,
+                      SUM(upd_plays)    AS plays
+             FROM     user_plays_daily
+             WHERE    """ + day_in_range.format('upd_day') + """
+             GROUP BY upd_user_id, upd_level
+        )
+
+    SELECT   DISTINCT( u_first_name || ' ' || u_last_name ) AS "user name",
+             u_user_id                                      AS "user ID",
+             SUM(plays)                                     AS "song count"
+    FROM     user_plays
+    JOIN     users
+    ON       upd_user_id = u_user_id
+    GROUP BY "user ID", "user name"
+    ORDER BY "song count" DESC, "user name"
+    LIMIT    %(limit)s;
+""")
+
+user_sessions = ("""
+    WITH sessions_user AS (
+            SELECT  *
+            FROM    session_songs
+            WHERE   ss_user_id  = %(user_id)s  AND
+                    """ + day_in_range.format('ss_day') + """
+        )
+
+    SELECT   (u_first_name || ' ' || u_last_name)   AS "user name",
+             ss_session_id                          AS "session ID",
+             (DATE_PART('year', 
+                        ss_day) || '-' || DATE_PART('month', 
+                        ss_day) || '-' || DATE_PART('day', 
+                        ss_day))                    AS date,
+             SUM(ss_songs)                          AS "song count"
+    FROM     sessions_user
+    JOIN     users
+    ON       ss_user_id  = u_user_id
+    GROUP BY ss_session_id, date, "user name"
+    ORDER BY "song count" DESC, date
+""")
+
+top_sessions_for_user = user_sessions + """    LIMIT    %(limit)s;
+"""
+
+# the users with the most sessions - top_user_id with a limit and date range
+top_session_users = ("""
+    WITH user_session_counts AS (
+             SELECT   ss_user_id,
+                      COUNT( DISTINCT ss_session_id )   AS sessions
+             FROM     session_songs
+             WHERE    """ + day_in_range.format('ss_day') + """
+             GROUP BY ss_user_id
+        )
+
+    SELECT   (u_first_name || ' ' || u_last_name)   AS "user name",
+             u_user_id                              AS "user ID",
+             sessions                               AS "session count"
+    FROM     user_session_counts
+    JOIN     users
+    ON       ss_user_id = u_user_id
+    ORDER BY "session count" DESC, "user ID"
+    LIMIT    %(limit)s;
+""")
+
+# the songs a user played most
+top_songs_for_user = ("""
+    SELECT   s_title        AS "song title",
+             a_name         AS "artist name",
+             COUNT(*)       AS count
+    FROM     ( """ + songplays_in_range + """ ) AS sp
+    JOIN     songs
+    ON       sp_song_id   = s_song_id
+    JOIN     artists
+    ON       sp_artist_id = a_artist_id
+    WHERE    sp_user_id   = %(user_id)s
+    GROUP BY s_title, a_name
+    ORDER BY count DESC, s_title, a_name
+    LIMIT    %(limit)s;
+""")
+
+# every song play of a user, for a full-history export
+user_songplays_export = ("""
+    SELECT   sp_start_time, sp_session_id, sp_level,
+             s_title, a_name, sp_location, sp_user_agent
+    FROM     ( """ + songplays_in_range + """ ) AS sp
+    JOIN     songs
+    ON       sp_song_id   = s_song_id
+    JOIN     artists
+    ON       sp_artist_id = a_artist_id
+    WHERE    sp_user_id   = %(user_id)s
+    ORDER BY sp_start_time;
+""")
+
+#------------------------------------------------------------------------------
+# QUERY REGISTRY - every statement an ETL stage runs, with the table it
+# writes to (or counts), its stage and the tables it reads from. Statements
+# that depend on the config (the COPY statements) are rendered from dwh.cfg
+# when first used.
+
+class Query:
+    """
+    A registered statement and its metadata.
+
+    Parameters:
+        name (str) : name of the statement, e.g. 'songplay_table_insert'
+        table (str) : table the statement writes to (or counts)
+        stage (str) : ETL stage that runs it, e.g. 'insert_tables'
+        sql (str or function) : the statement, or a function that renders it
+                                from a config file object
+        deps (list) : tables the statement reads from
+
+    """
+
+    def __init__(self, name, table, stage, sql, deps=()):
+        self.name     = name
+        self.table    = table
+        self.stage    = stage
+        self.deps     = list(deps)
+        self.template = sql
+        self.rendered = None
+
+    @property
+    def sql(self):
+        """
+        The statement for the target database; rendered from dwh.cfg
+        (get_config) on first use.
+
+        """
+        if self.rendered is None:
+            self.rendered = self.render(get_config()).rendered
+        return self.rendered
+
+    def render(self, config):
+        """
+        Return a copy of the query rendered from *config*, for its target.
+
+        """
+        sql = self.template(config) if callable(self.template) else self.template
+        return self.with_sql(target_query(sql, get_target(config)))
+
+    def with_sql(self, sql):
+        """
+        Return a copy of the query with another, final statement, e.g.
+        rewritten with the column types of a schema profile.
+
+        """
+        query = Query(self.name, self.table, self.stage, sql, self.deps)
+        query.rendered = sql
+        return query
+
+    def __repr__(self):
+        return 'Query({}, table={}, stage={})'.format(self.name, self.table, self.stage)
+
+
+# {name: Query}, in the order the statements run within a stage
+QUERIES = {}
+
+
+def register(name, table, stage, sql, deps=()):
+    """
+    Add a statement to the registry.
+
+    Returns:
+        query (Query) : the registered statement
+
+    """
+    query = Query(name, table, stage, sql, deps)
+    QUERIES[name] = query
+    return query
+
+
+def get_query(name):
+    return QUERIES[name]
+
+
+def stage_queries(stage):
+    """
+    Return the registered queries of a stage, in the order they run.
+
+    """
+    return [query for query in QUERIES.values() if query.stage == stage]
+
+
+def query_graph(stage):
+    """
+    Return the dependency graph of a stage - {table: (query, [tables of the
+    stage it reads from])}; tables loaded by an earlier stage (e.g. staging)
+    are not dependencies within the stage.
+
+    """
+    queries = stage_queries(stage)
+    tables = {query.table for query in queries}
+    return {query.table: (query, [dep for dep in query.deps if dep in tables])
+            for query in queries}
+
+
+# SETUP TABLES
+register('staging_events_table_drop',  'staging_events',   'drop_tables', staging_events_table_drop)
+register('staging_songs_table_drop',   'staging_songs',    'drop_tables', staging_songs_table_drop)
+register('songplay_table_drop',        'songplays',        'drop_tables', songplay_table_drop)
+register('user_table_drop',            'users',            'drop_tables', user_table_drop)
+register('song_table_drop',            'songs',            'drop_tables', song_table_drop)
+register('artist_table_drop',          'artists',          'drop_tables', artist_table_drop)
+register('time_table_drop',            'time',             'drop_tables', time_table_drop)
+register('watermark_table_drop',       'etl_watermark',    'drop_tables', watermark_table_drop)
+register('backfill_table_drop',        'etl_backfill',     'drop_tables', backfill_table_drop)
+register('song_plays_daily_drop',      'song_plays_daily', 'drop_tables', song_plays_daily_drop)
+register('user_plays_daily_drop',      'user_plays_daily', 'drop_tables', user_plays_daily_drop)
+register('session_songs_drop',         'session_songs',    'drop_tables', session_songs_drop)
+
+register('staging_events_table_create', 'staging_events',   'create_tables', staging_events_table_create)
+register('staging_songs_table_create',  'staging_songs',    'create_tables', staging_songs_table_create)
+register('songplay_table_create',       'songplays',        'create_tables', songplay_table_create)
+register('user_table_create',           'users',            'create_tables', user_table_create)
+register('song_table_create',           'songs',            'create_tables', song_table_create)
+register('artist_table_create',         'artists',          'create_tables', artist_table_create)
+register('time_table_create',           'time',             'create_tables', time_table_create)
+register('watermark_table_create',      'etl_watermark',    'create_tables', watermark_table_create)
+register('backfill_table_create',       'etl_backfill',     'create_tables', backfill_table_create)
+register('song_plays_daily_create',     'song_plays_daily', 'create_tables', song_plays_daily_create)
+register('user_plays_daily_create',     'user_plays_daily', 'create_tables', user_plays_daily_create)
+register('session_songs_create',        'session_songs',    'create_tables', session_songs_create)
+
+# STAGING - [ETL] copy_options picks the COPY option set
+register('staging_events_copy', 'staging_events', 'load_staging_tables',
+         etl_copy_query('staging_events'))
+register('staging_songs_copy',  'staging_songs',  'load_staging_tables',
+         etl_copy_query('staging_songs'))
+
+# FINAL TABLES - only the time table depends on another analytics table
+register('songplay_table_insert', 'songplays', 'insert_tables', songplay_table_insert,
+         ['staging_events', 'staging_songs'])
+register('user_table_insert',     'users',     'insert_tables', user_table_insert,
+         ['staging_events'])
+register('song_table_insert',     'songs',     'insert_tables', song_table_insert,
+         ['staging_songs'])
+register('artist_table_insert',   'artists',   'insert_tables', artist_table_insert,
+         ['staging_songs'])
+register('time_table_insert',     'time',      'insert_tables', time_table_insert,
+         ['songplays'])
+
+# AGGREGATES - rebuilt from songplays after a full load
+for table in aggregate_tables:
+    delete, rebuild = aggregate_table_queries(table, 'songplays', rebuild = True)
+    register(table + '_delete',  table, 'aggregates', delete)
+    register(table + '_rebuild', table, 'aggregates', rebuild, ['songplays'])
+
+# FINAL TABLES - INCREMENTAL; run in order, in a single transaction; the
+# dimension inserts are not part of the merge
+register('songplay_new_drop',     'songplays_new',   'insert_tables_incremental', songplay_new_drop)
+register('songplay_added_drop',   'songplays_added', 'insert_tables_incremental', songplay_added_drop)
+register('songplay_new_create',   'songplays_new',   'insert_tables_incremental', songplay_new_create,
+         ['staging_events', 'staging_songs', 'etl_watermark'])
+register('songplay_added_create', 'songplays_added', 'insert_tables_incremental',
+         songplay_added_create, ['songplays_new', 'songplays'])
+register('songplay_merge_delete', 'songplays',       'insert_tables_incremental',
+         songplay_merge_delete, ['songplays_new'])
+register('songplay_merge_insert', 'songplays',       'insert_tables_incremental',
+         songplay_merge_insert, ['songplays_new'])
+register('time_merge_insert',     'time',            'insert_tables_incremental', time_merge_insert,
+         ['songplays_new'])
+for table in aggregate_tables:
+    update, insert = aggregate_table_queries(table, 'songplays_added', rebuild = False)
+    register(table + '_update',     table, 'insert_tables_incremental', update, ['songplays_added'])
+    register(table + '_insert_new', table, 'insert_tables_incremental', insert, ['songplays_added'])
+register('watermark_merge_delete', 'etl_watermark',   'insert_tables_incremental',
+         watermark_merge_delete, ['songplays_new'])
+register('watermark_merge_insert', 'etl_watermark',   'insert_tables_incremental',
+         watermark_merge_insert, ['songplays_new'])
+register('songplay_new_cleanup',   'songplays_new',   'insert_tables_incremental', songplay_new_drop)
+register('songplay_added_cleanup', 'songplays_added', 'insert_tables_incremental',
+         songplay_added_drop)
+
+# COUNT TABLE ROWS
+register('staging_events_table_count', 'staging_events', 'count_table_rows',
+         staging_events_table_count)
+register('staging_songs_table_count',  'staging_songs',  'count_table_rows',
+         staging_songs_table_count)
+register('songplay_table_count',       'songplays',      'count_table_rows', songplay_table_count)
+register('user_table_count',           'users',          'count_table_rows', user_table_count)
+register('song_table_count',           'songs',          'count_table_rows', song_table_count)
+register('artist_table_count',         'artists',        'count_table_rows', artist_table_count)
+register('time_table_count',           'time',           'count_table_rows', time_table_count)
+
+#------------------------------------------------------------------------------
+# QUERY LISTS - the Redshift statements of the registry, for the notebooks
+# and tools that take plain SQL; copy_table_queries is rendered from dwh.cfg
+# on first access (see __getattr__)
+
+create_table_queries = [query.template for query in stage_queries('create_tables')]
+drop_table_queries   = [query.template for query in stage_queries('drop_tables')]
+insert_table_queries = [query.template for query in stage_queries('insert_tables')]
+
+# dependency graph of the inserts - {table: (query, [tables it reads from])}
+insert_table_graph = query_graph('insert_tables')
+
+incremental_insert_queries    = [query.template for query in stage_queries('insert_tables_incremental')]
+incremental_dimension_queries = [query.template for query in stage_queries('insert_tables')
+                                 if query.table in dimension_tables]
+
+
+def __getattr__(name):
+    """
+    Render the COPY statements from dwh.cfg when first accessed, e.g.
+    'from sql_queries import copy_table_queries'.
+
+    """
+    if name == 'copy_table_queries':
+        return [query.sql for query in stage_queries('load_staging_tables')]
+    if name in ('staging_events_copy', 'staging_songs_copy'):
+        return get_query(name).sql
+    raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
+
+# tables built by a shadow load, and swapped in together
+shadow_tables = ['songplays', 'users', 'songs', 'artists', 'time',
+                 'song_plays_daily', 'user_plays_daily', 'session_songs'
+                ]
 
 #------------------------------------------------------------------------------
 # QUERY LISTS - SETUP - dimensional tables only; leaves staging tables alone
@@ -407,17 +1559,29 @@ drop_db_table_queries  = [songplay_table_drop,
 #------------------------------------------------------------------------------
 # QUERY LISTS - ANALYTICS
 
-count_table_queries = [staging_events_table_count, 
-                       staging_songs_table_count, 
-                       songplay_table_count, 
-                       user_table_count, 
-                       song_table_count, 
-                       artist_table_count, 
-                       time_table_count
-                      ]
+count_table_queries = [query.template for query in stage_queries('count_table_rows')]
 
 sample_queries = [top_10_songs,
                   top_10_users,
                   top_user_id,
                   top_5_sessions_top_user_49
                  ]
+
+# parameterized analytics queries - {name: (query, default parameters)}
+analytics_queries = {'top_songs'             : (top_songs,
+                                                {'start': None, 'end': None, 'limit': 10}),
+                     'top_users'             : (top_users,
+                                                {'start': None, 'end': None, 'limit': 10}),
+                     'top_session_users'     : (top_session_users,
+                                                {'start': None, 'end': None, 'limit': 10}),
+                     'top_sessions_for_user' : (top_sessions_for_user,
+                                                {'start': None, 'end': None, 'limit': 5,
+                                                 'user_id': None}),
+                     'top_songs_for_user'    : (top_songs_for_user,
+                                                {'start': None, 'end': None, 'limit': 10,
+                                                 'user_id': None}),
+                     'user_sessions'         : (user_sessions,
+                                                {'start': None, 'end': None, 'user_id': None}),
+                     'user_songplays'        : (user_songplays_export,
+                                                {'start': None, 'end': None, 'user_id': None})
+                    }
@@ -0,0 +1,388 @@
+import argparse
+import configparser
+import json
+import re
+from decimal import Decimal
+import psycopg2
+import mylib
+from mylib import logger
+import db
+from sql_queries import sample_queries, stage_queries
+
+# ---------------------------------------------------------------------------------
+# Table design advisor: recommend distribution and sort keys for the analytics
+# tables from the table stats (svv_table_info) and the join / filter columns of
+# the sample queries, and emit DDL in the style of sql_queries.py
+#
+#     python table_advisor.py                       # live stats from the cluster
+#     python table_advisor.py --capture stats.json  # ... and save them
+#     python table_advisor.py --stats stats.json    # offline, from saved stats
+#     python table_advisor.py --apply               # run the ALTER statements
+# ---------------------------------------------------------------------------------
+
+
+table_info_query = ("""
+    SELECT  "table", diststyle, sortkey1, size, tbl_rows,
+            skew_rows, unsorted
+    FROM    svv_table_info
+    WHERE   schema = 'public';
+""")
+
+# the analytics tables the advice is for
+ANALYTICS_TABLES = ['songplays', 'users', 'songs', 'artists', 'time']
+
+# tables with fewer rows are copied to every node
+SMALL_TABLE_ROWS = 1000000
+# row skew (largest slice / smallest slice) above which a DISTKEY is rejected
+MAX_SKEW_ROWS    = 4.0
+# unsorted percent above which the table needs a VACUUM SORT
+MAX_UNSORTED     = 20.0
+
+
+def create_queries():
+    """
+    Return the registered CREATE TABLE queries of the analytics tables.
+
+    """
+    return [query for query in stage_queries('create_tables')
+            if query.table in ANALYTICS_TABLES]
+
+
+def parse_create(query, sql=None):
+    """
+    Split a registered CREATE TABLE query from sql_queries.py into its parts;
+    the table name is the one it is registered with.
+
+    Parameters:
+        query (Query) : CREATE TABLE query of the registry
+        sql (str) : the statement to split, e.g. rendered for the target;
+                    defaults to the query template
+
+    Returns:
+        (table, columns, lines) : table name, column names in order, and the
+                                  column definition lines
+
+    """
+    sql = query.template if sql is None else sql
+
+    # the column list runs to the parenthesis that closes the first one
+    start = sql.index('(')
+    depth = 0
+    for end in range(start, len(sql)):
+        depth += {'(': 1, ')': -1}.get(sql[end], 0)
+        if depth == 0:
+            break
+    body = sql[start + 1:end]
+    lines = [line.rstrip().rstrip(',') for line in body.split('\n') if line.strip()]
+    columns = [line.split()[0] for line in lines]
+
+    return query.table, columns, lines
+
+
+def table_columns():
+    """
+    Return {column: table} for the analytics tables.
+
+    """
+    owner = {}
+    for query in create_queries():
+        table, columns, lines = parse_create(query)
+        for column in columns:
+            owner[column] = table
+    return owner
+
+
+def column_usage(queries):
+    """
+    Count how the analytics columns are used by the queries.
+
+    Parameters:
+        queries (list) : SQL text of the queries
+
+    Returns:
+        (joins, filters) : {(column, column): uses} for equi-join pairs, and
+                           {column: uses} for columns compared to a constant
+                           or used in a date range
+
+    """
+    owner = table_columns()
+    joins = {}
+    filters = {}
+
+    for query in queries:
+        for left, right in re.findall(r'\b(\w+)\s*=\s*(\w+)\b', query):
+            if left in owner and right in owner and owner[left] != owner[right]:
+                pair = tuple(sorted([left, right]))
+                joins[pair] = joins.get(pair, 0) + 1
+            elif left in owner and right not in owner:
+                filters[left] = filters.get(left, 0) + 1
+
+        # date parts of a column are range filters on it
+        for column in re.findall(r'DATE_PART\(\s*\'?\w+\'?,\s*(\w+)', query):
+            if column in owner:
+                filters[column] = filters.get(column, 0) + 1
+
+    return joins, filters
+
+
+def recommend(stats, joins, filters, small_table_rows=SMALL_TABLE_ROWS,
+              max_skew_rows=MAX_SKEW_ROWS, max_unsorted=MAX_UNSORTED):
+    """
+    Recommend a distribution style, distribution key and sort key per table.
+
+    Parameters:
+        stats (dict) : {table: svv_table_info row}
+        joins (dict) : equi-join column pairs and their use counts
+        filters (dict) : filter / group / order columns and their use counts
+
+    Returns:
+        advice (dict) : {table: {'diststyle', 'distkey', 'sortkey', 'notes'}}
+
+    """
+    owner = table_columns()
+    queries = {query.table: query for query in create_queries()}
+    tables = sorted(queries)
+    rows = {table: int(stats.get(table, {}).get('tbl_rows') or 0) for table in tables}
+
+    # the fact table is the largest table with join columns to the others
+    fact = max(tables, key = lambda table: (rows[table], table == 'songplays'))
+
+    advice = {table: {'diststyle': 'ALL', 'distkey': None, 'sortkey': [], 'notes': []}
+              for table in tables}
+
+    # the largest dimension joined to the fact table is co-located with it
+    best = None
+    for (left, right), uses in joins.items():
+        fact_col, dim_col = (left, right) if owner[left] == fact else (right, left)
+        if owner[fact_col] != fact:
+            continue
+        dim = owner[dim_col]
+        if rows[dim] < small_table_rows:
+            continue
+        key = (rows[dim], uses)
+        if best is None or key > best[0]:
+            best = (key, fact_col, dim_col)
+
+    if best:
+        key, fact_col, dim_col = best
+        advice[fact].update(diststyle = 'KEY', distkey = fact_col)
+        advice[owner[dim_col]].update(diststyle = 'KEY', distkey = dim_col)
+        advice[fact]['notes'].append('co-located with {} on {}'.format(owner[dim_col], dim_col))
+    else:
+        advice[fact]['diststyle'] = 'EVEN'
+        advice[fact]['notes'].append('no dimension is large enough to co-locate with')
+
+    for table in tables:
+        info = stats.get(table, {})
+        table_advice = advice[table]
+
+        if table != fact and table_advice['diststyle'] != 'KEY':
+            if rows[table] < small_table_rows:
+                table_advice['notes'].append('{} rows, small enough to copy to every node'
+                                             .format(rows[table]))
+            else:
+                table_advice['diststyle'] = 'EVEN'
+
+        skew = float(info.get('skew_rows') or 0)
+        current_dist = str(info.get('diststyle') or '')
+        if skew > max_skew_rows and current_dist.startswith('KEY'):
+            table_advice['notes'].append('row skew {:.1f} on current {}'.format(skew, current_dist))
+            if table_advice['distkey'] and table_advice['distkey'] in current_dist:
+                table_advice.update(diststyle = 'EVEN', distkey = None)
+
+        # sort on the most used filter columns, else the join key (merge
+        # joins), else the primary key
+        used = sorted([column for column in filters if owner[column] == table],
+                      key = lambda column: -filters[column])
+        sortkey = used[:2]
+        if not sortkey:
+            sortkey = [column for pair in joins for column in pair
+                       if owner[column] == table][:1]
+        if not sortkey:
+            sortkey = [line.split()[0] for line in parse_create(queries[table])[2]
+                       if 'PRIMARY KEY' in line][:1]
+        table_advice['sortkey'] = sortkey
+
+        unsorted = float(info.get('unsorted') or 0)
+        if unsorted > max_unsorted:
+            table_advice['notes'].append('{:.0f}% unsorted, needs VACUUM SORT ONLY'
+                                         .format(unsorted))
+
+    return advice
+
+
+def render_create(query, table_advice):
+    """
+    Rewrite a registered CREATE TABLE query from sql_queries.py with the
+    advised distribution and sort keys, keeping its layout.
+
+    """
+    table, columns, lines = parse_create(query)
+
+    # drop the column-level DISTKEY / SORTKEY attributes
+    lines = [re.sub(r'\b(DISTKEY|SORTKEY)\b\s*', '', line).rstrip() for line in lines]
+
+    attributes = ['DISTSTYLE {}'.format(table_advice['diststyle'])]
+    if table_advice['distkey']:
+        attributes.append('DISTKEY( {} )'.format(table_advice['distkey']))
+    if table_advice['sortkey']:
+        attributes.append('SORTKEY( {} )'.format(', '.join(table_advice['sortkey'])))
+
+    name = query.name
+    return ('{} = ("""\n'
+            '    CREATE TABLE IF NOT EXISTS {}\n'
+            '    (\n'
+            '{}\n'
+            '    )\n'
+            '    {};\n'
+            '""")\n').format(name, table, ',\n'.join(lines), '\n    '.join(attributes))
+
+
+def render_alter(table, table_advice):
+    """
+    Return the ALTER TABLE statements that apply the advice to a live table.
+
+    """
+    statements = []
+    if table_advice['diststyle'] == 'KEY':
+        statements.append('ALTER TABLE {} ALTER DISTKEY {};'
+                          .format(table, table_advice['distkey']))
+    else:
+        statements.append('ALTER TABLE {} ALTER DISTSTYLE {};'
+                          .format(table, table_advice['diststyle']))
+    if table_advice['sortkey']:
+        statements.append('ALTER TABLE {} ALTER SORTKEY ( {} );'
+                          .format(table, ', '.join(table_advice['sortkey'])))
+    return statements
+
+
+def read_stats(cur):
+    """
+    Read svv_table_info for the public schema.
+
+    Returns:
+        stats (dict) : {table: {column: value}}
+
+    """
+    cur.execute(table_info_query)
+    names = [column[0] for column in cur.description]
+
+    stats = {}
+    for row in cur.fetchall():
+        info = dict(zip(names, row))
+        stats[info['table']] = {key: (float(value) if isinstance(value, Decimal) else value)
+                                for key, value in info.items()}
+    return stats
+
+
+def advise(stats, config=None):
+    """
+    Build the advice and the DDL from table stats.
+
+    Returns:
+        (advice, ddl) : advice per table, and the DDL text to apply
+
+    """
+    settings = dict(small_table_rows = SMALL_TABLE_ROWS,
+                    max_skew_rows = MAX_SKEW_ROWS, max_unsorted = MAX_UNSORTED)
+    if config is not None and config.has_section('ADVISOR'):
+        settings = dict(
+            small_table_rows = config.getint('ADVISOR', 'SMALL_TABLE_ROWS',
+                                             fallback = SMALL_TABLE_ROWS),
+            max_skew_rows    = config.getfloat('ADVISOR', 'MAX_SKEW_ROWS',
+                                               fallback = MAX_SKEW_ROWS),
+            max_unsorted     = config.getfloat('ADVISOR', 'MAX_UNSORTED',
+                                               fallback = MAX_UNSORTED))
+
+    joins, filters = column_usage(sample_queries)
+    advice = recommend(stats, joins, filters, **settings)
+
+    ddl = ['#' + '-' * 78, '# ADVISED TABLE DESIGN', '']
+    for query in create_queries():
+        table = query.table
+        for note in advice[table]['notes']:
+            ddl.append('# {} :  {}'.format(table, note))
+        ddl.append(render_create(query, advice[table]))
+
+    ddl.append('# ALTER statements for the live tables')
+    for query in create_queries():
+        table = query.table
+        ddl.extend('# ' + statement for statement in render_alter(table, advice[table]))
+
+    return advice, '\n'.join(ddl) + '\n'
+
+
+def apply_advice(config, advice):
+    """
+    Run the ALTER TABLE statements for the advice on the cluster.
+
+    """
+    conn = db.connect(config)
+    conn.autocommit = True
+    cur = conn.cursor()
+
+    for table, table_advice in advice.items():
+        for statement in render_alter(table, table_advice):
+            logger.info('apply :  {}'.format(statement))
+            try:
+                cur.execute(statement)
+            except psycopg2.Error as e:
+                logger.info('Error :  Altering table [ {} ]'.format(table))
+                print(e)
+                print(statement)
+
+    conn.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description = 'Advise distribution and sort keys')
+    parser.add_argument('--stats', help = 'read table stats from a JSON file (offline)')
+    parser.add_argument('--capture', help = 'save the live table stats to a JSON file')
+    parser.add_argument('--out', help = 'write the DDL to a file instead of stdout')
+    parser.add_argument('--apply', action = 'store_true',
+                        help = 'apply the advice to the live tables with ALTER TABLE')
+    args = parser.parse_args()
+    mylib.setup_logger()
+
+    logger.info('---[ Table Advisor ]---')
+    mylib.log_timestamp()
+
+    config = configparser.ConfigParser()
+    config.read('dwh.cfg')
+
+    if args.stats:
+        with open(args.stats) as f:
+            stats = json.load(f)
+    else:
+        try:
+            conn = db.connect(config)
+            stats = read_stats(conn.cursor())
+            conn.close()
+        except psycopg2.Error as e:
+            logger.info("Error :  Could not read table stats")
+            print(e)
+            return
+
+        if args.capture:
+            with open(args.capture, 'w') as f:
+                json.dump(stats, f, indent = 2)
+
+    advice, ddl = advise(stats, config)
+
+    for table, table_advice in advice.items():
+        logger.info('advise table [ {} ] :  DISTSTYLE {} DISTKEY {} SORTKEY {}'
+                    .format(table, table_advice['diststyle'], table_advice['distkey'],
+                            table_advice['sortkey']))
+
+    if args.out:
+        with open(args.out, 'w') as f:
+            f.write(ddl)
+    else:
+        print(ddl)
+
+    if args.apply:
+        apply_advice(config, advice)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,97 @@
+import configparser
+import os
+import sys
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+# moto: fake keys, and the AWS managed policies the IAM role attaches
+os.environ['MOTO_IAM_LOAD_MANAGED_POLICIES'] = 'true'
+os.environ['AWS_ACCESS_KEY_ID']              = 'testing'
+os.environ['AWS_SECRET_ACCESS_KEY']          = 'testing'
+os.environ['AWS_SECURITY_TOKEN']             = 'testing'
+os.environ['AWS_SESSION_TOKEN']              = 'testing'
+os.environ['AWS_DEFAULT_REGION']             = 'us-west-2'
+
+
+@pytest.fixture
+def config(tmp_path, monkeypatch):
+    """
+    The repo dwh.cfg, copied to a temporary working directory, so that the
+    logs, metrics and state files of a test stay there.
+
+    """
+    monkeypatch.chdir(tmp_path)
+    config = configparser.ConfigParser()
+    config.read(os.path.join(ROOT, 'dwh.cfg'))
+    return config
+
+
+def write_config(config, path='dwh.cfg'):
+    with open(path, 'w') as f:
+        config.write(f)
+
+
+def no_sleep(seconds):
+    pass
+
+
+class FakeCursor:
+    """
+    Cursor stub that records the statements and COPY loads it is given;
+    *fail* makes every statement containing that text raise.
+
+    """
+
+    def __init__(self, connection=None, fail=None, rows=None):
+        self.connection = connection
+        self.fail = fail
+        self.rows = rows if rows is not None else [(0,)]
+        self.queries = []
+        self.copies = []
+        self.rowcount = 1
+        self.description = []
+
+    def execute(self, query, params=None):
+        import psycopg2
+        self.queries.append(query)
+        if self.fail and self.fail in query:
+            raise psycopg2.Error('failed:  {}'.format(self.fail))
+
+    def copy_expert(self, query, buffer):
+        self.copies.append((query, buffer.getvalue()))
+
+    def fetchall(self):
+        return self.rows
+
+    def fetchone(self):
+        return self.rows[0]
+
+    def close(self):
+        pass
+
+
+class FakeConnection:
+    """
+    Connection stub; every cursor shares one FakeCursor.
+
+    """
+
+    def __init__(self, fail=None):
+        self.cur = FakeCursor(self, fail)
+        self.commits = 0
+        self.rollbacks = 0
+        self.autocommit = False
+
+    def cursor(self, *args, **kwargs):
+        return self.cur
+
+    def commit(self):
+        self.commits += 1
+
+    def rollback(self):
+        self.rollbacks += 1
+
+    def close(self):
+        pass
@@ -0,0 +1,77 @@
+import csv
+import pytest
+import analytics
+
+
+class NamedCursor:
+    """
+    Server-side cursor stub: returns *rows* in fetchmany chunks; like a
+    named cursor, it has no description before the first fetch.
+
+    """
+
+    def __init__(self, rows, columns):
+        self.rows = list(rows)
+        self.columns = columns
+        self.description = None
+        self.executed = None
+
+    def execute(self, query, params):
+        self.executed = (query, params)
+
+    def fetchmany(self, size):
+        self.description = [(column,) for column in self.columns]
+        chunk, self.rows = self.rows[:size], self.rows[size:]
+        return chunk
+
+    def close(self):
+        pass
+
+
+class NamedConnection:
+
+    def __init__(self, rows, columns):
+        self.cur = NamedCursor(rows, columns)
+
+    def cursor(self, name=None):
+        return self.cur
+
+    def commit(self):
+        pass
+
+
+def read_csv(path):
+    with open(path, newline = '') as f:
+        return list(csv.reader(f))
+
+
+def test_top_songs_for_user_params():
+    query, bound = analytics.bind_params('top_songs_for_user', user_id = 49, limit = 3)
+    assert bound == {'start': None, 'end': None, 'limit': 3, 'user_id': 49}
+    assert '%(user_id)s' in query and '%(limit)s' in query
+
+    with pytest.raises(ValueError):
+        analytics.bind_params('top_songs_for_user')
+
+
+def test_top_session_users_params():
+    query, bound = analytics.bind_params('top_session_users', limit = 1)
+    assert bound == {'start': None, 'end': None, 'limit': 1}
+    assert 'session_songs' in query
+
+
+def test_export_csv_chunks(tmp_path):
+    path = str(tmp_path / 'plays.csv')
+    conn = NamedConnection([(i, 'song {}'.format(i)) for i in range(5)], ['n', 'title'])
+
+    assert analytics.export_query(conn, 'user_songplays', path, 2, user_id = 49) == 5
+    assert read_csv(path)[0] == ['n', 'title']
+    assert len(read_csv(path)) == 6
+
+
+def test_export_csv_empty_result(tmp_path):
+    path = str(tmp_path / 'plays.csv')
+    conn = NamedConnection([], ['sp_start_time', 's_title'])
+
+    assert analytics.export_query(conn, 'user_songplays', path, user_id = 49) == 0
+    assert read_csv(path) == [['sp_start_time', 's_title']]
@@ -0,0 +1,130 @@
+import sys
+import boto3
+import pytest
+from moto import mock_aws
+import autoscale
+import etl
+import manage_redshift_cluster as cluster
+from conftest import FakeConnection, no_sleep, write_config
+
+
+CLUSTER_ID = 'dwhCluster'
+
+
+@pytest.fixture
+def clients(config):
+    with mock_aws():
+        session = boto3.session.Session(region_name = 'us-west-2')
+        clients = cluster.get_clients(config, session = session)
+        clients['redshift'].create_cluster(ClusterIdentifier  = CLUSTER_ID,
+                                           ClusterType        = 'multi-node',
+                                           NodeType           = 'dc2.large',
+                                           NumberOfNodes      = 4,
+                                           MasterUsername     = 'dwhuser',
+                                           MasterUserPassword = 'Passw0rd')
+        clients['s3'].create_bucket(Bucket = 'udacity-dend',
+                                    CreateBucketConfiguration = {'LocationConstraint': 'us-west-2'})
+        yield clients
+
+
+def put_input(s3, size):
+    s3.put_object(Bucket = 'udacity-dend', Key = 'log_data/events.json', Body = b'x' * size)
+    s3.put_object(Bucket = 'udacity-dend', Key = 'song_data/songs.json', Body = b'x' * size)
+
+
+def nodes(clients):
+    return cluster.describe_cluster(clients['redshift'], CLUSTER_ID)['NumberOfNodes']
+
+
+def test_plan_nodes_within_limits():
+    assert autoscale.plan_nodes(0, 'dc2.large') == autoscale.MIN_NODES
+    assert autoscale.plan_nodes(10 ** 15, 'dc2.large') == autoscale.MAX_NODES
+    # 3 GB over 2 slices per node at 256 MB per slice
+    assert autoscale.plan_nodes(3 * 1024 ** 3, 'dc2.large') == 6
+    assert autoscale.plan_nodes(3 * 1024 ** 3, 'ra3.16xlarge') == 2
+
+
+def test_valid_nodes_elastic():
+    # dc2.large: any count from half to double
+    assert autoscale.valid_nodes(7, 'dc2.large', 4) == 7
+    assert autoscale.valid_nodes(12, 'dc2.large', 4) == 8
+    # ra3.4xlarge: only half or double
+    assert autoscale.valid_nodes(5, 'ra3.4xlarge', 4) == 8
+    assert autoscale.valid_nodes(5, 'ra3.4xlarge', 4, method = 'classic') == 5
+    # node type limits
+    assert autoscale.valid_nodes(200, 'dc2.large', 4, method = 'classic') == 32
+
+
+def test_scale_for_load_keeps_larger_cluster(config, clients):
+    put_input(clients['s3'], 1024)
+
+    assert autoscale.scale_for_load(config, clients, no_sleep) is None
+    assert nodes(clients) == 4
+
+
+def test_scale_for_load_and_back(config, clients):
+    config['AUTOSCALE']['bytes_per_slice'] = '100'
+    put_input(clients['s3'], 1000)
+
+    # moto has no elastic resize; it falls back to a classic resize
+    previous = autoscale.scale_for_load(config, clients, no_sleep)
+    assert previous == 4
+    assert nodes(clients) == 8
+
+    autoscale.scale_back(config, previous, clients, no_sleep)
+    assert nodes(clients) == 4
+
+
+def test_scale_to_keep(config, clients):
+    assert autoscale.scale_to(config, 4, 'load', clients, no_sleep) is None
+    assert nodes(clients) == 4
+
+
+def test_run_autoscale_swallows_errors(config):
+    def step(config):
+        raise RuntimeError('resize failed')
+
+    assert etl.run_autoscale(step, config) is None
+
+
+def test_scale_back_after_failed_connection(config, monkeypatch):
+    config['AUTOSCALE']['enabled'] = 'true'
+    write_config(config)
+    calls = []
+
+    monkeypatch.setattr(sys, 'argv', ['etl.py'])
+    monkeypatch.setattr(autoscale, 'scale_for_load', lambda config: 4)
+    monkeypatch.setattr(autoscale, 'scale_back',
+                        lambda config, nodes: calls.append(nodes))
+
+    def connect(config):
+        raise RuntimeError('no cluster')
+    monkeypatch.setattr(etl.db, 'connect', connect)
+
+    assert etl.main() == 1
+    assert calls == [4]
+
+
+def test_scale_back_before_data_quality(config, monkeypatch):
+    config['AUTOSCALE']['enabled'] = 'true'
+    write_config(config)
+    calls = []
+
+    def step(name, result=None):
+        def run(*args):
+            calls.append(name)
+            return result
+        return run
+
+    monkeypatch.setattr(sys, 'argv', ['etl.py'])
+    monkeypatch.setattr(autoscale, 'scale_for_load', step('scale_for_load', 4))
+    monkeypatch.setattr(autoscale, 'scale_back', step('scale_back'))
+    monkeypatch.setattr(etl.db, 'connect', lambda config: calls.append('connect') or FakeConnection())
+    monkeypatch.setattr(etl, 'load_staging_tables', step('load_staging_tables'))
+    monkeypatch.setattr(etl, 'insert_tables', step('insert_tables'))
+    monkeypatch.setattr(etl, 'rebuild_aggregates', step('aggregates'))
+    monkeypatch.setattr(etl.data_quality, 'check_data_quality', step('data_quality', []))
+
+    assert etl.main() == 0
+    assert calls == ['scale_for_load', 'connect', 'load_staging_tables', 'insert_tables',
+                     'aggregates', 'scale_back', 'connect', 'data_quality']
@@ -0,0 +1,76 @@
+import datetime
+import json
+import backfill
+from conftest import FakeConnection
+
+
+DAY = datetime.date(2018, 11, 5)
+NEXT_DAY = datetime.date(2018, 11, 6)
+
+
+def test_day_partition_compressed():
+    for name in ['2018-11-05-events.json', '2018-11-05-events.json.gz',
+                 '2018-11-05-events.json.zst', '2018-11-05-events.json.bz2']:
+        assert backfill.day_partition('log_data/2018/11/' + name) == \
+               (DAY, 'log_data/2018/11/2018-11-05')
+
+    assert backfill.day_partition('log_data/2018/11/2018-11-05-events.csv') is None
+    assert backfill.day_partition('log_data/2018/11/2018-11-05-events.json.zip') is None
+
+
+def test_day_sources_spill_over():
+    partitions = backfill.day_sources({DAY: 'day-5', NEXT_DAY: 'day-6'})
+
+    assert partitions == {DAY                        : ['day-5'],
+                          NEXT_DAY                   : ['day-5', 'day-6'],
+                          datetime.date(2018, 11, 7) : ['day-6']}
+
+
+def test_load_partition(config):
+    conn = FakeConnection()
+
+    backfill.load_partition(conn.cur, conn, config, NEXT_DAY,
+                            ['s3://udacity-dend/log_data/2018/11/2018-11-05',
+                             's3://udacity-dend/log_data/2018/11/2018-11-06'])
+
+    queries = [' '.join(query.split()) for query in conn.cur.queries]
+    assert 'CREATE TEMP TABLE staging_events_day ( LIKE staging_events INCLUDING DEFAULTS )' \
+           in queries
+    copies = [query for query in queries if query.startswith('COPY staging_events_day')]
+    assert len(copies) == 2
+    assert '2018-11-05' in copies[0] and '2018-11-06' in copies[1]
+
+    # the join runs before the lock, bounded by the ts of the day
+    create = [query for query in queries if query.startswith('CREATE TEMP TABLE songplays_day')]
+    assert 'ts >= 1541462400000 AND ts < 1541548800000' in create[0]
+    lock = [i for i, query in enumerate(queries) if query.startswith('LOCK songplays')][0]
+    assert queries.index(create[0]) < lock
+    assert queries.index(copies[1]) < lock
+
+    # under the lock: the replace of the day, then the status
+    replace = queries[lock + 1:]
+    assert replace[0].startswith("DELETE FROM songplays WHERE sp_start_time >= '2018-11-06'")
+    assert replace[1].startswith('INSERT INTO songplays')
+    assert 'FROM songplays_day' in replace[1]
+    assert 'staging_songs' not in ' '.join(replace)
+    assert replace[-5:-3] == ['LOCK etl_backfill', 'DELETE FROM etl_backfill WHERE bf_day = %(day)s;']
+    assert conn.commits == 2
+
+
+def test_load_partition_local(config, tmp_path):
+    config['ETL']['target'] = 'postgres'
+    config['ETL']['staging_source'] = 'local'
+    config['LOCAL']['log_jsonpath'] = ''
+    (tmp_path / '2018-11-05-events.json').write_text(
+        json.dumps({'page': 'NextSong', 'ts': 1541462400000, 'userId': '7'}) + '\n')
+    conn = FakeConnection()
+
+    backfill.load_partition(conn.cur, conn, config, DAY, [str(tmp_path / '2018-11-05')])
+
+    # event_key is left to the default of the temp table
+    assert 'CREATE TEMP TABLE staging_events_day ( LIKE staging_events INCLUDING DEFAULTS )' \
+           in conn.cur.queries
+    query, data = conn.cur.copies[0]
+    assert query.startswith('COPY staging_events_day (artist, ')
+    assert 'event_key' not in query
+    assert data.count('\n') == 1
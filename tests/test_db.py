@@ -0,0 +1,117 @@
+import psycopg2
+import psycopg2.errors
+import pytest
+import db
+from conftest import FakeConnection
+
+
+def server_error(cls, pgcode):
+    """
+    An error as raised by the server, with its SQLSTATE.
+
+    """
+    return type(cls.__name__, (cls,), {'pgcode': pgcode})('server error')
+
+
+@pytest.mark.parametrize('error, transient', [
+    (psycopg2.OperationalError('server closed the connection unexpectedly'), True),
+    (psycopg2.InterfaceError('connection already closed'),                   True),
+    (server_error(psycopg2.errors.AdminShutdown, '57P01'),                  True),
+    (server_error(psycopg2.errors.ConnectionFailure, '08006'),              True),
+    (server_error(psycopg2.errors.TooManyConnections, '53300'),             True),
+    (server_error(psycopg2.errors.QueryCanceled, '57014'),                  False),
+    (server_error(psycopg2.errors.DiskFull, '53100'),                       False),
+    (server_error(psycopg2.errors.OutOfMemory, '53200'),                    False),
+    (server_error(psycopg2.errors.UniqueViolation, '23505'),                False),
+    (psycopg2.errors.QueryCanceled('canceling statement due to statement timeout'), False),
+])
+def test_is_transient(error, transient):
+    assert db.is_transient(error) is transient
+
+
+def test_is_transient_closed_connection():
+    conn = FakeConnection()
+    conn.closed = 2
+    assert db.is_transient(server_error(psycopg2.errors.QueryCanceled, '57014'), conn)
+
+
+def test_backoff(monkeypatch):
+    monkeypatch.setattr(db.random, 'uniform', lambda low, high: high)
+    assert [db.backoff(attempt, 1.0, 30) for attempt in range(7)] == [1, 2, 4, 8, 16, 30, 30]
+
+    monkeypatch.setattr(db.random, 'uniform', lambda low, high: low)
+    assert db.backoff(3, 1.0, 30) == 4
+
+
+class StubPool(db.Pool):
+    """
+    db.Pool without a database: every getconn() is a new FakeConnection.
+
+    """
+
+    def __init__(self, retries=3):
+        self.retries = retries
+        self.base    = 0
+        self.maximum = 0
+        self.connections = []
+        self.returned = []
+
+    def getconn(self):
+        conn = FakeConnection()
+        conn.closed = 0
+        self.connections.append(conn)
+        return conn
+
+    def putconn(self, conn, close=False):
+        self.returned.append(close)
+
+
+def failing(*errors):
+    errors = list(errors)
+
+    def function(conn):
+        if errors:
+            raise errors.pop(0)
+        return 'done'
+    return function
+
+
+def test_pool_run_retries_lost_connection(monkeypatch):
+    monkeypatch.setattr(db.time, 'sleep', lambda seconds: None)
+    pool = StubPool()
+
+    assert pool.run(failing(psycopg2.OperationalError('server closed the connection'),
+                            server_error(psycopg2.errors.AdminShutdown, '57P01'))) == 'done'
+    assert len(pool.connections) == 3
+    assert pool.returned == [True, True, False]
+
+
+def test_pool_run_gives_up(monkeypatch):
+    monkeypatch.setattr(db.time, 'sleep', lambda seconds: None)
+    pool = StubPool(retries = 2)
+
+    with pytest.raises(psycopg2.OperationalError):
+        pool.run(failing(*[psycopg2.OperationalError('down')] * 5))
+    assert len(pool.connections) == 3
+
+
+@pytest.mark.parametrize('error', [server_error(psycopg2.errors.QueryCanceled, '57014'),
+                                   server_error(psycopg2.errors.DiskFull, '53100')])
+def test_pool_run_no_retry_on_query_errors(error):
+    pool = StubPool()
+
+    with pytest.raises(psycopg2.Error):
+        pool.run(failing(error))
+    assert len(pool.connections) == 1
+    assert pool.connections[0].rollbacks == 1
+    assert pool.returned == [False]
+
+
+def test_pool_run_not_idempotent():
+    pool = StubPool()
+
+    with pytest.raises(psycopg2.OperationalError):
+        pool.run(failing(psycopg2.OperationalError('server closed the connection')),
+                 idempotent = False)
+    assert len(pool.connections) == 1
+    assert pool.returned == [True]
@@ -0,0 +1,109 @@
+import sys
+import threading
+import pytest
+import data_quality
+import etl
+import run_state
+from sql_queries import stage_queries
+from conftest import FakeConnection, write_config
+
+
+class StubPool:
+    """
+    db.Pool stub: every run() gets a fresh FakeConnection; COPY statements
+    containing *fail* raise. With *concurrent*, each COPY waits until the
+    other load has run its COPY too, so the loads must run side by side.
+
+    """
+
+    def __init__(self, fail=None, concurrent=0):
+        self.fail = fail
+        self.connections = []
+        self.idempotent = {}
+        self.lock = threading.Lock()
+        self.barrier = threading.Barrier(concurrent, timeout = 5) if concurrent else None
+
+    def run(self, f, idempotent=True):
+        conn = FakeConnection(self.fail)
+        with self.lock:
+            self.connections.append(conn)
+        try:
+            result = f(conn)
+        finally:
+            self.idempotent[conn.cur.queries[0].split()[0]] = idempotent
+        if self.barrier is not None and conn.cur.queries[0].startswith('COPY'):
+            self.barrier.wait()
+        return result
+
+    def copies(self):
+        return sorted(conn.cur.queries[0] for conn in self.connections
+                      if conn.cur.queries[0].startswith('COPY'))
+
+
+def copy_queries():
+    return [query.with_sql('COPY {} FROM s3'.format(query.table))
+            for query in stage_queries('load_staging_tables')]
+
+
+def test_load_staging_tables_parallel(config):
+    run_state.start(config, 'run-1', 'inputs')
+    pool = StubPool(concurrent = 2)
+
+    timings = etl.load_staging_tables_parallel(pool, 2, copy_queries())
+
+    assert sorted(timings) == ['staging_events', 'staging_songs']
+    assert all(status == 'ok' for status, seconds in timings.values())
+    assert pool.copies() == ['COPY staging_events FROM s3', 'COPY staging_songs FROM s3']
+    assert all(conn.commits == 1 for conn in pool.connections)
+    # a COPY that may have committed is not run again
+    assert pool.idempotent == {'COPY': False, 'SELECT': True}
+    assert run_state.is_done('load_staging_tables', 'staging_events')
+    assert run_state.get_item('load_staging_tables', 'staging_songs')['fingerprint'] == ['0']
+
+
+def test_load_staging_tables_parallel_failed_load(config):
+    run_state.start(config, 'run-1', 'inputs')
+    pool = StubPool(fail = 'COPY staging_events')
+
+    timings = etl.load_staging_tables_parallel(pool, 2, copy_queries())
+
+    assert timings['staging_events'][0] == 'failed'
+    assert timings['staging_songs'][0] == 'ok'
+    assert not run_state.is_done('load_staging_tables', 'staging_events')
+    assert run_state.failed('load_staging_tables') == ['staging_events']
+
+
+def test_load_staging_tables_parallel_skips_loaded(config):
+    run_state.start(config, 'run-1', 'inputs')
+    run_state.mark_done('load_staging_tables', 'staging_songs', fingerprint = ['0'])
+    pool = StubPool()
+
+    timings = etl.load_staging_tables_parallel(pool, 2, copy_queries())
+
+    assert timings['staging_songs'][0] == 'skipped'
+    assert pool.copies() == ['COPY staging_events FROM s3']
+
+
+def test_failed_data_quality_stage(config):
+    run_state.start(config, 'run-1', 'inputs')
+    conn = FakeConnection(fail = 'FROM')
+
+    assert not etl.run_stage('data_quality', data_quality.check_data_quality,
+                             conn.cur, conn, config)
+    assert run_state.failed('data_quality') == ['stats']
+    assert not run_state.is_done('data_quality')
+
+    # a resumed run checks again
+    run_state.finish('failed')
+    assert run_state.start(config, 'run-2', 'inputs', resume = True)
+    assert not run_state.is_done('data_quality')
+
+
+def test_incremental_shadow_load_rejected(config, monkeypatch):
+    config['ETL']['incremental'] = 'true'
+    config['ETL']['shadow_load'] = 'true'
+    write_config(config)
+    monkeypatch.setattr(sys, 'argv', ['etl.py'])
+    monkeypatch.setattr(etl.db, 'connect', lambda config: pytest.fail('connected'))
+
+    assert etl.main() == 1
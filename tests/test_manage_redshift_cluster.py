@@ -0,0 +1,174 @@
+import datetime
+import json
+import os
+import boto3
+import pytest
+from botocore.exceptions import ClientError
+from moto import mock_aws
+from moto.backends import get_backend
+from moto.core import DEFAULT_ACCOUNT_ID
+import manage_redshift_cluster as cluster
+from conftest import no_sleep
+
+
+CLUSTER_ID = 'dwhCluster'
+
+
+class FakeRedshift:
+    """
+    Redshift client stub: every describe_clusters call returns the next of
+    *statuses* (the last one repeats); a status of None is a deleted cluster.
+
+    """
+
+    def __init__(self, statuses, snapshots=()):
+        self.statuses = list(statuses)
+        self.snapshots = [{'SnapshotIdentifier' : snapshot,
+                           'Status'             : 'available',
+                           'SnapshotCreateTime' : datetime.datetime(2024, 1, day + 1)}
+                          for day, snapshot in enumerate(snapshots)]
+
+    def describe_clusters(self, ClusterIdentifier):
+        status = self.statuses.pop(0) if len(self.statuses) > 1 else self.statuses[0]
+        if status is None:
+            raise ClientError({'Error': {'Code': 'ClusterNotFound', 'Message': ''}},
+                              'DescribeClusters')
+        return {'Clusters': [{'ClusterIdentifier' : ClusterIdentifier,
+                              'ClusterStatus'     : status,
+                              'NumberOfNodes'     : 4}]}
+
+    def describe_cluster_snapshots(self, ClusterIdentifier, SnapshotType):
+        return {'Snapshots': self.snapshots}
+
+
+@pytest.mark.parametrize('statuses, path', [
+    (['available'], 'running'),
+    (['paused'], 'resume'),
+    (['resuming'], 'wait'),
+    (['creating'], 'wait'),
+    (['modifying'], 'wait'),
+])
+def test_choose_start_path(statuses, path):
+    redshift = FakeRedshift(statuses)
+    assert cluster.choose_start_path(redshift, CLUSTER_ID, no_sleep) == (path, None)
+
+
+def test_choose_start_path_pausing():
+    redshift = FakeRedshift(['pausing', 'pausing', 'pausing', 'paused'])
+
+    assert cluster.choose_start_path(redshift, CLUSTER_ID, no_sleep) == ('resume', None)
+    assert redshift.statuses == ['paused']
+
+
+def test_choose_start_path_deleting():
+    redshift = FakeRedshift(['deleting', 'final-snapshot', None], ['snap-1', 'snap-2'])
+    assert cluster.choose_start_path(redshift, CLUSTER_ID, no_sleep) == ('restore', 'snap-2')
+
+    redshift = FakeRedshift(['deleting', None])
+    assert cluster.choose_start_path(redshift, CLUSTER_ID, no_sleep) == ('create', None)
+
+
+def test_choose_start_path_deleted():
+    redshift = FakeRedshift([None], ['snap-1'])
+    assert cluster.choose_start_path(redshift, CLUSTER_ID, no_sleep) == ('restore', 'snap-1')
+
+    redshift = FakeRedshift([None])
+    assert cluster.choose_start_path(redshift, CLUSTER_ID, no_sleep) == ('create', None)
+
+
+@pytest.fixture
+def clients(config):
+    with mock_aws():
+        session = boto3.session.Session(region_name = 'us-west-2')
+        yield cluster.get_clients(config, session = session)
+
+
+def history(config):
+    with open(config['LIFECYCLE']['HISTORY_FILE']) as f:
+        return [json.loads(line) for line in f]
+
+
+def status(clients):
+    props = cluster.describe_cluster(clients['redshift'], CLUSTER_ID)
+    return props['ClusterStatus'] if props else None
+
+
+def test_lifecycle(config, clients):
+    # create: the role, its S3 policy and the cluster
+    props = cluster.start_cluster(config, clients, no_sleep)
+    assert props['ClusterStatus'] == 'available'
+    assert props['NumberOfNodes'] == 4
+    role = clients['iam'].get_role(RoleName = config['IAM_ROLE']['IAM_ROLE_NAME'])['Role']
+    assert [r['IamRoleArn'] for r in props['IamRoles']] == [role['Arn']]
+    policies = clients['iam'].list_attached_role_policies(RoleName = role['RoleName'])
+    assert [p['PolicyArn'] for p in policies['AttachedPolicies']] == \
+           [config['IAM_ROLE']['IAM_POLICY_ARN']]
+
+    # running
+    cluster.start_cluster(config, clients, no_sleep)
+
+    # pause, then resume
+    cluster.stop_cluster(config, clients, 'pause', no_sleep)
+    assert status(clients) == 'paused'
+    cluster.start_cluster(config, clients, no_sleep)
+    assert status(clients) == 'available'
+
+    # snapshot, then restore
+    cluster.stop_cluster(config, clients, 'snapshot', no_sleep)
+    assert status(clients) is None
+    snapshot = cluster.latest_snapshot(clients['redshift'], CLUSTER_ID)
+    assert snapshot.startswith(CLUSTER_ID.lower())
+    cluster.start_cluster(config, clients, no_sleep)
+    assert status(clients) == 'available'
+
+    entries = history(config)
+    assert [(entry['action'], entry['path']) for entry in entries] == \
+           [('start', 'create'), ('start', 'running'), ('stop', 'pause'), ('start', 'resume'),
+            ('stop', 'snapshot'), ('start', 'restore')]
+    assert entries[4]['snapshot'] == entries[5]['snapshot'] == snapshot
+    assert all(entry['cluster'] == CLUSTER_ID and entry['seconds'] >= 0 for entry in entries)
+
+
+def test_prune_snapshots(config, clients):
+    config['LIFECYCLE']['SNAPSHOTS_KEPT'] = '2'
+    cluster.start_cluster(config, clients, no_sleep)
+    for snapshot in ['old-1', 'old-2']:
+        clients['redshift'].create_cluster_snapshot(SnapshotIdentifier = snapshot,
+                                                    ClusterIdentifier  = CLUSTER_ID)
+    cluster.stop_cluster(config, clients, 'snapshot', no_sleep)
+
+    snapshots = clients['redshift'].describe_cluster_snapshots(ClusterIdentifier = CLUSTER_ID,
+                                                               SnapshotType      = 'manual')
+    assert len(snapshots['Snapshots']) == 2
+
+
+def test_stop_deleted_cluster(config, clients):
+    cluster.stop_cluster(config, clients, 'pause', no_sleep)
+    assert not os.path.exists(config['LIFECYCLE']['HISTORY_FILE'])
+
+
+def test_delete(config, clients):
+    cluster.start_cluster(config, clients, no_sleep)
+    cluster.stop_cluster(config, clients, 'delete', no_sleep)
+
+    assert status(clients) is None
+    with pytest.raises(ClientError):
+        clients['iam'].get_role(RoleName = config['IAM_ROLE']['IAM_ROLE_NAME'])
+
+
+def test_stop_pausing_cluster(config, clients):
+    cluster.start_cluster(config, clients, no_sleep)
+    backend = get_backend('redshift')[DEFAULT_ACCOUNT_ID]['us-west-2']
+    backend.clusters[CLUSTER_ID].status = 'pausing'
+    polls = []
+
+    # the pause finishes while the stop waits for it
+    def sleep(seconds):
+        polls.append(seconds)
+        backend.clusters[CLUSTER_ID].status = 'paused'
+
+    cluster.stop_cluster(config, clients, 'pause', sleep)
+
+    assert status(clients) == 'paused'
+    assert len(polls) == 1
+    assert history(config)[-1]['path'] == 'pause'
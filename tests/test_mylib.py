@@ -0,0 +1,56 @@
+import logging
+import subprocess
+import sys
+import time
+import mylib
+from conftest import ROOT
+
+
+def test_import_leaves_logging_alone(tmp_path):
+    # only the entry points attach the logfile handler
+    code = ('import sys; sys.path.insert(0, {!r}); '
+            'import logging, etl, mylib; '
+            'assert mylib.QUEUE_HANDLER not in logging.getLogger().handlers; '
+            'mylib.setup_logger(); '
+            'assert mylib.QUEUE_HANDLER in logging.getLogger().handlers').format(ROOT)
+    subprocess.run([sys.executable, '-c', code], cwd = str(tmp_path), check = True)
+
+
+def test_daily_rollover(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(mylib, 'set_log_file_name', lambda: './logs/etl-20240101.log')
+    handler = mylib.DailyFileHandler()
+    record = logging.LogRecord('etl', logging.INFO, __file__, 0, 'day %s', (1,), None)
+    handler.emit(record)
+
+    # past midnight: the next record goes to the file of the new date
+    monkeypatch.setattr(mylib, 'set_log_file_name', lambda: './logs/etl-20240102.log')
+    handler.rolloverAt = time.time() - 1
+    record.args = (2,)
+    handler.emit(record)
+    handler.close()
+
+    assert handler.logfile == './logs/etl-20240102.log'
+    assert handler.baseFilename == str(tmp_path / 'logs' / 'etl-20240102.log')
+    assert handler.rolloverAt > time.time()
+    assert (tmp_path / 'logs' / 'etl-20240101.log').read_text() == 'day 1\n'
+    assert (tmp_path / 'logs' / 'etl-20240102.log').read_text() == 'day 2\n'
+
+
+def test_setup_logger_twice():
+    root = logging.getLogger()
+    level = root.level
+    try:
+        mylib.setup_logger()
+        mylib.setup_logger()
+        assert root.handlers.count(mylib.QUEUE_HANDLER) == 1
+
+        mylib.start_listener()
+        listener = mylib.LISTENER['listener']
+        mylib.start_listener()
+        assert mylib.LISTENER['listener'] is listener
+    finally:
+        root.removeHandler(mylib.QUEUE_HANDLER)
+        root.setLevel(level)
+        mylib.stop_listener()
+    assert mylib.LISTENER['listener'] is None
@@ -0,0 +1,31 @@
+import os
+import result_cache
+from conftest import FakeCursor
+
+
+def cached(config, rows):
+    cur = FakeCursor(rows = rows)
+    cur.description = [('plays',)]
+    return result_cache.cached_query(cur, 'SELECT COUNT(*) FROM songplays', None, config)
+
+
+def test_new_load_purges_results(config):
+    config['CACHE']['DIR'] = './cache'
+    first = result_cache.stamp_load_version(config)
+    assert cached(config, [(1,)]) == (['plays'], [(1,)])
+    assert cached(config, [(2,)]) == (['plays'], [(1,)])
+
+    # a second load right after the first still gets a version of its own
+    second = result_cache.stamp_load_version(config)
+    assert second != first
+    assert [name for name in os.listdir('./cache') if name.endswith('.pkl')] == []
+    assert cached(config, [(2,)]) == (['plays'], [(2,)])
+
+
+def test_same_version_purges_results(config):
+    config['CACHE']['DIR'] = './cache'
+    result_cache.stamp_load_version(config, 'v1')
+    cached(config, [(1,)])
+
+    result_cache.stamp_load_version(config, 'v1')
+    assert cached(config, [(2,)]) == (['plays'], [(2,)])
@@ -0,0 +1,13 @@
+import schema_profiler
+from sql_queries import get_query
+
+
+def test_apply_profile_keeps_queries():
+    query = get_query('user_table_create')
+    profiled = schema_profiler.apply_profile(
+                   [query], {'users': {'u_first_name': {'type': 'VARCHAR(32)', 'encode': 'ZSTD'}}})
+
+    assert profiled[0].name == 'user_table_create'
+    assert profiled[0].table == 'users'
+    assert 'VARCHAR(32)' in profiled[0].sql and 'ENCODE ZSTD' in profiled[0].sql
+
@@ -0,0 +1,71 @@
+import time
+import psycopg2
+import pytest
+import shadow
+from conftest import FakeConnection
+
+
+TABLES = ['songplays', 'users']
+
+
+def stamp_time(stamp):
+    return time.mktime(time.strptime(stamp, shadow.STAMP_FORMAT))
+
+
+def test_shadow_query():
+    sql = ('INSERT INTO songplays (sp_song_id) SELECT s.song_id '
+           'FROM staging_songs s JOIN songs ON songs.song_id = s.song_id')
+
+    assert shadow.shadow_query(sql) == \
+           ('INSERT INTO songplays__shadow (sp_song_id) SELECT s.song_id '
+            'FROM staging_songs s JOIN songs__shadow ON songs__shadow.song_id = s.song_id')
+    # only whole table names
+    assert shadow.shadow_query('SELECT sp_songplay_id FROM songplays_day') == \
+           'SELECT sp_songplay_id FROM songplays_day'
+
+
+def test_swap_tables():
+    conn = FakeConnection()
+
+    shadow.swap_tables(conn.cur, conn, '20240101000000', TABLES)
+
+    assert conn.cur.queries == ['ALTER TABLE songplays RENAME TO songplays__v20240101000000',
+                                'ALTER TABLE songplays__shadow RENAME TO songplays',
+                                'ALTER TABLE users RENAME TO users__v20240101000000',
+                                'ALTER TABLE users__shadow RENAME TO users']
+    assert conn.commits == 1
+
+
+def test_swap_tables_rollback():
+    conn = FakeConnection(fail = 'users__shadow')
+
+    with pytest.raises(psycopg2.Error):
+        shadow.swap_tables(conn.cur, conn, '20240101000000', TABLES)
+
+    assert conn.rollbacks == 1
+    assert conn.commits == 0
+
+
+def test_list_versions():
+    conn = FakeConnection()
+    conn.cur.rows = [('songplays',), ('users',),
+                     ('songplays__v20240102000000',), ('users__v20240102000000',),
+                     ('songplays__v20240101000000',), ('users__v20240101000000',),
+                     # incomplete version, and names that only look like one
+                     ('songplays__v20240103000000',),
+                     ('songplays__v2024',), ('songplays__shadow',)]
+
+    assert shadow.list_versions(conn.cur, conn, TABLES) == ['20240101000000', '20240102000000']
+
+
+def test_prune_versions():
+    conn = FakeConnection()
+    conn.cur.rows = [('songplays__v20240101000000',), ('users__v20240101000000',),
+                     ('songplays__v20240102000000',), ('users__v20240102000000',)]
+
+    dropped = shadow.prune_versions(conn.cur, conn, 24, now = stamp_time('20240102120000'),
+                                    tables = TABLES)
+
+    assert dropped == ['20240101000000']
+    assert conn.cur.queries[1:] == ['DROP TABLE IF EXISTS songplays__v20240101000000',
+                                    'DROP TABLE IF EXISTS users__v20240101000000']
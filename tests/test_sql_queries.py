@@ -0,0 +1,83 @@
+import re
+import pytest
+import local_ingest
+import sql_queries
+from sql_queries import QUERIES, get_query, postgres_query, stage_queries
+
+
+REDSHIFT_ONLY = [r'\bIDENTITY\(', r'\bSORTKEY\b', r'\bDISTKEY\b', r'\bDISTSTYLE\b', r'\bENCODE\b',
+                 r'VARCHAR\(MAX\)', r'\bGETDATE\(', r'\bTRUNC\(', r'DATE_PART\(\s*\w+\s*,']
+
+
+def test_registry_metadata():
+    assert [query.table for query in stage_queries('load_staging_tables')] == \
+           ['staging_events', 'staging_songs']
+    graph = sql_queries.query_graph('insert_tables')
+    assert graph['time'][1] == ['songplays']
+    assert graph['songplays'][1] == []
+
+
+def test_redshift_target_unchanged(config):
+    for query in QUERIES.values():
+        if not callable(query.template):
+            assert query.render(config).sql == query.template
+
+
+def test_postgres_target(config):
+    config['ETL']['target'] = 'postgres'
+
+    for query in QUERIES.values():
+        sql = query.render(config).sql
+        for pattern in REDSHIFT_ONLY:
+            assert not re.search(pattern, sql), (query.name, pattern)
+
+
+def test_postgres_query():
+    sql = postgres_query(get_query('songplay_table_create').template)
+    assert 'sp_songplay_id      SERIAL   PRIMARY KEY' in sql
+    assert sql.rstrip().endswith(');')
+
+    sql = postgres_query(get_query('time_table_insert').template)
+    assert "DATE_PART('hour', sp_start_time)" in sql
+    assert "DATE_PART('dow', sp_start_time)" in sql
+
+
+def test_unknown_target(config):
+    config['ETL']['target'] = 'sqlite'
+    with pytest.raises(ValueError):
+        sql_queries.get_target(config)
+
+
+def test_local_staging_needs_postgres(config):
+    with pytest.raises(ValueError):
+        local_ingest.load_local_staging_tables(None, None, config)
+
+    config['ETL']['target'] = 'postgres'
+    local_ingest.check_target(config)
+
+
+def test_copy_options():
+    assert sql_queries.copy_options({'compression': 'gzip', 'maxerror': '10',
+                                     'truncatecolumns': 'true', 'timeformat': "'auto'"}) == \
+           "    GZIP\n    MAXERROR 10\n    TRUNCATECOLUMNS\n    TIMEFORMAT 'auto'\n"
+
+    # the defaults of dwh.cfg add no options
+    assert sql_queries.copy_options({'compression': 'none', 'maxerror': '0',
+                                     'truncatecolumns': 'false'}) == ''
+    assert 'MAXERROR' not in sql_queries.copy_options({'maxerror': '0'})
+
+
+def test_copy_options_unsupported_compression():
+    with pytest.raises(ValueError):
+        sql_queries.copy_options({'compression': 'lzop'})
+
+
+def test_copy_options_section(config):
+    config['COPY']['maxerror'] = '5'
+    config['COPY']['compupdate'] = 'on'
+
+    assert sql_queries.copy_options(sql_queries.copy_options_section(config)) == \
+           '    COMPUPDATE ON\n    MAXERROR 5\n'
+    # [COPY:repeat] overrides [COPY] and keeps the rest of it
+    assert sql_queries.copy_options(sql_queries.copy_options_section(config, 'repeat')) == \
+           '    COMPUPDATE OFF\n    STATUPDATE OFF\n    MAXERROR 5\n'
@@ -0,0 +1,30 @@
+import table_advisor
+from sql_queries import Query
+
+
+def test_parse_create_registry_name():
+    sql = """
+    CREATE TABLE IF NOT EXISTS public.songplays
+    (
+        sp_songplay_id      INT     IDENTITY(0,1)   PRIMARY KEY,
+        sp_start_time       TIMESTAMP   NOT NULL    SORTKEY,
+        sp_user_id          INT         NOT NULL
+    )
+    DISTSTYLE KEY;
+    """
+    query = Query('songplay_table_create', 'songplays', 'create_tables', sql)
+
+    table, columns, lines = table_advisor.parse_create(query)
+    assert table == 'songplays'
+    assert columns == ['sp_songplay_id', 'sp_start_time', 'sp_user_id']
+    assert lines[1].split() == ['sp_start_time', 'TIMESTAMP', 'NOT', 'NULL', 'SORTKEY']
+
+
+def test_advise_offline():
+    advice, ddl = table_advisor.advise({'songplays' : {'tbl_rows': 10 ** 8},
+                                        'users'     : {'tbl_rows': 10 ** 3}})
+
+    assert sorted(advice) == sorted(table_advisor.ANALYTICS_TABLES)
+    assert advice['users']['diststyle'] == 'ALL'
+    for query in table_advisor.create_queries():
+        assert '{} = ("""\n    CREATE TABLE IF NOT EXISTS {}\n'.format(query.name, query.table) in ddl
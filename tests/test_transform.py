@@ -0,0 +1,55 @@
+import pandas as pd
+import transform
+from conftest import FakeConnection
+
+
+EVENTS = pd.DataFrame({
+    'page'      : ['NextSong', 'NextSong', 'Home'],
+    'userid'    : ['7', '7', '8'],
+    'firstname' : ['Ann', 'Ann', 'Bob'],
+    'lastname'  : ['Lee', 'Lee', 'Ray'],
+    'gender'    : ['F', 'F', 'M'],
+    'level'     : ['free', 'paid', 'free'],
+    'ts'        : [1000, 2000, 3000]
+})
+
+
+def test_build_users_latest_level():
+    users = transform.build_users(EVENTS)
+    assert len(users) == 1
+    assert users.loc[0, 'u_level'] == 'paid'
+    assert users.loc[0, 'u_ts'] == 2000
+
+
+def test_upsert_dimension(config):
+    conn = FakeConnection()
+    users = transform.build_users(EVENTS)
+
+    transform.upsert_dimension(conn.cur, conn, 'users', users)
+
+    queries = conn.cur.queries
+    assert queries[0] == 'DROP TABLE IF EXISTS users_load'
+    assert queries[1].strip().startswith('CREATE TEMP TABLE users_load AS')
+    assert 'u_ts AS version' in queries[1]
+    # the rows go to the temp table, not to users
+    copy, data = conn.cur.copies[0]
+    assert copy.startswith('COPY users_load (u_user_id, u_first_name, u_last_name, '
+                           'u_gender, u_level, version)')
+    assert data == '7\tAnn\tLee\tF\tpaid\t2000\n'
+    # then the hash upsert from the temp table
+    assert queries[2].strip().startswith('DELETE FROM users')
+    assert 'FROM    users_load' in queries[2]
+    assert 'MD5(' in queries[2] and 'u_row_hash' in queries[2]
+    assert queries[3] == 'DROP TABLE IF EXISTS users_load'
+    assert conn.commits == 1
+
+
+def test_upsert_dimension_without_version(config):
+    conn = FakeConnection()
+    songs = pd.DataFrame({'song_id': ['S1'], 'title': ['t'], 'artist_id': ['A1'],
+                          'year': [2000], 'duration': [1.5]})
+
+    transform.upsert_dimension(conn.cur, conn, 'songs', transform.build_songs(songs))
+
+    assert '0::BIGINT AS version' in conn.cur.queries[1]
+    assert conn.cur.copies[0][1] == 'S1\tt\tA1\t2000\t1.5\t0\n'
@@ -0,0 +1,298 @@
+import psycopg2
+import numpy as np
+import pandas as pd
+import time
+from mylib import logger
+import metrics
+import run_state
+from local_ingest import copy_records
+from sql_queries import dimension_tables, dimension_load_queries, dimension_upsert
+
+# ---------------------------------------------------------------------------------
+# In-process transform engine: build the five analytics tables from the staged
+# event and song data with vectorized pandas/NumPy operations, then bulk-load
+# them with COPY ... FROM STDIN (Postgres target only).  The dimension rows go
+# through a temp table and the same hash upsert as the SQL inserts.  A fast
+# path for small batches, and a reference to check the results of the SQL
+# inserts against.
+# ---------------------------------------------------------------------------------
+
+
+SONGPLAY_COLUMNS = ['sp_start_time', 'sp_user_id', 'sp_level', 'sp_song_id',
+                    'sp_artist_id', 'sp_session_id', 'sp_location', 'sp_user_agent']
+USER_COLUMNS     = ['u_user_id', 'u_first_name', 'u_last_name', 'u_gender', 'u_level', 'u_ts']
+SONG_COLUMNS     = ['s_song_id', 's_title', 's_artist_id', 's_year', 's_duration']
+ARTIST_COLUMNS   = ['a_artist_id', 'a_name', 'a_location', 'a_latitude', 'a_longitude']
+TIME_COLUMNS     = ['t_start_time', 't_hour', 't_day', 't_week', 't_month',
+                    't_year', 't_weekday']
+
+
+def read_staging(conn):
+    """
+    Read both staging tables into DataFrames (column names in lower case,
+    as Postgres folds unquoted identifiers).
+
+    Parameters:
+        conn (db session object) : connection to a database session
+
+    Returns:
+        (events, songs) : DataFrames of staging_events and staging_songs
+
+    """
+    events = pd.read_sql("SELECT * FROM staging_events", conn)
+    songs  = pd.read_sql("SELECT * FROM staging_songs", conn)
+
+    events.columns = events.columns.str.lower()
+    songs.columns  = songs.columns.str.lower()
+
+    return events, songs
+
+
+def next_song_events(events):
+    """
+    Return the song play events (page = 'NextSong') with a numeric user id.
+
+    """
+    plays = events[events['page'] == 'NextSong'].copy()
+    plays['user_id'] = pd.to_numeric(plays['userid'], errors = 'coerce')
+    return plays[plays['user_id'].notna()]
+
+
+def build_songplays(events, songs):
+    """
+    Build the songplays fact table (songplay_table_insert): hash join of the
+    song play events with the songs on (title, artist name).
+
+    Parameters:
+        events (DataFrame) : staging_events
+        songs (DataFrame) : staging_songs
+
+    Returns:
+        songplays (DataFrame) : columns SONGPLAY_COLUMNS
+
+    """
+    plays = next_song_events(events)
+    keys  = songs[['title', 'artist_name', 'song_id', 'artist_id']]
+
+    joined = plays.merge(keys, how = 'inner',
+                         left_on = ['song', 'artist'],
+                         right_on = ['title', 'artist_name'])
+
+    # whole seconds, as TIMESTAMP 'epoch' + ts/1000 * INTERVAL '1 second'
+    start_time = pd.to_datetime(joined['ts'].to_numpy(dtype = np.int64) // 1000,
+                                unit = 's')
+
+    return pd.DataFrame({'sp_start_time' : start_time,
+                         'sp_user_id'    : joined['user_id'].astype(np.int64).to_numpy(),
+                         'sp_level'      : joined['level'].to_numpy(),
+                         'sp_song_id'    : joined['song_id'].to_numpy(),
+                         'sp_artist_id'  : joined['artist_id'].to_numpy(),
+                         'sp_session_id' : joined['sessionid'].to_numpy(),
+                         'sp_location'   : joined['location'].to_numpy(),
+                         'sp_user_agent' : joined['useragent'].to_numpy()
+                        }, columns = SONGPLAY_COLUMNS)
+
+
+def build_users(events):
+    """
+    Build the users dimension (user_table_insert): one row per user of the
+    song play events, with the attributes of the user's latest event by ts.
+
+    """
+    plays = next_song_events(events).sort_values('ts', kind = 'stable')
+    plays = plays.drop_duplicates('user_id', keep = 'last')
+    users = pd.DataFrame({'u_user_id'    : plays['user_id'].astype(np.int64),
+                          'u_first_name' : plays['firstname'],
+                          'u_last_name'  : plays['lastname'],
+                          'u_gender'     : plays['gender'],
+                          'u_level'      : plays['level'],
+                          'u_ts'         : plays['ts']
+                         }, columns = USER_COLUMNS)
+    return users.reset_index(drop = True)
+
+
+def build_songs(songs):
+    """
+    Build the songs dimension (song_table_insert): one row per song id.
+
+    """
+    rows = songs[songs['song_id'].notna()]
+    result = pd.DataFrame({'s_song_id'   : rows['song_id'],
+                           's_title'     : rows['title'],
+                           's_artist_id' : rows['artist_id'],
+                           's_year'      : rows['year'],
+                           's_duration'  : rows['duration']
+                          }, columns = SONG_COLUMNS)
+    return result.drop_duplicates('s_song_id').reset_index(drop = True)
+
+
+def build_artists(songs):
+    """
+    Build the artists dimension (artist_table_insert): one row per artist id.
+
+    """
+    rows = songs[songs['artist_id'].notna()]
+    result = pd.DataFrame({'a_artist_id' : rows['artist_id'],
+                           'a_name'      : rows['artist_name'],
+                           'a_location'  : rows['artist_location'],
+                           'a_latitude'  : rows['artist_latitude'],
+                           'a_longitude' : rows['artist_longitude']
+                          }, columns = ARTIST_COLUMNS)
+    return result.drop_duplicates('a_artist_id').reset_index(drop = True)
+
+
+def build_time(songplays):
+    """
+    Build the time dimension (time_table_insert) from the distinct song play
+    start times, with vectorized date-part extraction.
+
+    DATE_PART(week) is the ISO week, and DATE_PART(weekday) counts from
+    Sunday = 0.
+
+    """
+    start = pd.DatetimeIndex(songplays['sp_start_time'].drop_duplicates())
+
+    return pd.DataFrame({'t_start_time' : start,
+                         't_hour'       : start.hour,
+                         't_day'        : start.day,
+                         't_week'       : start.isocalendar().week.to_numpy(dtype = np.int64),
+                         't_month'      : start.month,
+                         't_year'       : start.year,
+                         't_weekday'    : (start.dayofweek + 1) % 7
+                        }, columns = TIME_COLUMNS).reset_index(drop = True)
+
+
+def build_tables(events, songs):
+    """
+    Build all five analytics tables from the staged data.
+
+    Parameters:
+        events (DataFrame) : staging_events
+        songs (DataFrame) : staging_songs
+
+    Returns:
+        tables (dict) : {table: (DataFrame, columns)}, in load order
+
+    """
+    songplays = build_songplays(events, songs)
+
+    return {'songplays' : (songplays,              SONGPLAY_COLUMNS),
+            'users'     : (build_users(events),    USER_COLUMNS),
+            'songs'     : (build_songs(songs),     SONG_COLUMNS),
+            'artists'   : (build_artists(songs),   ARTIST_COLUMNS),
+            'time'      : (build_time(songplays),  TIME_COLUMNS)
+           }
+
+
+def frame_rows(frame):
+    """
+    Yield the rows of a DataFrame as tuples, with missing values as None.
+
+    """
+    values = frame.astype(object).where(frame.notna(), None)
+    return values.itertuples(index = False, name = None)
+
+
+def upsert_dimension(cur, conn, table, frame):
+    """
+    Load a dimension frame into a temp table and upsert it into the table
+    with dimension_upsert: rows whose hash is unchanged are left alone,
+    changed rows are replaced and new keys inserted, in one transaction.
+
+    Returns:
+        count (int) : number of rows inserted (changed or new)
+
+    """
+    key, columns, hash_column, version_column, select = dimension_tables[table]
+    load = table + '_load'
+    drop, create = dimension_load_queries(table, load)
+
+    values = frame[[key] + columns].copy()
+    values['version'] = frame[version_column].to_numpy() if version_column else 0
+
+    cur.execute(drop)
+    cur.execute(create)
+    copy_records(cur, conn, load, list(values.columns), frame_rows(values), commit = False)
+    cur.execute(dimension_upsert(table, load, prepared = True))
+    count = cur.rowcount
+    cur.execute(drop)
+    conn.commit()
+
+    return count
+
+
+def insert_tables_pandas(cur, conn, events=None, songs=None):
+    """
+    Build the analytics tables in-process and bulk-load them; the dimension
+    tables are upserted (upsert_dimension), the others appended.
+
+    Parameters:
+        cur (cursor object) : for executing PostgreSQL command in a db session
+        conn (db session object) : connection to a database session
+        events, songs (DataFrame) : staged data; read from the staging
+                                    tables when not given
+
+    Returns:
+        counts (dict) : {table: rows loaded}
+
+    """
+    logger.info('Load final tables (pandas)...')
+
+    if events is None or songs is None:
+        events, songs = read_staging(conn)
+
+    start = time.time()
+    tables = build_tables(events, songs)
+    logger.info('transform :  {:.2f} sec'.format(time.time() - start))
+
+    counts = {}
+    for table, (frame, columns) in tables.items():
+        if run_state.is_done('insert_tables', table):
+            logger.info('table [ {} ] :  inserted by an earlier attempt'.format(table))
+            continue
+        logger.info('insert to table [ {} ]'.format(table))
+        start = time.time()
+
+        try:
+            if table in dimension_tables:
+                counts[table] = upsert_dimension(cur, conn, table, frame)
+            else:
+                counts[table] = copy_records(cur, conn, table, columns, frame_rows(frame))
+            metrics.record('insert_tables', table, time.time() - start, counts[table])
+            run_state.mark_done('insert_tables', table, rows = counts[table])
+
+        except psycopg2.Error as e:
+            conn.rollback()
+            run_state.mark_failed('insert_tables', table, e)
+            metrics.record('insert_tables', table, time.time() - start,
+                           status = 'failed', error = str(e))
+            logger.info('Error: Inserting to table [ {} ]'.format(table))
+            print(e)
+
+    return counts
+
+
+def compare_counts(cur, tables):
+    """
+    Compare the row counts of the analytics tables in the database with the
+    tables built in-process, e.g. to check the SQL inserts.
+
+    Parameters:
+        cur (cursor object) : for executing PostgreSQL command in a db session
+        tables (dict) : {table: (DataFrame, columns)} from build_tables()
+
+    Returns:
+        mismatches (dict) : {table: (db rows, in-process rows)} that differ
+
+    """
+    mismatches = {}
+    for table, (frame, columns) in tables.items():
+        cur.execute("SELECT COUNT(*) FROM {}".format(table))
+        rows = cur.fetchone()[0]
+
+        if rows != len(frame):
+            mismatches[table] = (rows, len(frame))
+            logger.info('table count [ {} ] :  db {}  in-process {}'
+                        .format(table, rows, len(frame)))
+
+    return mismatches